@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""客户端基准测试：CLI 冷启动、批量生成吞吐量和流式首字延迟，全部使用离线的 FakeBackend
+
+用法 (仓库根目录): python -m pytest benchmarks/bench_client.py
+"""
+
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+from gemini_cli import ContextManager, FakeBackend, GeminiClient, RetryPolicy, RateLimiter, run_batch
+
+CLI = str(Path(__file__).resolve().parent.parent / "gemini_cli.py")
+
+
+@pytest.mark.parametrize("args", [["--help"], ["sessions", "-l", "5"], ["search", "机器学习"],
+                                  ["generate", "--no-cache", "你好"]],
+                         ids=["help", "sessions", "search", "generate"])
+def test_cli_cold_start(benchmark, tmp_path, args):
+    """启动新进程执行一条命令的总耗时（含解释器启动和模块导入）"""
+    env = dict(os.environ, GEMINI_API_KEY="bench", GEMINI_TRANSPORT="fake", GEMINI_FAKE="reply_tokens=16")
+    env.pop("GEMINI_SOCKET", None)
+
+    def run():
+        result = subprocess.run([sys.executable, CLI] + args, cwd=tmp_path, env=env, capture_output=True)
+        assert result.returncode == 0, result.stderr.decode("utf-8", "replace")
+
+    benchmark.pedantic(run, rounds=10, warmup_rounds=1)
+
+
+def test_batch_throughput(benchmark, tmp_path):
+    """200 条提示词、8 个线程、每次请求 20 ms 时的批量完成时间"""
+    items = [{"id": str(i), "prompt": f"第 {i} 个问题"} for i in range(200)]
+    client = GeminiClient("bench", context_manager=ContextManager(str(tmp_path / "data")),
+                          backend=FakeBackend(latency_ms=20), retry=RetryPolicy(limiter=RateLimiter()))
+    outputs = iter(range(10 ** 6))
+
+    def setup():
+        return (client, items, str(tmp_path / f"out{next(outputs)}.jsonl"), "fake-flash"), {"workers": 8}
+
+    stats = benchmark.pedantic(run_batch, setup=setup, rounds=5)
+    assert stats["succeeded"] == len(items)
+    if benchmark.stats:  # --benchmark-disable 时只执行一次，没有统计数据
+        benchmark.extra_info["items_per_second"] = round(len(items) / benchmark.stats.stats.mean, 1)
+
+
+def test_streaming_first_chunk(benchmark, tmp_path):
+    """流式生成的首个片段延迟应等于后端的 TTFT，不受客户端额外开销影响"""
+    manager = ContextManager(str(tmp_path / "data"), fsync_policy="never")
+    client = GeminiClient("bench", context_manager=manager,
+                          backend=FakeBackend(ttft_ms=5, chunk_ms=1, reply_tokens=64, chunk_tokens=8))
+
+    def generate():
+        return client.generate("流式输出一段文字", "fake-flash", on_chunk=lambda text: None)
+
+    text, timing, usage = benchmark(generate)
+    assert usage["candidate_tokens"] == 64
+    benchmark.extra_info["first_chunk_ms"] = timing["first_chunk_ms"]
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""会话存储基准测试：长会话的追加/保存/恢复，大量会话的列表和搜索
+
+用法 (仓库根目录): python -m pytest benchmarks/bench_storage.py
+"""
+
+import shutil
+
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+from gemini_cli import ContextManager
+
+
+@pytest.fixture
+def long_manager(tmp_path, long_session_dir, storage):
+    """载入 10k 条消息会话的 ContextManager（数据目录为副本，测量中的写入互不影响）"""
+    data_dir = tmp_path / "data"
+    shutil.copytree(long_session_dir, data_dir)
+    manager = ContextManager(str(data_dir), fsync_policy="never", storage=storage)
+    assert manager.load_session("long0001")
+    yield manager
+    manager.close()
+
+
+def test_add_message(benchmark, long_manager):
+    benchmark(long_manager.add_message, "user", "继续讨论上面的索引设计问题", 12)
+
+
+def test_save_session(benchmark, long_manager):
+    benchmark(long_manager.save_session)
+
+
+def test_chat_resume(benchmark, long_session_dir, storage):
+    """恢复会话：载入全部消息并按 Token 预算重建对话历史"""
+    manager = ContextManager(long_session_dir, fsync_policy="never", storage=storage)
+
+    def resume():
+        manager.load_session("long0001")
+        return manager.get_chat_history()
+
+    assert benchmark(resume)
+
+
+def test_list_sessions(benchmark, many_sessions_dir, storage):
+    manager = ContextManager(many_sessions_dir, fsync_policy="never", storage=storage)
+    assert len(benchmark(manager.list_sessions, 20)) == 20
+
+
+@pytest.mark.parametrize("query", ["索引设计", '"machine learning"', "detail"])
+def test_search_messages(benchmark, many_sessions_dir, storage, query):
+    manager = ContextManager(many_sessions_dir, fsync_policy="never", storage=storage)
+    assert benchmark(manager.search_messages, query, 20)
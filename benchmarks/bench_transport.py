@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""传输层基准测试：比较 SDK 与 REST 连接池在本地桩服务上的单次请求延迟
+
+用法: python -m benchmarks.bench_transport [--requests 50] [--connect-delay 50] [--latency 0]
+
+--connect-delay 模拟每个新连接的 TLS + 代理 CONNECT 握手耗时 (毫秒)。
+SDK 默认走 gRPC，无法指向 HTTP 桩服务，这里使用 SDK 自带的 REST 传输作为对照。
+"""
+
+import argparse
+import statistics
+import time
+import warnings
+
+from benchmarks.stub_server import StubGeminiServer
+from gemini_cli import RestBackend
+
+
+def measure(name, server, call, count):
+    connections = server.connections
+    samples = []
+    for i in range(count):
+        started = time.perf_counter()
+        call(f"问题 {i}")
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+    print(f"{name:<16} 中位数 {statistics.median(samples):7.1f} ms  p95 {p95:7.1f} ms  "
+          f"平均 {statistics.mean(samples):7.1f} ms  新建连接 {server.connections - connections}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--connect-delay", type=float, default=50.0, help="每个新连接的握手耗时 (毫秒)")
+    parser.add_argument("--latency", type=float, default=0.0, help="服务端生成耗时 (毫秒)")
+    args = parser.parse_args()
+
+    with StubGeminiServer(connect_delay=args.connect_delay / 1000, latency=args.latency / 1000) as server:
+        print(f"桩服务 {server.endpoint}，{args.requests} 次请求，握手 {args.connect_delay:.0f} ms\n")
+
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                import google.generativeai as genai
+            genai.configure(api_key="bench", transport="rest", client_options={"api_endpoint": server.endpoint})
+            measure("sdk (rest)", server,
+                    lambda prompt: genai.GenerativeModel("stub-pro").generate_content(prompt).text, args.requests)
+        except ImportError:
+            print("sdk (rest)       未安装 google-generativeai，跳过")
+
+        def cold(prompt):
+            backend = RestBackend(endpoint=server.endpoint)
+            backend.configure("bench")
+            backend.GenerativeModel("stub-pro").generate_content(prompt).text
+            backend.close()
+
+        measure("rest 每次新连接", server, cold, args.requests)
+
+        pooled = RestBackend(endpoint=server.endpoint)
+        pooled.configure("bench")
+        model = pooled.GenerativeModel("stub-pro")
+        measure("rest 连接池", server, lambda prompt: model.generate_content(prompt).text, args.requests)
+        pooled.close()
+
+
+if __name__ == "__main__":
+    main()
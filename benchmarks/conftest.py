@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""基准测试的公共数据集：一个 10k 条消息的长会话、10k 个短会话
+
+数据集按存储后端各生成一次 (session 作用域)，日志后端直接写入 JSONL 文件，
+SQLite 后端由日志迁移得到，生成时间不计入测量。
+"""
+
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+from gemini_cli import ContextManager, migrate_sessions
+
+LONG_MESSAGES = 10_000
+SESSION_COUNT = 10_000
+TOPICS = ("Python 异步编程", "数据库索引设计", "machine learning pipeline", "前端性能优化",
+          "Kubernetes deployment", "缓存失效策略", "日志采集与检索", "distributed tracing")
+
+
+def _message(i: int, timestamp: str) -> dict:
+    topic = TOPICS[i % len(TOPICS)]
+    role = "user" if i % 2 == 0 else "assistant"
+    content = f"关于{topic}的第 {i} 条讨论，包含一些细节说明 detail-{i % 97} 和示例代码。" * (1 if role == "user" else 4)
+    return {"role": role, "content": content, "timestamp": timestamp, "tokens": len(content) // 2}
+
+
+def _write_journal(path, session_id: str, name: str, messages: list, created_at: str):
+    header = {"type": "header", "version": 2, "id": session_id, "name": name, "created_at": created_at,
+              "context_summary": ""}
+    with open(path / f"{session_id}.jsonl", "w", encoding="utf-8") as f:
+        f.write(json.dumps(header, ensure_ascii=False) + "\n")
+        for message in messages:
+            f.write(json.dumps(dict(type="message", **message), ensure_ascii=False) + "\n")
+
+
+def _build(data_dir, storage: str, sessions: list) -> str:
+    journal_dir = data_dir / "journal"
+    (journal_dir / "sessions").mkdir(parents=True)
+    for session_id, name, messages, created_at in sessions:
+        _write_journal(journal_dir / "sessions", session_id, name, messages, created_at)
+    source = ContextManager(str(journal_dir), fsync_policy="never")
+    source.sync_index()
+    if storage == "journal":
+        source.close()
+        return str(journal_dir)
+    target_dir = data_dir / "sqlite"
+    migrate_sessions(source, ContextManager(str(target_dir), fsync_policy="never", storage="sqlite"))
+    return str(target_dir)
+
+
+@pytest.fixture(scope="session", params=ContextManager.STORAGE_BACKENDS)
+def storage(request):
+    return request.param
+
+
+@pytest.fixture(scope="session")
+def long_session_dir(tmp_path_factory, storage):
+    """包含一个 10k 条消息会话 (ID long0001) 的数据目录"""
+    start = datetime(2024, 1, 1)
+    messages = [_message(i, (start + timedelta(seconds=i)).isoformat()) for i in range(LONG_MESSAGES)]
+    return _build(tmp_path_factory.mktemp(f"long-{storage}"), storage,
+                  [("long0001", "长会话", messages, start.isoformat())])
+
+
+@pytest.fixture(scope="session")
+def many_sessions_dir(tmp_path_factory, storage):
+    """包含 10k 个会话 (每个 4 条消息) 的数据目录"""
+    start = datetime(2024, 1, 1)
+    sessions = []
+    for n in range(SESSION_COUNT):
+        created_at = (start + timedelta(minutes=n)).isoformat()
+        sessions.append((f"s{n:07x}", f"会话 {n}", [_message(n * 4 + i, created_at) for i in range(4)], created_at))
+    return _build(tmp_path_factory.mktemp(f"many-{storage}"), storage, sessions)
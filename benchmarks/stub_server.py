@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""本地 Gemini REST 接口桩服务，用于基准测试和传输层测试
+
+实现 generateContent、streamGenerateContent (SSE) 和 models 列表。
+connect_delay 模拟每个新连接的 TLS/代理 CONNECT 握手耗时，keep-alive 连接只在首次请求时付出。
+"""
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+        if self.server.connect_delay:
+            time.sleep(self.server.connect_delay)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, data: dict, headers: Optional[dict] = None):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    @staticmethod
+    def _reply(text: str, prompt_tokens: int) -> dict:
+        return {
+            "candidates": [{"content": {"role": "model", "parts": [{"text": text}]}}],
+            "usageMetadata": {"promptTokenCount": prompt_tokens, "candidatesTokenCount": len(text),
+                              "totalTokenCount": prompt_tokens + len(text)},
+        }
+
+    def do_GET(self):
+        self.server.requests.append(("GET", self.path, None))
+        self._send_json(200, {"models": [{"name": "models/stub-pro", "displayName": "Stub",
+                                          "supportedGenerationMethods": ["generateContent"]}]})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        self.server.requests.append(("POST", self.path, body))
+        if self.server.fail_next:
+            self.server.fail_next -= 1
+            self._send_json(503, {"error": {"code": 503, "message": "overloaded"}}, {"Retry-After": "0"})
+            return
+
+        prompt = body["contents"][-1]["parts"][0]["text"]
+        prompt_tokens = sum(len(part.get("text", "")) for item in body["contents"] for part in item["parts"])
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if ":streamGenerateContent" not in self.path:
+            self._send_json(200, self._reply(f"回复: {prompt}", prompt_tokens))
+            return
+
+        events = [self._reply(piece, 0) for piece in ("回复", ": ", prompt)]
+        events[-1] = self._reply(prompt, prompt_tokens)
+        events[-1]["usageMetadata"]["candidatesTokenCount"] = len(f"回复: {prompt}")
+        events[-1]["usageMetadata"]["totalTokenCount"] = prompt_tokens + len(f"回复: {prompt}")
+        payload = "".join(f"data: {json.dumps(event, ensure_ascii=False)}\r\n\r\n" for event in events).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class StubGeminiServer(ThreadingHTTPServer):
+    """在后台线程运行的桩服务：with StubGeminiServer() as server: server.endpoint"""
+
+    daemon_threads = True
+
+    def __init__(self, connect_delay: float = 0.0, latency: float = 0.0):
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.connect_delay = connect_delay
+        self.latency = latency
+        self.fail_next = 0
+        self.connections = 0
+        self.requests: List[tuple] = []
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def endpoint(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
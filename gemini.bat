@@ -14,4 +14,4 @@ if not exist .env (
     exit /b 1
 )
 
-python gemini_cli.py %*
\ No newline at end of file
+python -m gemini_cli %*
\ No newline at end of file
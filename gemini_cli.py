@@ -1,35 +1,1490 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import time
+_IMPORT_STARTED = time.perf_counter()  # --timings 中统计模块导入耗时（从此处起的全部导入）
+
 import os
+import re
 import sys
 import json
+import zlib
+import queue
+import atexit
+import random
+import shutil
+import sqlite3
+import threading
+from typing import TYPE_CHECKING, Optional, Dict, Any, List, Tuple, Callable, AsyncIterator
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta
+from pathlib import Path
+from contextlib import contextmanager
+from functools import lru_cache, partial
+from collections import deque
+from types import SimpleNamespace
+
 import click
-import requests
-from typing import Optional, Dict, Any, List, Tuple
-from dotenv import load_dotenv
 from colorama import init, Fore, Style
-import google.generativeai as genai
-from datetime import datetime
-from pathlib import Path
-import uuid
+
+if TYPE_CHECKING:
+    import asyncio
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
 
 # 初始化colorama用于跨平台颜色输出
 init()
 
+
+def _lock_file(f):
+    """对已打开的文件加排他建议锁（阻塞等待）"""
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        return
+    f.seek(0)
+    while True:
+        try:
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            return
+        except OSError:
+            continue  # LK_LOCK 重试约 10 秒后放弃，继续等待
+
+
+def _unlock_file(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+ARCHIVE_SUFFIXES = (".jsonl.zst", ".jsonl.gz")
+
+
+def _archive_suffix() -> str:
+    """归档格式：安装了 zstandard 时用 zstd，否则用 gzip"""
+    try:
+        import zstandard  # noqa: F401
+        return ".jsonl.zst"
+    except ImportError:
+        return ".jsonl.gz"
+
+
+def _open_compressed(path: Path, mode: str = 'rt'):
+    """按扩展名以文本方式打开 .zst / .gz 压缩文件"""
+    if ".zst" in path.suffixes:
+        import zstandard
+        return zstandard.open(path, mode, encoding='utf-8')
+    import gzip
+    return gzip.open(path, mode, encoding='utf-8', compresslevel=6)
+
+
+class _NullSpan:
+    """未启用计时时 Tracer.span 返回的空 span，进入、退出和 set 都不做任何事"""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span:
+    """一个计时阶段，可嵌套；attrs 为附加属性（Token 数、缓存命中、重试次数等）"""
+
+    __slots__ = ("tracer", "name", "attrs", "path", "start", "duration", "thread")
+
+    def __init__(self, tracer: 'Tracer', name: str, attrs: Dict):
+        self.tracer = tracer
+        self.name = name
+        self.attrs = attrs
+        self.path: Tuple[str, ...] = (name,)
+        self.start = self.duration = 0.0
+        self.thread = ""
+
+    def __enter__(self):
+        stack = self.tracer._stack()
+        if stack:
+            self.path = stack[-1].path + (self.name,)
+        stack.append(self)
+        self.thread = threading.current_thread().name
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.perf_counter() - self.start
+        self.tracer._stack().pop()
+        if exc_type is not None:
+            self.attrs["error"] = exc_type.__name__
+        self.tracer._finish(self)
+        return False
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+
+class Tracer:
+    """分阶段计时：span() 记录嵌套阶段的耗时和属性，用于 --timings 汇总和 --trace-file 导出
+
+    未启用时 span() 直接返回共享的空 span，开销只有一次属性检查。各线程分别维护嵌套关系。
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.spans: List[Span] = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def start(self):
+        self.enabled = True
+        self.spans = []
+
+    def span(self, name: str, **attrs):
+        if not self.enabled:
+            return _NULL_SPAN
+        return Span(self, name, attrs)
+
+    def add(self, **values):
+        """累加当前线程最内层 span 的数值属性（如重试次数、限流等待时间）"""
+        if not self.enabled:
+            return
+        stack = self._stack()
+        if stack:
+            for key, value in values.items():
+                stack[-1].attrs[key] = stack[-1].attrs.get(key, 0) + value
+
+    def record(self, name: str, start: float, end: float, **attrs):
+        """记录一个已结束的阶段（如模块导入）"""
+        if self.enabled:
+            span = Span(self, name, attrs)
+            span.start, span.duration, span.thread = start, end - start, threading.current_thread().name
+            self._finish(span)
+
+    def _stack(self) -> List[Span]:
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _finish(self, span: Span):
+        with self._lock:
+            self.spans.append(span)
+
+    def breakdown(self) -> List[Dict]:
+        """按阶段路径汇总，顺序为首次开始的时间"""
+        phases: Dict[Tuple[str, ...], Dict] = {}
+        for span in sorted(self.spans, key=lambda item: item.start):
+            phase = phases.setdefault(span.path, {"path": span.path, "count": 0, "total_ms": 0.0})
+            phase["count"] += 1
+            phase["total_ms"] += span.duration * 1000
+        return list(phases.values())
+
+    def report(self, stream=None):
+        """打印分阶段耗时"""
+        stream = stream or sys.stderr
+        print(f"{Fore.CYAN}=== 分阶段耗时 ==={Style.RESET_ALL}", file=stream)
+        print(f"{'阶段':<40} {'次数':>6} {'总耗时(ms)':>12} {'平均(ms)':>10}", file=stream)
+        for phase in self.breakdown():
+            label = "  " * (len(phase["path"]) - 1) + phase["path"][-1]
+            print(f"{label:<40} {phase['count']:>6} {phase['total_ms']:>12.1f} "
+                  f"{phase['total_ms'] / phase['count']:>10.1f}", file=stream)
+
+    def export(self, path: str, trace_format: Optional[str] = None):
+        """追加写入追踪记录：jsonl 为每个 span 一行 JSON，chrome 为 Chrome trace 事件数组（可在 Perfetto 中打开）"""
+        trace_format = trace_format or ("chrome" if path.endswith(".json") else "jsonl")
+        # perf_counter 换算为墙上时间，多次运行追加到同一文件时时间轴仍然一致
+        offset = time.time() - time.perf_counter()
+        pid = os.getpid()
+        thread_ids: Dict[str, int] = {}
+        with open(path, 'a', encoding='utf-8') as f:
+            if trace_format == "chrome" and f.tell() == 0:
+                f.write("[\n")  # 数组格式允许省略结尾的 ]，因此可以持续追加
+            for span in sorted(self.spans, key=lambda item: item.start):
+                if trace_format == "chrome":
+                    if span.thread not in thread_ids:
+                        thread_ids[span.thread] = len(thread_ids) + 1
+                        f.write(json.dumps({"name": "thread_name", "ph": "M", "pid": pid, "tid": thread_ids[span.thread],
+                                            "args": {"name": span.thread}}) + ",\n")
+                    event = {"name": span.name, "cat": "gemini", "ph": "X", "pid": pid, "tid": thread_ids[span.thread],
+                             "ts": round((span.start + offset) * 1e6), "dur": round(span.duration * 1e6),
+                             "args": span.attrs}
+                    f.write(json.dumps(event, ensure_ascii=False, default=str) + ",\n")
+                else:
+                    record = {"ts": datetime.fromtimestamp(span.start + offset).isoformat(timespec='microseconds'),
+                              "pid": pid, "thread": span.thread, "span": "/".join(span.path),
+                              "duration_ms": round(span.duration * 1000, 3)}
+                    record.update(span.attrs)
+                    f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+
+
+# 进程内共享的计时器，由 --timings / --trace-file 开启
+tracer = Tracer()
+
+
+class SessionCatalog:
+    """会话目录索引 (SQLite)
+
+    保存每个会话的元数据和对应文件的 mtime/大小，列出会话时只需比对文件状态，
+    无需解析消息内容。
+    """
+
+    SORT_FIELDS = ("created_at", "updated_at", "name", "message_count", "total_tokens")
+    USAGE_COLUMNS = {
+        "request_count": "INTEGER NOT NULL DEFAULT 0",
+        "prompt_tokens": "INTEGER NOT NULL DEFAULT 0",
+        "candidate_tokens": "INTEGER NOT NULL DEFAULT 0",
+        "response_ms": "REAL NOT NULL DEFAULT 0"
+    }
+
+    def __init__(self, db_path: Path):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(str(db_path), timeout=30, isolation_level=None, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                id TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                created_at TEXT NOT NULL,
+                updated_at TEXT NOT NULL,
+                message_count INTEGER NOT NULL DEFAULT 0,
+                total_tokens INTEGER NOT NULL DEFAULT 0,
+                file TEXT NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                request_count INTEGER NOT NULL DEFAULT 0,
+                prompt_tokens INTEGER NOT NULL DEFAULT 0,
+                candidate_tokens INTEGER NOT NULL DEFAULT 0,
+                response_ms REAL NOT NULL DEFAULT 0
+            )
+        """)
+        # 旧版目录索引缺少用量统计列，补齐后由 refresh 按文件重新解析
+        columns = {row["name"] for row in self.conn.execute("PRAGMA table_info(sessions)")}
+        for column, ddl in self.USAGE_COLUMNS.items():
+            if column not in columns:
+                self.conn.execute(f"ALTER TABLE sessions ADD COLUMN {column} {ddl}")
+                self.conn.execute("UPDATE sessions SET mtime_ns = -1")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS model_usage (
+                session_id TEXT NOT NULL,
+                model TEXT NOT NULL,
+                request_count INTEGER NOT NULL DEFAULT 0,
+                prompt_tokens INTEGER NOT NULL DEFAULT 0,
+                candidate_tokens INTEGER NOT NULL DEFAULT 0,
+                total_tokens INTEGER NOT NULL DEFAULT 0,
+                response_ms REAL NOT NULL DEFAULT 0,
+                PRIMARY KEY (session_id, model)
+            )
+        """)
+
+    @contextmanager
+    def transaction(self):
+        """显式事务，批量写入时只提交一次"""
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        else:
+            self.conn.execute("COMMIT")
+
+    @staticmethod
+    def entry_from_session(session: Dict) -> Dict:
+        """从完整会话数据提取目录条目（含按模型汇总的用量）"""
+        messages = session.get("messages", [])
+        entry = {
+            "id": session["id"],
+            "name": session["name"],
+            "created_at": session["created_at"],
+            "updated_at": messages[-1]["timestamp"] if messages else session["created_at"],
+            "message_count": len(messages),
+            "total_tokens": session.get("total_tokens", 0),
+            "request_count": 0,
+            "prompt_tokens": 0,
+            "candidate_tokens": 0,
+            "response_ms": 0.0,
+            "models": {}
+        }
+        for msg in messages:
+            usage = msg.get("usage")
+            if not usage:
+                continue
+            response_ms = msg.get("latency", {}).get("total_ms", 0)
+            model = entry["models"].setdefault(usage["model"], {
+                "request_count": 0, "prompt_tokens": 0, "candidate_tokens": 0, "total_tokens": 0, "response_ms": 0.0
+            })
+            for target in (entry, model):
+                target["request_count"] += 1
+                target["prompt_tokens"] += usage["prompt_tokens"]
+                target["candidate_tokens"] += usage["candidate_tokens"]
+                target["response_ms"] += response_ms
+            model["total_tokens"] += usage["total_tokens"]
+        return entry
+
+    def upsert(self, entry: Dict, file: str, stat: os.stat_result):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO sessions (id, name, created_at, updated_at, message_count, total_tokens, "
+            "file, mtime_ns, size, request_count, prompt_tokens, candidate_tokens, response_ms) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (entry["id"], entry["name"], entry["created_at"], entry["updated_at"],
+             entry["message_count"], entry["total_tokens"], file, stat.st_mtime_ns, stat.st_size,
+             entry["request_count"], entry["prompt_tokens"], entry["candidate_tokens"], entry["response_ms"])
+        )
+        self.conn.execute("DELETE FROM model_usage WHERE session_id = ?", (entry["id"],))
+        for model, usage in entry["models"].items():
+            self.conn.execute(
+                "INSERT INTO model_usage VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (entry["id"], model, usage["request_count"], usage["prompt_tokens"],
+                 usage["candidate_tokens"], usage["total_tokens"], usage["response_ms"])
+            )
+
+    def record_message(self, session_id: str, tokens: int, updated_at: str, stat: os.stat_result,
+                       usage: Optional[Dict] = None, response_ms: float = 0):
+        """追加一条消息后增量更新计数；usage 为该次响应的用量（按模型汇总）"""
+        self.conn.execute(
+            "UPDATE sessions SET message_count = message_count + 1, total_tokens = total_tokens + ?, "
+            "updated_at = ?, mtime_ns = ?, size = ? WHERE id = ?",
+            (tokens, updated_at, stat.st_mtime_ns, stat.st_size, session_id)
+        )
+        if not usage:
+            return
+        self.conn.execute(
+            "UPDATE sessions SET request_count = request_count + 1, prompt_tokens = prompt_tokens + ?, "
+            "candidate_tokens = candidate_tokens + ?, response_ms = response_ms + ? WHERE id = ?",
+            (usage["prompt_tokens"], usage["candidate_tokens"], response_ms, session_id)
+        )
+        self.conn.execute(
+            "INSERT INTO model_usage VALUES (?, ?, 1, ?, ?, ?, ?) ON CONFLICT(session_id, model) DO UPDATE SET "
+            "request_count = request_count + 1, prompt_tokens = prompt_tokens + excluded.prompt_tokens, "
+            "candidate_tokens = candidate_tokens + excluded.candidate_tokens, "
+            "total_tokens = total_tokens + excluded.total_tokens, response_ms = response_ms + excluded.response_ms",
+            (session_id, usage["model"], usage["prompt_tokens"], usage["candidate_tokens"],
+             usage["total_tokens"], response_ms)
+        )
+
+    def touch(self, session_id: str, stat: os.stat_result):
+        """文件内容变化但计数不变（如摘要更新）时刷新文件状态"""
+        self.conn.execute(
+            "UPDATE sessions SET mtime_ns = ?, size = ? WHERE id = ?",
+            (stat.st_mtime_ns, stat.st_size, session_id)
+        )
+
+    def stamps(self) -> Dict[str, Tuple[str, int, int]]:
+        """返回 {会话ID: (文件名, mtime_ns, 大小)}"""
+        rows = self.conn.execute("SELECT id, file, mtime_ns, size FROM sessions")
+        return {row["id"]: (row["file"], row["mtime_ns"], row["size"]) for row in rows}
+
+    def remove(self, session_ids: List[str]):
+        self.conn.executemany("DELETE FROM sessions WHERE id = ?", [(sid,) for sid in session_ids])
+        self.conn.executemany("DELETE FROM model_usage WHERE session_id = ?", [(sid,) for sid in session_ids])
+
+    def count(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def query(self, limit: Optional[int] = None, offset: int = 0,
+              sort_by: str = "created_at", descending: bool = True) -> List[Dict]:
+        if sort_by not in self.SORT_FIELDS:
+            raise ValueError(f"不支持的排序字段: {sort_by}")
+        order = "DESC" if descending else "ASC"
+        rows = self.conn.execute(
+            f"SELECT id, name, created_at, updated_at, message_count, total_tokens FROM sessions "
+            f"ORDER BY {sort_by} {order}, id LIMIT ? OFFSET ?",
+            (-1 if limit is None else limit, offset)
+        )
+        return [dict(row) for row in rows]
+
+    def usage_totals(self) -> Dict:
+        row = self.conn.execute(
+            "SELECT COUNT(*) AS sessions, COALESCE(SUM(message_count), 0) AS messages, "
+            "COALESCE(SUM(request_count), 0) AS request_count, COALESCE(SUM(prompt_tokens), 0) AS prompt_tokens, "
+            "COALESCE(SUM(candidate_tokens), 0) AS candidate_tokens, COALESCE(SUM(total_tokens), 0) AS total_tokens, "
+            "COALESCE(SUM(response_ms), 0) AS response_ms FROM sessions"
+        ).fetchone()
+        return dict(row)
+
+    def usage_by_model(self) -> List[Dict]:
+        rows = self.conn.execute(
+            "SELECT model, SUM(request_count) AS request_count, SUM(prompt_tokens) AS prompt_tokens, "
+            "SUM(candidate_tokens) AS candidate_tokens, SUM(total_tokens) AS total_tokens, "
+            "SUM(response_ms) AS response_ms FROM model_usage GROUP BY model ORDER BY total_tokens DESC"
+        )
+        return [dict(row) for row in rows]
+
+    def top_sessions(self, limit: int = 10) -> List[Dict]:
+        rows = self.conn.execute(
+            "SELECT id, name, message_count, request_count, prompt_tokens, candidate_tokens, total_tokens, "
+            "response_ms FROM sessions WHERE total_tokens > 0 ORDER BY total_tokens DESC LIMIT ?",
+            (limit,)
+        )
+        return [dict(row) for row in rows]
+
+
+_CJK_RANGES = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af"
+
+
+@lru_cache(maxsize=None)
+def _cjk_char_pattern() -> re.Pattern:
+    # 含大段 Unicode 区间的正则编译较慢，首次使用时再编译，避免拖慢启动
+    return re.compile(f"[{_CJK_RANGES}]")
+
+
+@lru_cache(maxsize=None)
+def _token_pattern() -> re.Pattern:
+    return re.compile(f"([{_CJK_RANGES}]+)|([^\\W_{_CJK_RANGES}]+)")
+
+
+def estimate_tokens(text: str) -> int:
+    """本地估算 Token 数：中日韩文字约 1 字 1 Token，其余约 4 字符 1 Token"""
+    cjk = len(_cjk_char_pattern().findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def _truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """按估算的 Token 数截断文本，截断时以省略号结尾"""
+    cost = estimate_tokens(text)
+    if cost <= max_tokens:
+        return text
+    cut = max(int(len(text) * max_tokens / cost) - 1, 0)
+    while cut and estimate_tokens(text[:cut]) + 1 > max_tokens:
+        cut = cut * 9 // 10
+    return text[:cut] + "…"
+
+
+def tokenize_text(text: str) -> List[str]:
+    """分词：拉丁文字按单词切分并转小写，中日韩文字切分为重叠的二元组"""
+    tokens = []
+    for cjk, word in _token_pattern().findall(text.lower()):
+        if word:
+            tokens.append(word)
+        elif len(cjk) == 1:
+            tokens.append(cjk)
+        else:
+            tokens.extend(cjk[i:i + 2] for i in range(len(cjk) - 1))
+    return tokens
+
+
+def cjk_chars(text: str) -> List[str]:
+    """文本中出现过的中日韩单字（去重），用于单字查询"""
+    return list(dict.fromkeys(_cjk_char_pattern().findall(text)))
+
+
+class MessageIndex:
+    """消息全文倒排索引 (SQLite FTS5)，与会话目录索引共用数据库
+
+    消息内容先经 tokenize_text 切分为词/二元组写入 terms 列，中日韩单字另写入 chars 列，
+    以支持中文检索；消息本身存放在 indexed_messages 表中，与 FTS 表按 rowid 对应。
+    index_state 表记录每个会话建立索引时的文件状态，用于增量补建索引。
+    """
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+        self.conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS message_index USING fts5(terms, chars)")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS indexed_messages (
+                id INTEGER PRIMARY KEY,
+                session_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                timestamp TEXT NOT NULL,
+                content TEXT NOT NULL
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_indexed_messages_session ON indexed_messages (session_id)")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS index_state (
+                session_id TEXT PRIMARY KEY,
+                mtime_ns INTEGER NOT NULL,
+                size INTEGER NOT NULL
+            )
+        """)
+
+    def add(self, session_id: str, seq: int, message: Dict):
+        cursor = self.conn.execute(
+            "INSERT INTO indexed_messages (session_id, seq, role, timestamp, content) VALUES (?, ?, ?, ?, ?)",
+            (session_id, seq, message["role"], message["timestamp"], message["content"])
+        )
+        self.conn.execute(
+            "INSERT INTO message_index (rowid, terms, chars) VALUES (?, ?, ?)",
+            (cursor.lastrowid, " ".join(tokenize_text(message["content"])), " ".join(cjk_chars(message["content"])))
+        )
+
+    def mark_indexed(self, session_id: str, stat: os.stat_result):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO index_state VALUES (?, ?, ?)",
+            (session_id, stat.st_mtime_ns, stat.st_size)
+        )
+
+    def is_current(self, session_id: str, stat: os.stat_result) -> bool:
+        """索引是否与文件状态为 stat 的会话文件一致"""
+        row = self.conn.execute("SELECT mtime_ns, size FROM index_state WHERE session_id = ?",
+                                (session_id,)).fetchone()
+        return row is not None and (row["mtime_ns"], row["size"]) == (stat.st_mtime_ns, stat.st_size)
+
+    def message_count(self, session_id: str) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM indexed_messages WHERE session_id = ?",
+                                 (session_id,)).fetchone()[0]
+
+    def restamp(self, session_id: str, old: Tuple[int, int], stat: os.stat_result):
+        """会话文件被改写但内容不变（如归档）时更新文件状态，原先已过期的索引保持过期"""
+        self.conn.execute(
+            "UPDATE index_state SET mtime_ns = ?, size = ? WHERE session_id = ? AND mtime_ns = ? AND size = ?",
+            (stat.st_mtime_ns, stat.st_size, session_id, *old)
+        )
+
+    def remove(self, session_ids: List[str]):
+        for session_id in session_ids:
+            self.conn.execute(
+                "DELETE FROM message_index WHERE rowid IN (SELECT id FROM indexed_messages WHERE session_id = ?)",
+                (session_id,)
+            )
+            self.conn.execute("DELETE FROM indexed_messages WHERE session_id = ?", (session_id,))
+            self.conn.execute("DELETE FROM index_state WHERE session_id = ?", (session_id,))
+
+    def reindex(self, session_id: str, messages: List[Dict], mtime_ns: int, size: int):
+        self.remove([session_id])
+        for seq, message in enumerate(messages):
+            self.add(session_id, seq, message)
+        self.conn.execute("INSERT OR REPLACE INTO index_state VALUES (?, ?, ?)", (session_id, mtime_ns, size))
+
+    def stale_sessions(self) -> List[sqlite3.Row]:
+        """与会话目录索引对比，返回需要重建索引的会话"""
+        return self.conn.execute("""
+            SELECT s.id, s.file, s.mtime_ns, s.size FROM sessions s
+            LEFT JOIN index_state i ON i.session_id = s.id
+            WHERE i.mtime_ns IS NOT s.mtime_ns OR i.size IS NOT s.size
+        """).fetchall()
+
+    def orphaned_sessions(self) -> List[str]:
+        """已从会话目录索引中移除、但仍有全文索引的会话"""
+        rows = self.conn.execute("SELECT session_id FROM index_state WHERE session_id NOT IN (SELECT id FROM sessions)")
+        return [row[0] for row in rows]
+
+    @staticmethod
+    def build_match(query: str) -> str:
+        """将查询转换为 FTS5 表达式: 空格分隔的词为 AND 关系，引号内为短语，未加引号的词做前缀匹配"""
+        clauses = []
+        for phrase, term in re.findall(r'"([^"]*)"|(\S+)', query):
+            tokens = tokenize_text(phrase or term)
+            if not tokens:
+                continue
+            if len(tokens) == 1 and _cjk_char_pattern().fullmatch(tokens[0]):
+                clauses.append(f'chars : "{tokens[0]}"')
+                continue
+            clause = '"' + " ".join(tokens) + '"'
+            clauses.append(clause if phrase else clause + " *")
+        return " AND ".join(clauses)
+
+    def search(self, query: str, limit: Optional[int] = None, session_id: Optional[str] = None,
+               role: Optional[str] = None, since: Optional[str] = None, until: Optional[str] = None,
+               ranked: bool = True) -> List[Tuple[str, Dict]]:
+        match = self.build_match(query)
+        if not match:
+            return []
+
+        sql = ("SELECT m.session_id, m.seq, m.role, m.timestamp, m.content FROM message_index f "
+               "JOIN indexed_messages m ON m.id = f.rowid WHERE message_index MATCH ?")
+        params: List[Any] = [match]
+        if session_id:
+            sql += " AND m.session_id = ?"
+            params.append(session_id)
+        if role:
+            sql += " AND m.role = ?"
+            params.append(role)
+        if since:
+            sql += " AND m.timestamp >= ?"
+            params.append(since)
+        if until:
+            sql += " AND m.timestamp < ?"
+            params.append(until)
+        # 不排序相关度时按写入顺序倒序返回，FTS5 可按 rowid 顺序扫描并在达到 limit 后提前结束
+        sql += " ORDER BY f.rank" if ranked else " ORDER BY f.rowid DESC"
+        sql += " LIMIT ?"
+        params.append(-1 if limit is None else limit)
+
+        return [
+            (row["session_id"], {"role": row["role"], "content": row["content"],
+                                 "timestamp": row["timestamp"], "seq": row["seq"]})
+            for row in self.conn.execute(sql, params)
+        ]
+
+
+class HashingEmbedder:
+    """本地嵌入器：词、中文单字/二元组和字符三元组经哈希映射到固定维度（无需网络，结果稳定）
+
+    词频取 1+log(tf)，哈希符号位用于抵消冲突，输出向量按 L2 归一化。
+    """
+
+    def __init__(self, dim: int = 256):
+        self.dim = dim
+        self.key = f"hash-{dim}"
+
+    def _features(self, text: str) -> Dict[str, int]:
+        counts: Dict[str, int] = {}
+        tokens = tokenize_text(text)
+        features = tokens + cjk_chars(text)
+        for token in tokens:
+            if len(token) > 3 and token.isascii():
+                padded = f"<{token}>"
+                features += [padded[i:i + 3] for i in range(len(padded) - 2)]
+        for feature in features:
+            counts[feature] = counts.get(feature, 0) + 1
+        return counts
+
+    def embed(self, texts: List[str], query: bool = False):
+        import numpy as np
+
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature, count in self._features(text).items():
+                digest = zlib.crc32(feature.encode('utf-8'))
+                sign = 1.0 if digest & 0x80000000 else -1.0
+                vectors[row, digest % self.dim] += sign * (1.0 + np.log(count))
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+
+class GeminiEmbedder:
+    """通过 Gemini 嵌入接口生成向量（按批请求，经过客户端的重试和限流）"""
+
+    def __init__(self, client: 'GeminiClient', model: str = "models/text-embedding-004", batch_size: int = 100):
+        self.client = client
+        self.model = model
+        self.batch_size = batch_size
+        self.key = f"gemini-{model.split('/')[-1]}"
+
+    def embed(self, texts: List[str], query: bool = False):
+        import numpy as np
+
+        task_type = "retrieval_query" if query else "retrieval_document"
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            batch = texts[start:start + self.batch_size]
+            result = self.client.retry.call(
+                lambda: self.client.genai.embed_content(model=self.model, content=batch, task_type=task_type),
+                tokens=sum(estimate_tokens(text) for text in batch))
+            vectors.extend(result["embedding"])
+        matrix = np.asarray(vectors, dtype=np.float32).reshape(len(texts), -1)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return matrix / np.maximum(norms, 1e-12)
+
+
+class SemanticIndex:
+    """语义检索索引：消息嵌入矩阵 (float32) 与消息键 (会话ID, 序号) 一一对应
+
+    文件保存在 <目录>/<嵌入器>/ 下：vectors.f32 为按行追加的矩阵，keys.bin 为对应的消息键，
+    meta.json 记录已嵌入到的全文索引行号及该行的消息键（用于发现全文索引重建）。新消息从全文索引的 indexed_messages 表增量嵌入，
+    查询为一次矩阵-向量乘积加 top-k 选择。需要 NumPy。
+    """
+
+    KEY_DTYPE = [("session_id", "S16"), ("seq", "<i4")]
+
+    def __init__(self, directory: Path, embedder: Any, conn: sqlite3.Connection):
+        import numpy as np
+
+        self.np = np
+        self.embedder = embedder
+        self.conn = conn
+        self.directory = directory / embedder.key
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.vectors_path = self.directory / "vectors.f32"
+        self.keys_path = self.directory / "keys.bin"
+        self.meta_path = self.directory / "meta.json"
+        self._load_meta()
+
+    def _load_meta(self):
+        self.meta = {"dim": 0, "last_id": 0, "last_key": None}
+        if self.meta_path.exists():
+            self.meta.update(json.loads(self.meta_path.read_text(encoding='utf-8')))
+        self._matrix = self._keys = None
+
+    def _save_meta(self):
+        tmp_path = self.meta_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(self.meta), encoding='utf-8')
+        os.replace(tmp_path, self.meta_path)
+
+    def _reset(self):
+        for path in (self.vectors_path, self.keys_path):
+            path.unlink(missing_ok=True)
+        self.meta = {"dim": 0, "last_id": 0, "last_key": None}
+        self._matrix = self._keys = None
+
+    def __len__(self) -> int:
+        if not self.keys_path.exists():
+            return 0
+        return self.keys_path.stat().st_size // self.np.dtype(self.KEY_DTYPE).itemsize
+
+    def sync(self, batch_size: int = 256) -> int:
+        """嵌入全文索引中新增的消息，返回新增数量；持有文件锁，多个进程可同时调用"""
+        with open(self.directory / "sync.lock", 'a+b') as lock:
+            _lock_file(lock)
+            try:
+                return self._sync(batch_size)
+            finally:
+                _unlock_file(lock)
+
+    def _truncate(self):
+        """截掉上次中断时多写的向量或键，使两个文件的行数一致"""
+        dim = self.meta["dim"]
+        if not dim or not self.vectors_path.exists() or not self.keys_path.exists():
+            return
+        count = min(len(self), self.vectors_path.stat().st_size // (4 * dim))
+        for path, size in ((self.vectors_path, count * dim * 4),
+                           (self.keys_path, count * self.np.dtype(self.KEY_DTYPE).itemsize)):
+            if path.stat().st_size > size:
+                os.truncate(path, size)
+
+    def _sync(self, batch_size: int) -> int:
+        self._load_meta()  # 其他进程可能已更新索引，以磁盘上的记录为准
+        if self.meta["last_id"]:
+            row = self.conn.execute("SELECT session_id, seq FROM indexed_messages WHERE id = ?",
+                                    (self.meta["last_id"],)).fetchone()
+            if row is None or [row["session_id"], row["seq"]] != self.meta.get("last_key"):
+                self._reset()  # 全文索引被重建或该会话已重建索引，行号不再对应
+        self._truncate()
+        added = 0
+        while True:
+            rows = self.conn.execute(
+                "SELECT id, session_id, seq, content FROM indexed_messages WHERE id > ? ORDER BY id LIMIT ?",
+                (self.meta["last_id"], batch_size)
+            ).fetchall()
+            if not rows:
+                return added
+            vectors = self.embedder.embed([row["content"] for row in rows]).astype(self.np.float32)
+            keys = self.np.array([(row["session_id"].encode('utf-8'), row["seq"]) for row in rows],
+                                 dtype=self.KEY_DTYPE)
+            # 先写向量再写键，中断时以两者中较短的为准，下次同步前截齐
+            with open(self.vectors_path, 'ab') as f:
+                f.write(vectors.tobytes())
+            with open(self.keys_path, 'ab') as f:
+                f.write(keys.tobytes())
+            self.meta.update(dim=vectors.shape[1], last_id=rows[-1]["id"],
+                             last_key=[rows[-1]["session_id"], rows[-1]["seq"]])
+            self._save_meta()
+            self._matrix = self._keys = None
+            added += len(rows)
+
+    def _load(self):
+        if self._matrix is None:
+            count = len(self)
+            dim = self.meta["dim"]
+            if not count or not dim:
+                return None, None
+            count = min(count, self.vectors_path.stat().st_size // (4 * dim))
+            self._matrix = self.np.memmap(self.vectors_path, dtype=self.np.float32, mode='r', shape=(count, dim))
+            self._keys = self.np.fromfile(self.keys_path, dtype=self.KEY_DTYPE, count=count)
+        return self._matrix, self._keys
+
+    def search(self, query: str, limit: Optional[int] = None, session_id: Optional[str] = None,
+               role: Optional[str] = None, since: Optional[str] = None,
+               until: Optional[str] = None) -> List[Tuple[str, Dict]]:
+        np = self.np
+        matrix, keys = self._load()
+        if matrix is None:
+            return []
+        limit = limit or 20
+        scores = matrix @ self.embedder.embed([query], query=True)[0]
+        if session_id:
+            scores = np.where(keys["session_id"] == session_id.encode('utf-8'), scores, -np.inf)
+        if role or since or until:
+            # 一次查询取出满足过滤条件的消息键，在分数上屏蔽其余消息
+            conditions, params = [], []
+            for clause, value in (("session_id = ?", session_id), ("role = ?", role),
+                                  ("timestamp >= ?", since), ("timestamp < ?", until)):
+                if value:
+                    conditions.append(clause)
+                    params.append(value)
+            allowed = {(row[0].encode('utf-8'), row[1]) for row in self.conn.execute(
+                f"SELECT session_id, seq FROM indexed_messages WHERE {' AND '.join(conditions)}", params)}
+            mask = np.fromiter(((key["session_id"], int(key["seq"])) in allowed for key in keys),
+                               dtype=bool, count=len(keys))
+            scores = np.where(mask, scores, -np.inf)
+        # 只需部分排序：按分数依次检查候选直到凑满 limit
+        candidates = min(len(scores), limit * 4 + 16)
+        top = np.argpartition(-scores, candidates - 1)[:candidates] if candidates < len(scores) else np.arange(len(scores))
+        top = top[np.argsort(-scores[top])]
+
+        results = []
+        seen = set()
+        for position in top:
+            if len(results) >= limit or scores[position] == -np.inf:
+                break
+            key = (keys[position]["session_id"].decode('utf-8'), int(keys[position]["seq"]))
+            if key in seen:
+                continue  # 会话重建索引后同一消息可能被嵌入多次
+            seen.add(key)
+            row = self.conn.execute(
+                "SELECT role, timestamp, content FROM indexed_messages WHERE session_id = ? AND seq = ? "
+                "ORDER BY id DESC LIMIT 1", key
+            ).fetchone()
+            if row is None or (role and row["role"] != role) or (since and row["timestamp"] < since) \
+                    or (until and row["timestamp"] >= until):
+                continue  # 会话已删除或不满足过滤条件
+            results.append((key[0], {"role": row["role"], "content": row["content"], "timestamp": row["timestamp"],
+                                     "seq": key[1], "score": round(float(scores[position]), 4)}))
+        return results
+
+
+class SessionStore(ABC):
+    """会话存储后端接口，ContextManager 通过它读写会话
+
+    会话为字典：id/name/created_at/context_summary 等元数据，messages 为消息列表，
+    total_tokens 为 Token 合计。catalog 和 index 为该后端使用的会话目录索引和全文索引。
+    """
+
+    catalog: SessionCatalog
+    index: MessageIndex
+
+    @abstractmethod
+    def create(self, session: Dict):
+        """保存新建的（空）会话"""
+
+    @abstractmethod
+    def load(self, session_id: str) -> Optional[Dict]:
+        """读取完整会话，不存在时返回 None"""
+
+    @abstractmethod
+    def append(self, session: Dict, messages: List[Dict]):
+        """追加消息（session 中已包含这些消息），并在同一事务中更新目录和全文索引"""
+
+    @abstractmethod
+    def update_meta(self, session: Dict, fields: Dict):
+        """更新会话元数据（如摘要）"""
+
+    @abstractmethod
+    def put(self, session: Dict):
+        """写入完整会话，已存在则覆盖（用于迁移）"""
+
+    def peek(self, session_id: str, limit: int) -> Optional[Dict]:
+        """读取会话元数据和最近 limit 条消息，message_count 为消息总数"""
+        session = self.load(session_id)
+        if session is not None:
+            session["message_count"] = len(session["messages"])
+            session["messages"] = session["messages"][-limit:] if limit else []
+        return session
+
+    @abstractmethod
+    def archive(self, session_id: str) -> bool:
+        """将会话压缩归档（目录和全文索引保留），已归档或不存在时返回 False"""
+
+    @abstractmethod
+    def delete(self, session_id: str):
+        """删除会话及其目录和全文索引条目"""
+
+    @abstractmethod
+    def sizes(self) -> Dict[str, int]:
+        """返回 {会话ID: 占用字节数}"""
+
+    def reclaim(self):
+        """归档或删除会话后回收存储空间"""
+
+    def session_ids(self) -> List[str]:
+        self.refresh()
+        return [row["id"] for row in self.catalog.query()]
+
+    def save(self, session: Dict):
+        """手动保存时整理存储（如压缩日志），默认无需操作"""
+
+    def refresh(self):
+        """使会话目录索引与存储内容一致"""
+
+    def sync_index(self):
+        """为目录中新增或变化的会话补建全文索引"""
+
+    def close(self):
+        """释放文件句柄和连接，默认无需操作"""
+
+
+class JournalStore(SessionStore):
+    """追加式日志 (JSONL) 存储，每个会话一个文件
+
+    首行为会话头记录，每条消息追加一行 message 记录，摘要等元数据的更新追加为 meta 记录。
+    meta 记录累积到阈值或手动保存时压缩回 "头记录 + 消息" 的紧凑形式。旧版 .json 会话文件
+    在加载时透明读取并迁移。目录索引和全文索引保存在 catalog.db 中，按文件 mtime/大小校验。
+
+    长期不用的会话可归档为压缩的紧凑日志 (<会话ID>.jsonl.zst 或 .jsonl.gz)，目录和全文索引
+    保留；加载时自动解压回普通日志，只读查看 (peek) 直接读取归档。
+
+    多进程安全：追加和压缩都持有会话的建议锁 (<会话ID>.lock)，读取不加锁。压缩以磁盘上的
+    日志为准重新读取后写入临时文件再原子替换，其他进程追加的消息不会丢失；读者只会看到
+    替换前或替换后的完整文件。
+    """
+
+    JOURNAL_VERSION = 2
+
+    def __init__(self, sessions_dir: Path, catalog_path: Path, fsync_policy: str = "batch",
+                 fsync_interval: float = 1.0, compact_threshold: int = 50):
+        self.sessions_dir = sessions_dir
+        self.fsync_policy = fsync_policy
+        self.fsync_interval = fsync_interval
+        self.compact_threshold = compact_threshold
+        self.catalog = SessionCatalog(catalog_path)
+        self.index = MessageIndex(self.catalog.conn)
+        self._journal = None
+        self._journal_session_id = None
+        self._last_fsync = 0.0
+        self._meta_records = 0
+
+    def _journal_path(self, session_id: str) -> Path:
+        return self.sessions_dir / f"{session_id}.jsonl"
+
+    def _legacy_path(self, session_id: str) -> Path:
+        return self.sessions_dir / f"{session_id}.json"
+
+    def _archive_path(self, session_id: str) -> Optional[Path]:
+        for suffix in ARCHIVE_SUFFIXES:
+            path = self.sessions_dir / f"{session_id}{suffix}"
+            if path.exists():
+                return path
+        return None
+
+    def _scan_session_files(self) -> Dict[str, os.DirEntry]:
+        """扫描会话目录，返回 {会话ID: 文件}（日志优先于归档，归档优先于旧版 JSON）"""
+        priority = {".jsonl": 0, ".jsonl.zst": 1, ".jsonl.gz": 1, ".json": 2}
+        files = {}
+        with os.scandir(self.sessions_dir) as entries:
+            for entry in entries:
+                stem, _, ext = entry.name.partition(".")
+                rank = priority.get("." + ext)
+                if rank is not None and (stem not in files or rank < files[stem][0]):
+                    files[stem] = (rank, entry)
+        return {stem: entry for stem, (_, entry) in files.items()}
+
+    @staticmethod
+    def _read_journal(path: Path) -> Tuple[Dict, int]:
+        """读取会话日志（归档则先解压），返回 (会话数据, 未压缩的 meta 记录数)"""
+        session = None
+        meta_records = 0
+        opener = _open_compressed if path.name.endswith(ARCHIVE_SUFFIXES) else lambda p: open(p, 'r', encoding='utf-8')
+        with opener(path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # 崩溃时可能残留不完整的末行
+                record_type = record.pop("type", None)
+                if record_type == "header":
+                    record.pop("version", None)
+                    session = record
+                    session["messages"] = []
+                    session["total_tokens"] = 0
+                elif session is None:
+                    continue
+                elif record_type == "message":
+                    session["messages"].append(record)
+                    session["total_tokens"] += record.get("tokens", 0)
+                elif record_type == "meta":
+                    session.update(record)
+                    meta_records += 1
+        if session is None:
+            raise ValueError(f"会话日志缺少头记录: {path}")
+        return session, meta_records
+
+    @classmethod
+    def _read_session_file(cls, path: Path) -> Dict:
+        """读取任意格式的会话文件"""
+        if path.name.endswith((".jsonl",) + ARCHIVE_SUFFIXES):
+            return cls._read_journal(path)[0]
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    @contextmanager
+    def _locked(self, session_id: str):
+        """持有会话写锁"""
+        with open(self.sessions_dir / f"{session_id}.lock", 'a+b') as f:
+            _lock_file(f)
+            try:
+                yield
+            finally:
+                _unlock_file(f)
+
+    def _close_journal(self):
+        if self._journal is not None:
+            self._journal.flush()
+            if self.fsync_policy != "never":
+                os.fsync(self._journal.fileno())
+            self._journal.close()
+            self._journal = None
+            self._journal_session_id = None
+
+    def _append_records(self, session_id: str, records: List[Dict]) -> os.stat_result:
+        """向会话日志一次性追加多条记录，只 flush/fsync 一次，返回追加后的文件状态（调用方须持有写锁）"""
+        path = self._journal_path(session_id)
+        # 其他进程压缩后文件已被替换，需要重新打开，否则会写入已删除的旧文件
+        if self._journal_session_id != session_id or os.fstat(self._journal.fileno()).st_ino != path.stat().st_ino:
+            self._close_journal()
+            self._journal = open(path, 'a', encoding='utf-8')
+            self._journal_session_id = session_id
+        self._journal.write("".join(
+            json.dumps(record, ensure_ascii=False, separators=(',', ':')) + "\n" for record in records
+        ))
+        self._journal.flush()
+
+        if self.fsync_policy == "always":
+            os.fsync(self._journal.fileno())
+        elif self.fsync_policy == "batch":
+            now = time.monotonic()
+            if now - self._last_fsync >= self.fsync_interval:
+                os.fsync(self._journal.fileno())
+                self._last_fsync = now
+        return os.fstat(self._journal.fileno())
+
+    def _compact(self, session: Dict, merge: bool = True):
+        """将会话重写为 头记录+消息 的紧凑日志（临时文件 + 原子替换）
+
+        merge=True 时以磁盘上的日志为准（包含其他进程追加的消息和元数据），并同步到内存中的 session。
+        """
+        self._close_journal()
+        path = self._journal_path(session["id"])
+        with self._locked(session["id"]):
+            old = path.stat() if path.exists() else None
+            if merge and old is not None:
+                merged, _ = self._read_journal(path)
+                session.clear()
+                session.update(merged)
+            self._write_compact(session, path)
+            stat = path.stat()
+            # 目录索引在持有写锁时更新，保证记录的文件状态与计数一致
+            with self.catalog.transaction():
+                self.catalog.upsert(SessionCatalog.entry_from_session(session), path.name, stat)
+                if merge and old is not None:
+                    # 以磁盘为准压缩时消息及顺序不变，原先与文件一致的全文索引继续有效
+                    self.index.restamp(session["id"], (old.st_mtime_ns, old.st_size), stat)
+                elif old is None and not session["messages"]:
+                    self.index.mark_indexed(session["id"], stat)
+        self._meta_records = 0
+
+    def _write_compact(self, session: Dict, path: Path):
+        """将会话写为 头记录+消息 的紧凑日志：先写临时文件再原子替换（调用方须持有写锁）"""
+        header = {"type": "header", "version": self.JOURNAL_VERSION}
+        header.update({k: v for k, v in session.items() if k not in ("messages", "total_tokens")})
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        compressed = path.name.endswith(ARCHIVE_SUFFIXES)
+        with (_open_compressed(tmp_path, 'wt') if compressed else open(tmp_path, 'w', encoding='utf-8')) as f:
+            f.write(json.dumps(header, ensure_ascii=False, separators=(',', ':')) + "\n")
+            for msg in session["messages"]:
+                record = {"type": "message"}
+                record.update(msg)
+                f.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + "\n")
+            if not compressed:
+                f.flush()
+                if self.fsync_policy != "never":
+                    os.fsync(f.fileno())
+        if compressed and self.fsync_policy != "never":
+            with open(tmp_path, 'rb') as f:
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        if self.fsync_policy != "never" and hasattr(os, "O_DIRECTORY"):
+            # 确保重命名本身落盘
+            dir_fd = os.open(self.sessions_dir, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+
+    def _move(self, session_id: str, source: Path, target: Path):
+        """以 target 的格式重写会话文件并删除 source，目录和全文索引改指向新文件（调用方须持有写锁）"""
+        session = self._read_session_file(source)
+        old = source.stat()
+        self._write_compact(session, target)
+        source.unlink()
+        with self.catalog.transaction():
+            self.catalog.upsert(SessionCatalog.entry_from_session(session), target.name, target.stat())
+            self.index.restamp(session_id, (old.st_mtime_ns, old.st_size), target.stat())
+
+    def _thaw(self, session_id: str):
+        """会话只有归档时解压回普通日志（调用方须持有写锁）"""
+        if self._journal_path(session_id).exists():
+            return
+        archive = self._archive_path(session_id)
+        if archive is not None:
+            self._move(session_id, archive, self._journal_path(session_id))
+
+    def archive(self, session_id: str) -> bool:
+        if session_id == self._journal_session_id:
+            self._close_journal()
+        with self._locked(session_id):
+            source = self._journal_path(session_id)
+            if not source.exists():
+                source = self._legacy_path(session_id)
+            if not source.exists() or self._archive_path(session_id) is not None:
+                return False
+            self._move(session_id, source, self.sessions_dir / f"{session_id}{_archive_suffix()}")
+        return True
+
+    def delete(self, session_id: str):
+        if session_id == self._journal_session_id:
+            self._close_journal()
+        with self._locked(session_id):
+            for path in (self._journal_path(session_id), self._legacy_path(session_id), self._archive_path(session_id)):
+                if path is not None:
+                    path.unlink(missing_ok=True)
+            with self.catalog.transaction():
+                self.catalog.remove([session_id])
+                self.index.remove([session_id])
+        (self.sessions_dir / f"{session_id}.lock").unlink(missing_ok=True)
+
+    def sizes(self) -> Dict[str, int]:
+        self.refresh()
+        return {session_id: size for session_id, (_, _, size) in self.catalog.stamps().items()}
+
+    def create(self, session: Dict):
+        self._compact(session)
+
+    def put(self, session: Dict):
+        self._compact(session, merge=False)
+        self._legacy_path(session["id"]).unlink(missing_ok=True)
+
+    def load(self, session_id: str) -> Optional[Dict]:
+        self._close_journal()
+        journal_file = self._journal_path(session_id)
+        legacy_file = self._legacy_path(session_id)
+        if not journal_file.exists() and self._archive_path(session_id) is not None:
+            with self._locked(session_id):
+                self._thaw(session_id)
+
+        try:
+            if journal_file.exists():
+                session, meta_records = self._read_journal(journal_file)
+            elif legacy_file.exists():
+                with open(legacy_file, 'r', encoding='utf-8') as f:
+                    session = json.load(f)
+                meta_records = None
+            else:
+                return None
+        except Exception:
+            return None
+
+        self._meta_records = meta_records or 0
+        if meta_records is None:
+            self._compact(session)
+            legacy_file.unlink(missing_ok=True)
+        elif meta_records >= self.compact_threshold:
+            self._compact(session)
+        return session
+
+    def peek(self, session_id: str, limit: int) -> Optional[Dict]:
+        archive = None
+        if not self._journal_path(session_id).exists() and not self._legacy_path(session_id).exists():
+            archive = self._archive_path(session_id)
+        if archive is None:
+            return super().peek(session_id, limit)
+        # 只读查看时直接解压读取，不恢复为普通日志
+        try:
+            session = self._read_session_file(archive)
+        except Exception:
+            return None
+        session["message_count"] = len(session["messages"])
+        session["messages"] = session["messages"][-limit:] if limit else []
+        return session
+
+    def append(self, session: Dict, messages: List[Dict]):
+        with self._locked(session["id"]):
+            self._thaw(session["id"])  # 载入后被其他进程归档
+            with self.catalog.transaction():
+                # 序号以磁盘上的日志为准（其他进程可能已追加消息）：全文索引与追加前的文件一致时，
+                # 已索引的消息数即为新消息的起始序号；否则保持过期，由 sync_index 按文件重建
+                indexed = self.index.is_current(session["id"], self._journal_path(session["id"]).stat())
+                first_seq = self.index.message_count(session["id"]) if indexed else 0
+                stat = self._append_records(session["id"],
+                                            [dict(type="message", **message) for message in messages])
+                for seq, message in enumerate(messages, first_seq):
+                    self.catalog.record_message(session["id"], message["tokens"], message["timestamp"], stat,
+                                                message.get("usage"), message.get("latency", {}).get("total_ms", 0))
+                    if indexed:
+                        self.index.add(session["id"], seq, message)
+                if indexed:
+                    self.index.mark_indexed(session["id"], stat)
+
+    def update_meta(self, session: Dict, fields: Dict):
+        with self._locked(session["id"]):
+            self._thaw(session["id"])
+            old = self._journal_path(session["id"]).stat()
+            stat = self._append_records(session["id"], [dict(type="meta", **fields)])
+            self._meta_records += 1
+            if self._meta_records < self.compact_threshold:
+                with self.catalog.transaction():
+                    self.catalog.touch(session["id"], stat)
+                    self.index.restamp(session["id"], (old.st_mtime_ns, old.st_size), stat)
+                return
+        self._compact(session)
+
+    def save(self, session: Dict):
+        self._compact(session)
+
+    def close(self):
+        self._close_journal()
+
+    def refresh(self):
+        """按文件 mtime/大小校验会话目录，只重新解析发生变化的会话文件"""
+        files = self._scan_session_files()
+        stamps = self.catalog.stamps()
+        removed = [sid for sid in stamps if sid not in files]
+        stale = []
+        for session_id, entry in files.items():
+            stat = entry.stat()
+            if stamps.get(session_id) != (entry.name, stat.st_mtime_ns, stat.st_size):
+                stale.append((entry, stat))
+        if not removed and not stale:
+            return
+
+        with self.catalog.transaction():
+            self.catalog.remove(removed)
+            for entry, stat in stale:
+                try:
+                    session = self._read_session_file(Path(entry.path))
+                except Exception:
+                    continue
+                self.catalog.upsert(SessionCatalog.entry_from_session(session), entry.name, stat)
+
+    def sync_index(self):
+        self.refresh()
+        stale = self.index.stale_sessions()
+        orphaned = self.index.orphaned_sessions()
+        if not stale and not orphaned:
+            return
+
+        with self.catalog.transaction():
+            self.index.remove(orphaned)
+            for row in stale:
+                try:
+                    session = self._read_session_file(self.sessions_dir / row["file"])
+                except Exception:
+                    continue
+                self.index.reindex(row["id"], session["messages"], row["mtime_ns"], row["size"])
+
+
+class SQLiteStore(SessionStore):
+    """SQLite (WAL) 存储：会话元数据和按 (session_id, seq) 索引的消息保存在 sessions.db 中
+
+    消息、目录统计和全文索引在同一事务中更新，多个进程可同时追加同一会话；
+    读取最近 N 条消息只需按主键倒序扫描 N 行，无需载入整个会话。
+    归档的会话消息压缩后存入 archived_messages 表，加载或追加时自动解压回 messages 表。
+    """
+
+    MESSAGE_FIELDS = ("role", "content", "timestamp", "tokens")
+    # 目录索引按文件状态校验，数据库存储没有对应文件，使用固定值
+    NO_FILE = SimpleNamespace(st_mtime_ns=0, st_size=0)
+
+    def __init__(self, db_path: Path, fsync_policy: str = "batch"):
+        self.catalog = SessionCatalog(db_path)
+        self.conn = self.catalog.conn
+        synchronous = {"always": "FULL", "never": "OFF"}.get(fsync_policy, "NORMAL")
+        self.conn.execute(f"PRAGMA synchronous={synchronous}")
+        self.index = MessageIndex(self.conn)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS session_meta (id TEXT PRIMARY KEY, data TEXT NOT NULL)")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS messages (
+                session_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                timestamp TEXT NOT NULL,
+                tokens INTEGER NOT NULL DEFAULT 0,
+                extra TEXT,
+                PRIMARY KEY (session_id, seq)
+            ) WITHOUT ROWID
+        """)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS archived_messages (session_id TEXT PRIMARY KEY, data BLOB NOT NULL)")
+
+    @classmethod
+    def _message_from_row(cls, row: sqlite3.Row) -> Dict:
+        message = {field: row[field] for field in cls.MESSAGE_FIELDS}
+        if row["extra"]:
+            message.update(json.loads(row["extra"]))
+        return message
+
+    def _meta(self, session_id: str) -> Optional[Dict]:
+        row = self.conn.execute("SELECT data FROM session_meta WHERE id = ?", (session_id,)).fetchone()
+        return json.loads(row["data"]) if row else None
+
+    def _write_meta(self, session: Dict):
+        meta = {k: v for k, v in session.items() if k not in ("messages", "total_tokens", "message_count")}
+        self.conn.execute("INSERT OR REPLACE INTO session_meta VALUES (?, ?)",
+                          (session["id"], json.dumps(meta, ensure_ascii=False)))
+
+    def _insert_messages(self, session_id: str, first_seq: int, messages: List[Dict], index: bool = True):
+        for seq, message in enumerate(messages, first_seq):
+            self._insert_message(session_id, seq, message)
+            if index:
+                self.index.add(session_id, seq, message)
+
+    def _insert_message(self, session_id: str, seq: int, message: Dict):
+        extra = {k: v for k, v in message.items() if k not in self.MESSAGE_FIELDS}
+        self.conn.execute(
+            "INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (session_id, seq, message["role"], message["content"], message["timestamp"],
+             message.get("tokens", 0), json.dumps(extra, ensure_ascii=False) if extra else None)
+        )
+
+    def _archived(self, session_id: str) -> Optional[List[Tuple[int, Dict]]]:
+        """归档的消息 [(序号, 消息)]，未归档时返回 None"""
+        import gzip
+        row = self.conn.execute("SELECT data FROM archived_messages WHERE session_id = ?", (session_id,)).fetchone()
+        return json.loads(gzip.decompress(row["data"])) if row else None
+
+    def _thaw(self, session_id: str):
+        """将归档的消息解压回 messages 表（全文索引未删除，无需重建；调用方须处于事务中）"""
+        archived = self._archived(session_id)
+        if archived is None:
+            return
+        for seq, message in archived:
+            self._insert_message(session_id, seq, message)
+        self.conn.execute("DELETE FROM archived_messages WHERE session_id = ?", (session_id,))
+
+    def create(self, session: Dict):
+        with self.catalog.transaction():
+            self._write_meta(session)
+            self.catalog.upsert(SessionCatalog.entry_from_session(session), "", self.NO_FILE)
+            self.index.mark_indexed(session["id"], self.NO_FILE)
+
+    def put(self, session: Dict):
+        with self.catalog.transaction():
+            self.conn.execute("DELETE FROM messages WHERE session_id = ?", (session["id"],))
+            self.index.remove([session["id"]])
+            self._write_meta(session)
+            self._insert_messages(session["id"], 0, session["messages"])
+            self.catalog.upsert(SessionCatalog.entry_from_session(session), "", self.NO_FILE)
+            self.index.mark_indexed(session["id"], self.NO_FILE)
+
+    def load(self, session_id: str) -> Optional[Dict]:
+        session = self._meta(session_id)
+        if session is None:
+            return None
+        if self._archived(session_id) is not None:
+            with self.catalog.transaction():
+                self._thaw(session_id)
+        rows = self.conn.execute("SELECT * FROM messages WHERE session_id = ? ORDER BY seq", (session_id,))
+        session["messages"] = [self._message_from_row(row) for row in rows]
+        session["total_tokens"] = sum(message["tokens"] for message in session["messages"])
+        return session
+
+    def peek(self, session_id: str, limit: int) -> Optional[Dict]:
+        session = self._meta(session_id)
+        if session is None:
+            return None
+        archived = self._archived(session_id)
+        if archived is not None:
+            # 只读查看时直接解压读取，不恢复到 messages 表
+            session["messages"] = [message for _, message in archived[-limit:]] if limit else []
+        else:
+            rows = self.conn.execute(
+                "SELECT * FROM messages WHERE session_id = ? ORDER BY seq DESC LIMIT ?", (session_id, limit)
+            ).fetchall()
+            session["messages"] = [self._message_from_row(row) for row in reversed(rows)]
+        counts = self.conn.execute("SELECT message_count, total_tokens FROM sessions WHERE id = ?",
+                                   (session_id,)).fetchone()
+        session["message_count"], session["total_tokens"] = tuple(counts) if counts else (0, 0)
+        return session
+
+    def append(self, session: Dict, messages: List[Dict]):
+        with self.catalog.transaction():
+            self._thaw(session["id"])  # 载入后被其他进程归档
+            # 序号取自数据库而不是内存，其他进程同时追加时也不会冲突
+            first_seq = self.conn.execute("SELECT COALESCE(MAX(seq) + 1, 0) FROM messages WHERE session_id = ?",
+                                          (session["id"],)).fetchone()[0]
+            self._insert_messages(session["id"], first_seq, messages)
+            for message in messages:
+                self.catalog.record_message(session["id"], message["tokens"], message["timestamp"], self.NO_FILE,
+                                            message.get("usage"), message.get("latency", {}).get("total_ms", 0))
+
+    def update_meta(self, session: Dict, fields: Dict):
+        with self.catalog.transaction():
+            meta = self._meta(session["id"]) or {}
+            meta.update(fields)
+            self.conn.execute("INSERT OR REPLACE INTO session_meta VALUES (?, ?)",
+                              (session["id"], json.dumps(meta, ensure_ascii=False)))
+
+    def archive(self, session_id: str) -> bool:
+        import gzip
+        with self.catalog.transaction():
+            rows = self.conn.execute("SELECT * FROM messages WHERE session_id = ? ORDER BY seq",
+                                     (session_id,)).fetchall()
+            if not rows or self._meta(session_id) is None:
+                return False  # 已归档（追加前总会先解压，两者不会同时存在）或不存在
+            archived = [[row["seq"], self._message_from_row(row)] for row in rows]
+            data = gzip.compress(json.dumps(archived, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+            self.conn.execute("INSERT INTO archived_messages VALUES (?, ?)", (session_id, data))
+            self.conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+        return True
+
+    def delete(self, session_id: str):
+        with self.catalog.transaction():
+            for table, column in (("messages", "session_id"), ("archived_messages", "session_id"),
+                                  ("session_meta", "id")):
+                self.conn.execute(f"DELETE FROM {table} WHERE {column} = ?", (session_id,))
+            self.catalog.remove([session_id])
+            self.index.remove([session_id])
+
+    def sizes(self) -> Dict[str, int]:
+        sizes = {row[0]: len(row[1]) for row in self.conn.execute("SELECT id, data FROM session_meta")}
+        for session_id, size in self.conn.execute(
+                "SELECT session_id, SUM(LENGTH(CAST(content AS BLOB)) + COALESCE(LENGTH(extra), 0)) "
+                "FROM messages GROUP BY session_id"):
+            sizes[session_id] = sizes.get(session_id, 0) + size
+        for session_id, size in self.conn.execute("SELECT session_id, LENGTH(data) FROM archived_messages"):
+            sizes[session_id] = sizes.get(session_id, 0) + size
+        return sizes
+
+    def reclaim(self):
+        """删除或归档后收缩数据库文件"""
+        self.conn.execute("VACUUM")
+
+
 class ContextManager:
-    """上下文管理器，负责会话历史和上下文关联"""
-    
-    def __init__(self, data_dir: str = ".gemini_data"):
+    """上下文管理器，负责会话历史和上下文关联
+
+    会话的读写由存储后端完成：默认为每个会话一个追加式日志文件 (JournalStore)，
+    GEMINI_STORAGE=sqlite 时使用 SQLite 数据库 (SQLiteStore)。两者可用 migrate 命令互相迁移。
+    """
+
+    STORAGE_BACKENDS = ("journal", "sqlite")
+    FSYNC_POLICIES = ("always", "batch", "never")
+    # 组装上下文时，边界处剩余预算低于该值则直接丢弃消息而不截断
+    MIN_TRUNCATED_TOKENS = 32
+
+    def __init__(self, data_dir: str = ".gemini_data", fsync_policy: Optional[str] = None,
+                 fsync_interval: float = 1.0, compact_threshold: int = 50, storage: Optional[str] = None):
         self.data_dir = Path(data_dir)
         self.data_dir.mkdir(exist_ok=True)
         self.sessions_dir = self.data_dir / "sessions"
         self.sessions_dir.mkdir(exist_ok=True)
         self.current_session_id = None
         self.current_session = None
-    
+
+        # 持久化策略: always=每次追加都 fsync, batch=最多每 fsync_interval 秒 fsync 一次, never=交给操作系统
+        self.fsync_policy = (fsync_policy or os.getenv('GEMINI_FSYNC', 'batch')).lower()
+        if self.fsync_policy not in self.FSYNC_POLICIES:
+            raise ValueError(f"未知的 fsync 策略: {self.fsync_policy}")
+        self.storage = (storage or os.getenv('GEMINI_STORAGE', 'journal')).lower()
+        if self.storage == "journal":
+            self.store: SessionStore = JournalStore(self.sessions_dir, self.data_dir / "catalog.db",
+                                                    self.fsync_policy, fsync_interval, compact_threshold)
+        elif self.storage == "sqlite":
+            self.store = SQLiteStore(self.data_dir / "sessions.db", self.fsync_policy)
+        else:
+            raise ValueError(f"未知的存储后端: {self.storage}")
+        self.catalog = self.store.catalog
+        self.index = self.store.index
+        # 语义索引按需开启（需要 NumPy），开启后新消息随 add_message 增量嵌入
+        self.semantic: Optional[SemanticIndex] = None
+
     def create_session(self, name: Optional[str] = None) -> str:
         """创建新会话"""
+        import uuid
         session_id = str(uuid.uuid4())[:8]
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         session_name = name or f"chat_{timestamp}"
@@ -43,52 +1498,68 @@ class ContextManager:
             "total_tokens": 0
         }
         
-        session_file = self.sessions_dir / f"{session_id}.json"
-        with open(session_file, 'w', encoding='utf-8') as f:
-            json.dump(session_data, f, ensure_ascii=False, indent=2)
-        
         self.current_session_id = session_id
         self.current_session = session_data
+        with tracer.span("session.create"):
+            self.store.create(session_data)
         return session_id
     
     def load_session(self, session_id: str) -> bool:
         """加载现有会话"""
-        session_file = self.sessions_dir / f"{session_id}.json"
-        if not session_file.exists():
-            return False
-        
-        try:
-            with open(session_file, 'r', encoding='utf-8') as f:
-                self.current_session = json.load(f)
-            self.current_session_id = session_id
-            return True
-        except Exception:
+        with tracer.span("session.load") as span:
+            session = self.store.load(session_id)
+            span.set(messages=len(session["messages"]) if session else 0)
+        if session is None:
             return False
+        self.current_session_id = session_id
+        self.current_session = session
+        return True
+
+    def peek_session(self, session_id: str, limit: int = 10) -> Optional[Dict]:
+        """读取会话元数据和最近 limit 条消息，不改变当前会话（SQLite 后端无需载入全部消息）"""
+        return self.store.peek(session_id, limit)
     
     def save_session(self):
-        """保存当前会话"""
+        """保存当前会话（日志后端会压缩日志）"""
         if not self.current_session_id or not self.current_session:
             return
-        
-        session_file = self.sessions_dir / f"{self.current_session_id}.json"
-        with open(session_file, 'w', encoding='utf-8') as f:
-            json.dump(self.current_session, f, ensure_ascii=False, indent=2)
+        with tracer.span("session.save", messages=len(self.current_session["messages"])):
+            self.store.save(self.current_session)
+
+    def close(self):
+        """刷新并关闭当前会话的存储"""
+        self.store.close()
     
-    def add_message(self, role: str, content: str, tokens: int = 0):
-        """添加消息到当前会话"""
-        if not self.current_session:
+    def add_message(self, role: str, content: str, tokens: int = 0, extra: Optional[Dict] = None):
+        """添加消息到当前会话，extra 为附加字段（如响应耗时）"""
+        self.add_messages([(role, content, tokens, extra)])
+
+    def add_messages(self, entries: List[Tuple[str, str, int, Optional[Dict]]]):
+        """批量添加消息：一次追加写入、一次目录/全文索引事务
+
+        entries 中每项为 (role, content, tokens, extra)。
+        """
+        if not self.current_session or not entries:
             return
         
-        message = {
-            "role": role,
-            "content": content,
-            "timestamp": datetime.now().isoformat(),
-            "tokens": tokens
-        }
-        
-        self.current_session["messages"].append(message)
-        self.current_session["total_tokens"] += tokens
-        self.save_session()
+        messages = []
+        for role, content, tokens, extra in entries:
+            message = {
+                "role": role,
+                "content": content,
+                "timestamp": datetime.now().isoformat(),
+                "tokens": tokens
+            }
+            if extra:
+                message.update(extra)
+            messages.append(message)
+
+        self.current_session["messages"].extend(messages)
+        self.current_session["total_tokens"] += sum(message["tokens"] for message in messages)
+        with tracer.span("session.append", messages=len(messages)):
+            self.store.append(self.current_session, messages)
+            if self.semantic is not None:
+                self.semantic.sync()
     
     def get_context_messages(self, limit: int = 10) -> List[Dict]:
         """获取上下文消息（最近的N条）"""
@@ -98,78 +1569,1090 @@ class ContextManager:
         messages = self.current_session["messages"]
         return messages[-limit:] if len(messages) > limit else messages
     
+    def get_unsummarized_messages(self) -> List[Dict]:
+        """获取上次摘要之后新增的消息（偏移量保存在会话元数据 summarized_upto 中）"""
+        if not self.current_session:
+            return []
+        return self.current_session["messages"][self.current_session.get("summarized_upto", 0):]
+
+    def get_chat_history(self, token_budget: int = 8000) -> List[Dict]:
+        """将会话消息重建为 start_chat 可用的历史记录
+
+        从最新的消息向前取，直到估算 Token 数超出预算；被截断时在开头附上上下文摘要。
+        结果以用户消息开头，且用户/模型角色交替出现。
+        """
+        if not self.current_session:
+            return []
+
+        messages = self.current_session["messages"]
+        summary = self.get_context_summary()
+        budget = token_budget - (estimate_tokens(summary) if summary else 0)
+        start = len(messages)
+        while start > 0:
+            cost = estimate_tokens(messages[start - 1]["content"])
+            if cost > budget:
+                break
+            budget -= cost
+            start -= 1
+
+        history: List[Dict] = []
+        for msg in messages[start:]:
+            role = "user" if msg["role"] == "user" else "model"
+            if history and history[-1]["role"] == role:
+                history[-1]["parts"].append(msg["content"])
+            elif history or role == "user":
+                history.append({"role": role, "parts": [msg["content"]]})
+        if history and history[-1]["role"] == "user":
+            history.pop()  # 没有得到回复的用户消息不计入历史
+
+        if start > 0 and summary:
+            history[:0] = [
+                {"role": "user", "parts": [f"以下是我们之前对话的摘要: {summary}"]},
+                {"role": "model", "parts": ["好的，我已了解之前的对话内容。"]}
+            ]
+        return history
+
+    def build_context_prompt(self, token_budget: int = 2000) -> str:
+        """在 Token 预算内组装上下文提示：先放摘要，再从最新消息向前填充
+
+        超出预算的消息整条丢弃；边界处剩余预算足够时截断该消息而不是丢弃。
+        Token 数由 estimate_tokens 本地估算，不调用 count_tokens。
+        """
+        if not self.current_session:
+            return ""
+
+        budget = token_budget
+        context_prompt = ""
+        summary = self.get_context_summary()
+        if summary:
+            summary = _truncate_to_tokens(summary, budget)
+            budget -= estimate_tokens(summary)
+            context_prompt += f"上下文摘要: {summary}\n\n"
+
+        lines = []
+        for msg in reversed(self.current_session["messages"]):
+            role = "用户" if msg["role"] == "user" else "AI"
+            line = f"{role}: {msg['content']}"
+            cost = estimate_tokens(line)
+            if cost > budget:
+                if budget >= self.MIN_TRUNCATED_TOKENS:
+                    lines.append(_truncate_to_tokens(line, budget))
+                break
+            lines.append(line)
+            budget -= cost
+
+        if lines:
+            context_prompt += "最近的对话\n" + "\n".join(reversed(lines)) + "\n\n"
+        return context_prompt
+
     def get_context_summary(self) -> str:
         """获取上下文摘要"""
         if not self.current_session:
             return ""
         return self.current_session.get("context_summary", "")
     
-    def update_context_summary(self, summary: str):
-        """更新上下文摘要"""
+    def update_context_summary(self, summary: str, summarized_upto: Optional[int] = None):
+        """更新上下文摘要，summarized_upto 为摘要已覆盖的消息数（默认为全部消息）"""
         if self.current_session:
+            if summarized_upto is None:
+                summarized_upto = len(self.current_session["messages"])
             self.current_session["context_summary"] = summary
-            self.save_session()
+            self.current_session["summarized_upto"] = summarized_upto
+            self.store.update_meta(self.current_session,
+                                   {"context_summary": summary, "summarized_upto": summarized_upto})
+    
+    def refresh_catalog(self):
+        """使会话目录索引与存储内容一致（日志后端按文件 mtime/大小只重新解析变化的文件）"""
+        self.store.refresh()
+
+    def list_sessions(self, limit: Optional[int] = None, offset: int = 0,
+                      sort_by: str = "created_at", descending: bool = True) -> List[Dict]:
+        """列出会话（从会话目录索引读取，支持分页和排序）"""
+        with tracer.span("catalog.refresh"):
+            self.refresh_catalog()
+        with tracer.span("catalog.query"):
+            return self.catalog.query(limit, offset, sort_by, descending)
     
-    def list_sessions(self) -> List[Dict]:
-        """列出所有会话"""
-        sessions = []
-        for session_file in self.sessions_dir.glob("*.json"):
+    def archive_sessions(self, idle_days: float) -> List[str]:
+        """将超过 idle_days 天没有新消息的会话压缩归档，返回本次归档的会话ID"""
+        self.refresh_catalog()
+        cutoff = (datetime.now() - timedelta(days=idle_days)).isoformat()
+        archived = [row["id"] for row in self.catalog.query(sort_by="updated_at", descending=False)
+                    if row["updated_at"] < cutoff and row["id"] != self.current_session_id
+                    and self.store.archive(row["id"])]
+        if archived:
+            self.store.reclaim()
+        return archived
+
+    def prune_sessions(self, max_age_days: Optional[float] = None, max_bytes: Optional[int] = None,
+                       max_sessions: Optional[int] = None, dry_run: bool = False) -> List[Dict]:
+        """按保留策略删除会话，返回被删除（dry_run 时为将被删除）的会话
+
+        按最近活动时间从新到旧保留：超过 max_age_days 天未活动的会话删除；保留的会话数达到
+        max_sessions 或累计大小超过 max_bytes 后，更早的会话全部删除。当前会话始终保留。
+        """
+        self.refresh_catalog()
+        sizes = self.store.sizes()
+        cutoff = (datetime.now() - timedelta(days=max_age_days)).isoformat() if max_age_days is not None else None
+        kept_count = kept_bytes = 0
+        over_budget = False
+        pruned = []
+        for row in self.catalog.query(sort_by="updated_at", descending=True):
+            row["size"] = sizes.get(row["id"], 0)
+            if row["id"] == self.current_session_id:
+                kept_count += 1
+                kept_bytes += row["size"]
+                continue
+            over_budget = over_budget or (max_sessions is not None and kept_count >= max_sessions) \
+                or (max_bytes is not None and kept_bytes + row["size"] > max_bytes)
+            if over_budget or (cutoff is not None and row["updated_at"] < cutoff):
+                pruned.append(row)
+            else:
+                kept_count += 1
+                kept_bytes += row["size"]
+        if not dry_run and pruned:
+            for row in pruned:
+                self.store.delete(row["id"])
+            self.store.reclaim()
+        return pruned
+
+    def sync_index(self):
+        """为新增或被外部修改的会话补建全文索引"""
+        with tracer.span("index.sync"):
+            self.store.sync_index()
+
+    def search_messages(self, query: str, limit: Optional[int] = None, session_id: Optional[str] = None,
+                        role: Optional[str] = None, since: Optional[str] = None,
+                        until: Optional[str] = None, ranked: bool = True) -> List[Tuple[str, Dict]]:
+        """搜索消息（全文索引，按相关度排序，可按会话/角色/时间过滤）"""
+        self.sync_index()
+        with tracer.span("index.search") as span:
+            results = self.index.search(query, limit, session_id, role, since, until, ranked)
+            span.set(results=len(results))
+        return results
+
+    def enable_semantic(self, embedder: Any = None) -> SemanticIndex:
+        """开启语义索引，embedder 默认为本地 HashingEmbedder"""
+        self.semantic = SemanticIndex(self.data_dir / "semantic" / self.storage, embedder or HashingEmbedder(),
+                                      self.index.conn)
+        return self.semantic
+
+    def semantic_search(self, query: str, limit: Optional[int] = None, session_id: Optional[str] = None,
+                        role: Optional[str] = None, since: Optional[str] = None,
+                        until: Optional[str] = None) -> List[Tuple[str, Dict]]:
+        """按语义相似度搜索消息，结果中的 score 为余弦相似度"""
+        self.sync_index()
+        index = self.semantic or self.enable_semantic()
+        with tracer.span("semantic.sync") as span:
+            span.set(embedded=index.sync())
+        with tracer.span("semantic.search"):
+            return index.search(query, limit, session_id, role, since, until)
+
+
+def migrate_sessions(source: ContextManager, target: ContextManager) -> Tuple[int, int]:
+    """将 source 中的会话复制到 target，目标中已存在的会话跳过，返回 (迁移数, 跳过数)"""
+    existing = set(target.store.session_ids())
+    migrated = skipped = 0
+    for session_id in source.store.session_ids():
+        session = None if session_id in existing else source.store.load(session_id)
+        if session is None:
+            skipped += 1
+            continue
+        target.store.put(session)
+        migrated += 1
+    source.close()
+    target.close()
+    return migrated, skipped
+
+
+class ResponseCache:
+    """响应缓存 (SQLite)，以 模型+完整提示词+生成配置 的哈希为键
+
+    支持过期时间 (TTL)、按条数/总大小的 LRU 淘汰，命中/未命中计数持久化，
+    多个 CLI 进程可同时读写。
+    """
+
+    def __init__(self, db_path: Path, ttl: Optional[float] = None, max_entries: Optional[int] = None,
+                 max_bytes: Optional[int] = None):
+        self.ttl = ttl if ttl is not None else float(os.getenv('GEMINI_CACHE_TTL', 7 * 24 * 3600))
+        self.max_entries = max_entries if max_entries is not None else int(os.getenv('GEMINI_CACHE_MAX_ENTRIES', 10000))
+        self.max_bytes = max_bytes if max_bytes is not None else int(float(os.getenv('GEMINI_CACHE_MAX_MB', 100)) * 1024 * 1024)
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(str(db_path), timeout=30, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_accessed ON responses (accessed_at)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+
+    @staticmethod
+    def make_key(model_name: str, prompt: str, config: Optional[Dict] = None) -> str:
+        import hashlib
+        material = json.dumps({"model": model_name, "prompt": prompt, "config": config or {}},
+                              ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def _count(self, name: str):
+        self.conn.execute(
+            "INSERT INTO counters VALUES (?, 1) ON CONFLICT(name) DO UPDATE SET value = value + 1", (name,)
+        )
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            row = self.conn.execute("SELECT response, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row and self.ttl and now - row[1] > self.ttl:
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                row = None
+            if row is None:
+                self._count("misses")
+                return None
+            self.conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            self._count("hits")
+            return row[0]
+
+    def put(self, key: str, model_name: str, response: str):
+        now = time.time()
+        size = len(response.encode('utf-8'))
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, model_name, response, size, now, now)
+                )
+                self._evict()
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def _evict(self):
+        """按最近访问时间淘汰，直到条数和总大小都在限制以内"""
+        entries, total = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        if entries <= self.max_entries and total <= self.max_bytes:
+            return
+        # 沿 accessed_at 索引逐行读取，只读到满足限制为止，不加载全部键
+        victims = []
+        cursor = self.conn.execute("SELECT key, size FROM responses ORDER BY accessed_at")
+        try:
+            for key, size in cursor:
+                if entries <= self.max_entries and total <= self.max_bytes:
+                    break
+                victims.append((key,))
+                entries -= 1
+                total -= size
+        finally:
+            cursor.close()
+        self.conn.executemany("DELETE FROM responses WHERE key = ?", victims)
+        evicted = len(victims)
+        self.conn.execute(
+            "INSERT INTO counters VALUES ('evictions', ?) ON CONFLICT(name) DO UPDATE SET value = value + ?",
+            (evicted, evicted)
+        )
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            counters = dict(self.conn.execute("SELECT name, value FROM counters").fetchall())
+            entries, total = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        return {
+            "hits": counters.get("hits", 0),
+            "misses": counters.get("misses", 0),
+            "evictions": counters.get("evictions", 0),
+            "entries": entries,
+            "bytes": total
+        }
+
+    def clear(self):
+        with self._lock:
+            self.conn.execute("DELETE FROM responses")
+            self.conn.execute("DELETE FROM counters")
+
+
+class PersistenceWorker:
+    """后台持久化线程：聊天循环只把消息写入和摘要保存放入队列，不等待磁盘
+
+    队列有界，写入过快时调用方阻塞等待；每次唤醒时把队列中连续的消息合并为一次追加写入
+    和一次索引事务。close() 会等待队列清空，并在进程正常退出时通过 atexit 自动调用。
+    """
+
+    def __init__(self, context_manager: 'ContextManager', max_pending: int = 256, batch_size: int = 64):
+        self.context_manager = context_manager
+        self.batch_size = batch_size
+        self.queue: queue.Queue = queue.Queue(maxsize=max_pending)
+        self.batches_written = 0
+        self.messages_written = 0
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="gemini-persistence", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def add_message(self, role: str, content: str, tokens: int = 0, extra: Optional[Dict] = None):
+        """与 ContextManager.add_message 相同的签名，写入在后台完成"""
+        self.queue.put(("message", (role, content, tokens, extra)))
+
+    def submit(self, task: Callable[[], Any]) -> bool:
+        """在后台按顺序执行任务（如保存自动摘要），已关闭时丢弃并返回 False"""
+        if self._closed:
+            return False
+        self.queue.put(("task", task))
+        return True
+
+    def flush(self):
+        """等待已提交的写入和任务全部完成"""
+        self.queue.join()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self.queue.put(("stop", None))
+        self._thread.join()
+        atexit.unregister(self.close)
+
+    def _write(self, entries: List[Tuple]):
+        if not entries:
+            return
+        try:
+            self.context_manager.add_messages(entries)
+            self.batches_written += 1
+            self.messages_written += len(entries)
+        except Exception as e:
+            print(f"{Fore.RED}保存消息失败: {e}{Style.RESET_ALL}")
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = False
+            entries = []
+            for kind, payload in batch:
+                if kind == "message":
+                    entries.append(payload)
+                    continue
+                self._write(entries)
+                entries = []
+                if kind == "task":
+                    try:
+                        payload()
+                    except Exception as e:
+                        print(f"{Fore.RED}后台任务失败: {e}{Style.RESET_ALL}")
+                elif kind == "stop":
+                    stop = True
+            self._write(entries)
+
+            for _ in batch:
+                self.queue.task_done()
+            if stop:
+                return
+
+
+class RateLimiter:
+    """令牌桶限流器，同时限制每分钟请求数和 Token 数（线程安全）
+
+    两个桶的容量均为每分钟配额，按时间连续补充；配额为 0 表示不限制。
+    """
+
+    def __init__(self, requests_per_minute: int = 0, tokens_per_minute: int = 0):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._lock = threading.Lock()
+        self._request_allowance = float(requests_per_minute)
+        self._token_allowance = float(tokens_per_minute)
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float):
+        elapsed = now - self._updated
+        self._updated = now
+        if self.requests_per_minute:
+            self._request_allowance = min(self.requests_per_minute,
+                                          self._request_allowance + elapsed * self.requests_per_minute / 60)
+        if self.tokens_per_minute:
+            self._token_allowance = min(self.tokens_per_minute,
+                                        self._token_allowance + elapsed * self.tokens_per_minute / 60)
+
+    def acquire(self, tokens: int = 0) -> float:
+        """阻塞直到配额足够，返回等待的秒数"""
+        if self.tokens_per_minute:
+            tokens = min(tokens, self.tokens_per_minute)  # 超过桶容量的请求按满桶处理
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill(time.monotonic())
+                wait = 0.0
+                if self.requests_per_minute and self._request_allowance < 1:
+                    wait = (1 - self._request_allowance) * 60 / self.requests_per_minute
+                if self.tokens_per_minute and self._token_allowance < tokens:
+                    wait = max(wait, (tokens - self._token_allowance) * 60 / self.tokens_per_minute)
+                if wait == 0.0:
+                    if self.requests_per_minute:
+                        self._request_allowance -= 1
+                    if self.tokens_per_minute:
+                        self._token_allowance -= tokens
+                    return waited
+            time.sleep(wait)
+            waited += wait
+
+    _shared: Optional['RateLimiter'] = None
+    _shared_lock = threading.Lock()
+
+    @classmethod
+    def shared(cls) -> 'RateLimiter':
+        """进程内共享的限流器，配额来自 GEMINI_RPM / GEMINI_TPM (默认不限)"""
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls(int(os.getenv('GEMINI_RPM', 0)), int(os.getenv('GEMINI_TPM', 0)))
+            return cls._shared
+
+
+class CircuitOpenError(RuntimeError):
+    """熔断器打开期间直接拒绝请求"""
+
+
+class RequestCancelled(Exception):
+    """请求被调用方中止（AsyncGeminiClient 的任务被取消、对冲请求落败）后，在下一个片段到达时抛出以停止读取响应"""
+
+
+class CircuitBreaker:
+    """熔断器：连续失败达到阈值后打开，在 reset_timeout 秒内直接拒绝请求；
+    之后放行一个试探请求（半开），成功则关闭，失败则重新打开。
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial_running = False
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at >= self.reset_timeout:
+                return "half_open"
+            return "open"
+
+    def before_call(self):
+        """请求前检查，熔断中抛出 CircuitOpenError"""
+        with self._lock:
+            if self._opened_at is None:
+                return
+            remaining = self.reset_timeout - (time.monotonic() - self._opened_at)
+            if remaining <= 0 and not self._trial_running:
+                self._trial_running = True
+                return
+        raise CircuitOpenError(f"上游服务连续失败，已熔断，{max(remaining, 0):.0f} 秒后重试")
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_running or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+            self._trial_running = False
+
+
+class RetryPolicy:
+    """API 调用的重试层：客户端限流 + 带抖动的指数退避 + 熔断
+
+    只重试临时性错误（429、5xx、超时、连接错误），服务端给出 retry-after 时按其等待。
+    计数器可通过 stats() 读取。同一个实例可在多个线程中共享。
+    """
+
+    RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+    RETRYABLE_ERRORS = {"ResourceExhausted", "TooManyRequests", "ServiceUnavailable", "InternalServerError",
+                        "DeadlineExceeded", "GatewayTimeout", "BadGateway", "RequestTimeout",
+                        "ConnectionError", "Timeout", "ConnectTimeout", "ReadTimeout"}
+    _RETRY_IN = re.compile(r'retry in (\d+(?:\.\d+)?)\s*s', re.IGNORECASE)
+    _RETRY_DELAY = re.compile(r'retry_delay\s*\{\s*seconds:\s*(\d+)')
+
+    def __init__(self, max_retries: Optional[int] = None, base_delay: Optional[float] = None,
+                 max_delay: Optional[float] = None, limiter: Optional[RateLimiter] = None,
+                 breaker: Optional[CircuitBreaker] = None):
+        self.max_retries = max_retries if max_retries is not None else int(os.getenv('GEMINI_MAX_RETRIES', 4))
+        self.base_delay = base_delay if base_delay is not None else float(os.getenv('GEMINI_RETRY_BASE', 1.0))
+        self.max_delay = max_delay if max_delay is not None else float(os.getenv('GEMINI_RETRY_MAX', 30.0))
+        self.limiter = limiter if limiter is not None else RateLimiter.shared()
+        self.breaker = breaker or CircuitBreaker(int(os.getenv('GEMINI_BREAKER_THRESHOLD', 5)),
+                                                 float(os.getenv('GEMINI_BREAKER_RESET', 30.0)))
+        self._lock = threading.Lock()
+        self.counters = {"calls": 0, "retries": 0, "failures": 0, "rejected": 0,
+                         "throttled": 0, "throttle_seconds": 0.0}
+
+    def _count(self, name: str, amount: float = 1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.counters)
+        stats["circuit"] = self.breaker.state
+        return stats
+
+    @staticmethod
+    def _status_code(error: Exception) -> Optional[int]:
+        for value in (getattr(error, "code", None), getattr(error, "status_code", None),
+                      getattr(getattr(error, "response", None), "status_code", None)):
+            if isinstance(value, int):
+                return value
+        return None
+
+    @classmethod
+    def is_retryable(cls, error: Exception) -> bool:
+        if isinstance(error, (ConnectionError, TimeoutError)):
+            return True
+        if type(error).__name__ in cls.RETRYABLE_ERRORS:
+            return True
+        return cls._status_code(error) in cls.RETRYABLE_STATUS
+
+    @classmethod
+    def retry_after(cls, error: Exception) -> Optional[float]:
+        """从异常中提取服务端建议的等待秒数"""
+        value = getattr(error, "retry_after", None)
+        if value is None:
+            headers = getattr(getattr(error, "response", None), "headers", None) or {}
+            value = headers.get("Retry-After") or headers.get("retry-after")
+        if value is not None:
             try:
-                with open(session_file, 'r', encoding='utf-8') as f:
-                    session = json.load(f)
-                    sessions.append({
-                        "id": session["id"],
-                        "name": session["name"],
-                        "created_at": session["created_at"],
-                        "message_count": len(session["messages"]),
-                        "total_tokens": session.get("total_tokens", 0)
-                    })
-            except Exception:
-                continue
-        
-        return sorted(sessions, key=lambda x: x["created_at"], reverse=True)
-    
-    def search_messages(self, query: str) -> List[Tuple[str, Dict]]:
-        """搜索消息"""
-        results = []
-        for session_file in self.sessions_dir.glob("*.json"):
+                return max(float(value), 0.0)
+            except (TypeError, ValueError):
+                return None
+        match = cls._RETRY_IN.search(str(error)) or cls._RETRY_DELAY.search(str(error))
+        return float(match.group(1)) if match else None
+
+    def backoff(self, attempt: int, error: Exception) -> float:
+        """第 attempt 次重试前的等待时间：retry-after 优先，否则为全抖动指数退避"""
+        hint = self.retry_after(error)
+        if hint is not None:
+            return hint + random.uniform(0, self.base_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def call(self, func: Callable[[], Any], tokens: int = 0, can_retry: Optional[Callable[[], bool]] = None) -> Any:
+        """执行 func，临时性错误按策略重试；tokens 为本次请求的预估 Token 数（用于限流）
+
+        can_retry 返回 False 时不再重试（如流式输出已经开始）。
+        """
+        self._count("calls")
+        attempt = 0
+        while True:
             try:
-                with open(session_file, 'r', encoding='utf-8') as f:
-                    session = json.load(f)
-                    for msg in session["messages"]:
-                        if query.lower() in msg["content"].lower():
-                            results.append((session["id"], msg))
-            except Exception:
+                self.breaker.before_call()
+            except CircuitOpenError:
+                self._count("rejected")
+                tracer.add(circuit_rejected=1)
+                raise
+            waited = self.limiter.acquire(tokens) if self.limiter else 0.0
+            if waited:
+                self._count("throttled")
+                self._count("throttle_seconds", waited)
+                tracer.add(throttle_ms=round(waited * 1000, 1))
+            try:
+                result = func()
+            except RequestCancelled:
+                raise  # 调用方主动中止（取消或对冲落败），不计入失败
+            except Exception as e:
+                if not self.is_retryable(e):
+                    self.breaker.record_success()  # 上游正常响应，只是请求本身有误
+                    self._count("failures")
+                    raise
+                self.breaker.record_failure()
+                if attempt >= self.max_retries or (can_retry and not can_retry()):
+                    self._count("failures")
+                    raise
+                self._count("retries")
+                tracer.add(retries=1)
+                time.sleep(self.backoff(attempt, e))
+                attempt += 1
                 continue
-        return results
+            self.breaker.record_success()
+            return result
+
+
+def _percentile(values: List[float], percentile: float) -> float:
+    """最近秩分位数：第 ceil(n * p / 100) 小的值，values 须已排序且非空"""
+    rank = int(-(-len(values) * percentile // 100))  # 向上取整
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+class HedgePolicy:
+    """对冲请求：请求在 delay() 内没有收到首个片段时，再发一个相同的请求（可发给备用模型），先完成者胜出
+
+    delay 取最近 window 次首片段耗时的 percentile 分位数，样本不足 min_samples 时使用 initial_delay；
+    对冲请求数不超过 max_rate × 请求数，控制额外开销，max_rate <= 0 时不发对冲请求。计数器可通过 stats() 读取，线程安全。
+    """
+
+    def __init__(self, percentile: float = 95, max_rate: float = 0.1, fallback_model: Optional[str] = None,
+                 initial_delay: float = 2.0, min_delay: float = 0.05, window: int = 200, min_samples: int = 20):
+        self.percentile = percentile
+        self.max_rate = max_rate
+        self.fallback_model = fallback_model
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self._samples: deque = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.counters = {"requests": 0, "hedged": 0, "hedge_wins": 0, "rate_limited": 0}
+
+    @classmethod
+    def from_env(cls, enabled: Optional[bool] = None) -> Optional['HedgePolicy']:
+        """按 GEMINI_HEDGE_* 创建；enabled 为 None 时由 GEMINI_HEDGE 决定是否启用"""
+        if enabled is None:
+            enabled = os.getenv('GEMINI_HEDGE', '').lower() in ('1', 'true', 'yes')
+        if not enabled:
+            return None
+        return cls(percentile=float(os.getenv('GEMINI_HEDGE_PERCENTILE', 95)),
+                   max_rate=float(os.getenv('GEMINI_HEDGE_MAX_RATE', 0.1)),
+                   fallback_model=os.getenv('GEMINI_HEDGE_MODEL') or None,
+                   initial_delay=float(os.getenv('GEMINI_HEDGE_DELAY', 2.0)))
+
+    def delay(self) -> float:
+        """发出对冲请求前等待首个片段的秒数"""
+        with self._lock:
+            samples = sorted(self._samples)
+        if len(samples) < self.min_samples:
+            return self.initial_delay
+        return max(_percentile(samples, self.percentile), self.min_delay)
+
+    def observe(self, first_chunk_seconds: float):
+        """记录主请求的首片段耗时（被中止的主请求记录中止时已等待的时间）"""
+        with self._lock:
+            self._samples.append(first_chunk_seconds)
+
+    def begin(self):
+        with self._lock:
+            self.counters["requests"] += 1
+
+    def acquire(self) -> bool:
+        """是否允许再发一个对冲请求"""
+        with self._lock:
+            if self.max_rate > 0 and self.counters["hedged"] < self.max_rate * self.counters["requests"]:
+                self.counters["hedged"] += 1
+                return True
+            self.counters["rate_limited"] += 1
+            return False
+
+    def record_win(self):
+        with self._lock:
+            self.counters["hedge_wins"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.counters)
+        stats["delay_ms"] = round(self.delay() * 1000, 1)
+        return stats
+
+
+class RestResponse:
+    """REST 响应，提供与 SDK 响应相同的 text / usage_metadata 属性"""
+
+    def __init__(self, data: Dict):
+        self.data = data
+        usage = data.get("usageMetadata", {})
+        self.usage_metadata = SimpleNamespace(prompt_token_count=usage.get("promptTokenCount", 0),
+                                              candidates_token_count=usage.get("candidatesTokenCount", 0),
+                                              total_token_count=usage.get("totalTokenCount", 0))
+
+    @property
+    def text(self) -> str:
+        candidates = self.data.get("candidates") or [{}]
+        parts = candidates[0].get("content", {}).get("parts", [])
+        texts = [part["text"] for part in parts if "text" in part]
+        if not texts:
+            raise ValueError("响应中没有文本内容")
+        return "".join(texts)
+
+
+class StreamResponse:
+    """流式响应：迭代得到各个片段；close() 可在其他线程中调用，立即释放连接，读取方随后收到 RequestCancelled"""
+
+    def __init__(self, chunks, release: Callable[[], None] = lambda: None):
+        self._chunks = chunks
+        self._release = release
+        self.closed = False
+
+    def __iter__(self):
+        try:
+            for chunk in self._chunks:
+                if self.closed:
+                    break
+                yield chunk
+        except Exception:
+            if not self.closed:
+                raise  # 关闭连接后读取失败属于预期
+        if self.closed:
+            raise RequestCancelled("流式响应已关闭")
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._release()
+
+
+class RestChatSession:
+    """多轮对话，历史记录格式与 SDK 的 start_chat(history=...) 相同"""
+
+    def __init__(self, model: 'RestModel', history: Optional[List[Dict]] = None):
+        self.model = model
+        self.history: List[Dict] = list(history or [])
+
+    def send_message(self, content: str, stream: bool = False):
+        message = {"role": "user", "parts": [content]}
+        response = self.model.generate_content(self.history + [message], stream=stream)
+        if not stream:
+            self.history += [message, {"role": "model", "parts": [response.text]}]
+            return response
+
+        def chunks():
+            texts = []
+            for chunk in response:
+                try:
+                    texts.append(chunk.text)
+                except ValueError:
+                    pass
+                yield chunk
+            # 与 SDK 一致：流式响应读取完毕后才写入历史
+            self.history += [message, {"role": "model", "parts": ["".join(texts)]}]
+        return chunks()
+
+
+class RestModel:
+    def __init__(self, backend: 'RestBackend', model_name: str):
+        self.backend = backend
+        self.model_name = model_name if model_name.startswith("models/") else f"models/{model_name}"
+
+    @staticmethod
+    def _contents(contents) -> List[Dict]:
+        if isinstance(contents, str):
+            contents = [{"role": "user", "parts": [contents]}]
+        return [{"role": item["role"],
+                 "parts": [{"text": part} if isinstance(part, str) else part for part in item["parts"]]}
+                for item in contents]
+
+    def generate_content(self, contents, stream: bool = False):
+        return self.backend.generate(self.model_name, self._contents(contents), stream)
+
+    def start_chat(self, history: Optional[List[Dict]] = None) -> RestChatSession:
+        return RestChatSession(self, history)
+
+
+class RestBackend:
+    """基于 requests.Session 连接池的 REST 传输，可替代 google.generativeai 作为 GeminiClient 的 backend
+
+    连接在请求之间保持 (keep-alive)，多次请求只需一次 TLS/代理 CONNECT 握手；代理按实例设置，
+    不修改进程环境变量。通过 GEMINI_TRANSPORT=rest 启用。
+    """
+
+    DEFAULT_ENDPOINT = "https://generativelanguage.googleapis.com"
+
+    def __init__(self, proxies: Optional[Dict[str, str]] = None, endpoint: Optional[str] = None,
+                 pool_size: Optional[int] = None, timeout: Optional[float] = None,
+                 connect_timeout: Optional[float] = None, api_version: str = "v1beta"):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.endpoint = (endpoint or os.getenv('GEMINI_ENDPOINT') or self.DEFAULT_ENDPOINT).rstrip('/')
+        self.api_version = api_version
+        pool_size = pool_size or int(os.getenv('GEMINI_POOL_SIZE', 10))
+        self.timeout = (connect_timeout or float(os.getenv('GEMINI_CONNECT_TIMEOUT', 10)),
+                        timeout or float(os.getenv('GEMINI_TIMEOUT', 120)))
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        if proxies:
+            # 显式代理，不再读取环境变量中的代理设置
+            self.session.trust_env = False
+            self.session.proxies = {key.lower().replace("_proxy", ""): value for key, value in proxies.items()}
+
+    def configure(self, api_key: str):
+        self.session.headers["x-goog-api-key"] = api_key
+
+    def close(self):
+        self.session.close()
+
+    def _request(self, method: str, path: str, **kwargs):
+        import requests
+
+        response = self.session.request(method, f"{self.endpoint}/{self.api_version}/{path}",
+                                        timeout=self.timeout, **kwargs)
+        if response.status_code >= 400:
+            try:
+                message = response.json()["error"]["message"]
+            except (ValueError, KeyError, TypeError):
+                message = response.text[:200]
+            response.close()
+            raise requests.HTTPError(f"{response.status_code} {response.reason}: {message}", response=response)
+        return response
+
+    def list_models(self) -> List[SimpleNamespace]:
+        data = self._request("GET", "models", params={"pageSize": 1000}).json()
+        return [SimpleNamespace(name=model["name"], display_name=model.get("displayName", ""),
+                                supported_generation_methods=model.get("supportedGenerationMethods", []))
+                for model in data.get("models", [])]
+
+    def GenerativeModel(self, model_name: str) -> RestModel:
+        return RestModel(self, model_name)
+
+    def embed_content(self, model: str, content, task_type: Optional[str] = None) -> Dict:
+        """与 SDK 的 genai.embed_content 相同：content 为字符串或字符串列表"""
+        texts = [content] if isinstance(content, str) else list(content)
+        model = model if model.startswith("models/") else f"models/{model}"
+        requests_body = [{"model": model, "content": {"parts": [{"text": text}]}} for text in texts]
+        if task_type:
+            for item in requests_body:
+                item["taskType"] = task_type.upper()
+        data = self._request("POST", f"{model}:batchEmbedContents", json={"requests": requests_body}).json()
+        vectors = [item["values"] for item in data.get("embeddings", [])]
+        return {"embedding": vectors[0] if isinstance(content, str) else vectors}
+
+    def generate(self, model_name: str, contents: List[Dict], stream: bool = False):
+        """发送请求；流式请求在返回前即完成连接和状态检查，错误可由重试层处理"""
+        body = {"contents": contents}
+        if not stream:
+            return RestResponse(self._request("POST", f"{model_name}:generateContent", json=body).json())
+
+        response = self._request("POST", f"{model_name}:streamGenerateContent", params={"alt": "sse"},
+                                 json=body, stream=True)
+
+        def events():
+            response.encoding = "utf-8"  # SSE 固定为 UTF-8，服务端通常不声明 charset
+            with response:
+                for line in response.iter_lines(decode_unicode=True):
+                    if line and line.startswith("data:"):
+                        yield RestResponse(json.loads(line[5:]))
+        return StreamResponse(events(), response.close)
+
+
+class FakeAPIError(Exception):
+    """FakeBackend 注入的错误，code/retry_after 与真实 API 错误一致，可被重试层识别"""
+
+    def __init__(self, code: int, message: str, retry_after: Optional[float] = None):
+        super().__init__(f"{code} {message}")
+        self.code = code
+        self.retry_after = retry_after
+
+
+class FakeBackend:
+    """确定性的离线 Gemini 后端，可替代 google.generativeai 作为 GeminiClient 的 backend（用于测试和基准测试）
+
+    回复内容由提示词的哈希决定，同一提示词总是得到相同回复。可配置：
+    latency_ms (非流式响应耗时)、ttft_ms (流式首个片段耗时)、chunk_ms (后续片段间隔)、
+    chunk_tokens (每个片段的 Token 数)、reply_tokens (回复长度)、
+    fail_first (前 N 次请求失败)、error_rate (随机失败比例，按 seed 确定)、error_code (默认 503)、
+    straggler_rate / straggler_ms (按比例随机让请求的首个片段额外延迟，模拟长尾)。
+    通过 GEMINI_TRANSPORT=fake 启用，参数取自 GEMINI_FAKE，如 "latency_ms=200,error_rate=0.1"。
+    """
+
+    WORDS = ("模型", "上下文", "会话", "token", "stream", "缓存", "请求", "latency", "索引", "批量",
+             "response", "重试", "summary", "日志", "proxy", "并发")
+    PARAMS = {"latency_ms": float, "ttft_ms": float, "chunk_ms": float, "chunk_tokens": int, "reply_tokens": int,
+              "fail_first": int, "error_rate": float, "error_code": int, "seed": int,
+              "straggler_rate": float, "straggler_ms": float}
+
+    def __init__(self, latency_ms: float = 0.0, ttft_ms: float = 0.0, chunk_ms: float = 0.0, chunk_tokens: int = 4,
+                 reply_tokens: int = 32, fail_first: int = 0, error_rate: float = 0.0, error_code: int = 503,
+                 seed: int = 0, straggler_rate: float = 0.0, straggler_ms: float = 0.0,
+                 sleep: Callable[[float], None] = time.sleep):
+        self.latency_ms = latency_ms
+        self.ttft_ms = ttft_ms
+        self.chunk_ms = chunk_ms
+        self.chunk_tokens = max(chunk_tokens, 1)
+        self.reply_tokens = reply_tokens
+        self.fail_first = fail_first
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self.straggler_rate = straggler_rate
+        self.straggler_ms = straggler_ms
+        self.sleep = sleep
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.requests: List[Tuple[str, List[Dict], bool]] = []
+        self.failures = 0
+        self.stragglers = 0
+        self.cancelled = 0  # 被调用方关闭的流式响应数
+
+    @classmethod
+    def from_spec(cls, spec: str) -> 'FakeBackend':
+        """从 "key=value,key=value" 形式的配置创建"""
+        params = {}
+        for item in filter(None, (part.strip() for part in spec.split(","))):
+            key, _, value = item.partition("=")
+            if key not in cls.PARAMS:
+                raise ValueError(f"未知的 FakeBackend 参数: {key}")
+            params[key] = cls.PARAMS[key](value)
+        return cls(**params)
+
+    def configure(self, api_key: str):
+        self.api_key = api_key
+
+    def list_models(self) -> List[SimpleNamespace]:
+        return [SimpleNamespace(name=name, display_name=name.split("/")[-1],
+                                supported_generation_methods=["generateContent", "countTokens"])
+                for name in ("models/fake-flash", "models/fake-pro")]
+
+    def GenerativeModel(self, model_name: str) -> RestModel:
+        return RestModel(self, model_name)
+
+    def embed_content(self, model: str, content, task_type: Optional[str] = None) -> Dict:
+        texts = [content] if isinstance(content, str) else list(content)
+        vectors = HashingEmbedder(64).embed(texts).tolist()
+        return {"embedding": vectors[0] if isinstance(content, str) else vectors}
+
+    def reply(self, prompt: str) -> str:
+        """提示词对应的确定性回复"""
+        seed = zlib.crc32(prompt.encode('utf-8'))
+        return " ".join(self.WORDS[(seed + i * 7) % len(self.WORDS)] for i in range(self.reply_tokens))
+
+    def _check_failure(self):
+        with self._lock:
+            fail = self.fail_first > 0 or (self.error_rate and self._random.random() < self.error_rate)
+            if self.fail_first > 0:
+                self.fail_first -= 1
+            if fail:
+                self.failures += 1
+        if fail:
+            raise FakeAPIError(self.error_code, "fake backend injected error", retry_after=0)
+
+    def _straggle_ms(self) -> float:
+        """本次请求首个片段的额外延迟"""
+        with self._lock:
+            if not (self.straggler_rate and self._random.random() < self.straggler_rate):
+                return 0.0
+            self.stragglers += 1
+        return self.straggler_ms
+
+    @staticmethod
+    def _response(text: str, prompt_tokens: int, candidate_tokens: int) -> RestResponse:
+        return RestResponse({
+            "candidates": [{"content": {"role": "model", "parts": [{"text": text}]}}],
+            "usageMetadata": {"promptTokenCount": prompt_tokens, "candidatesTokenCount": candidate_tokens,
+                              "totalTokenCount": prompt_tokens + candidate_tokens},
+        })
+
+    def generate(self, model_name: str, contents: List[Dict], stream: bool = False):
+        with self._lock:
+            self.requests.append((model_name, contents, stream))
+        self._check_failure()
+        straggle_ms = self._straggle_ms()
+        prompt = "".join(part.get("text", "") for part in contents[-1]["parts"])
+        prompt_tokens = sum(estimate_tokens(part.get("text", "")) for item in contents for part in item["parts"])
+        words = self.reply(prompt).split(" ")
+        if not stream:
+            self.sleep((self.latency_ms + straggle_ms) / 1000)
+            return self._response(" ".join(words), prompt_tokens, len(words))
+
+        def chunks():
+            for start in range(0, len(words), self.chunk_tokens):
+                self.sleep((self.ttft_ms + straggle_ms if start == 0 else self.chunk_ms) / 1000)
+                text = " ".join(words[start:start + self.chunk_tokens])
+                last = start + self.chunk_tokens >= len(words)
+                # 与 API 一致：用量只在最后一个片段中给出
+                yield self._response(text if start == 0 else " " + text,
+                                     prompt_tokens if last else 0, len(words) if last else 0)
+
+        def release():
+            with self._lock:
+                self.cancelled += 1
+        return StreamResponse(chunks(), release)
 
 
 class GeminiClient:
     """Gemini API客户端，支持代理访问和上下文管理"""
     
-    def __init__(self, api_key: str, proxy_config: Optional[Dict[str, str]] = None):
+    def __init__(self, api_key: str, proxy_config: Optional[Dict[str, str]] = None, probe: Optional[bool] = None,
+                 context_manager: Optional[ContextManager] = None, backend: Any = None,
+                 cache: Optional[ResponseCache] = None, retry: Optional[RetryPolicy] = None,
+                 hedge: Optional[HedgePolicy] = None, verbose: bool = True):
         self.api_key = api_key
         self.proxy_config = proxy_config or {}
-        self.context_manager = ContextManager()
+        # 作为库使用时 (verbose=False) 不向标准输出打印提示
+        self.verbose = verbose
+        self.context_manager = context_manager or ContextManager()
+        self.cache = cache
+        # 所有 API 调用都经过重试层，默认使用进程内共享的限流器
+        self.retry = retry or RetryPolicy()
+        # 对冲请求默认关闭，可通过 GEMINI_HEDGE=1 或 generate/batch --hedge 开启
+        self.hedge = hedge or HedgePolicy.from_env()
+        # generate(use_context=True) 时上下文部分的 Token 预算
+        self.context_tokens = int(os.getenv('GEMINI_CONTEXT_TOKENS', 2000))
+        # 上次摘要后新增内容超过该 Token 数时自动更新摘要
+        self.summary_tokens = int(os.getenv('GEMINI_SUMMARY_TOKENS', 1000))
+        self._summarizing = False  # 聊天中的自动摘要请求进行中
+        # backend 为 google.generativeai 或与其接口兼容的对象，默认在首次调用时才导入
+        transport = os.getenv('GEMINI_TRANSPORT', 'sdk').lower()
+        if backend is None and transport == 'rest':
+            backend = RestBackend(proxies=self.proxy_config)
+        elif backend is None and transport == 'fake':
+            backend = FakeBackend.from_spec(os.getenv('GEMINI_FAKE', ''))
+        self._backend = backend
+        self._configured = False
+        self.last_timing: Dict[str, float] = {}
+        self.last_usage: Dict[str, Any] = {}
         self.setup_proxy()
-        self.setup_client()
+        # 连接测试需要一次网络往返，默认关闭，可通过 GEMINI_PROBE=1 开启
+        if probe is None:
+            probe = os.getenv('GEMINI_PROBE', '') in ('1', 'true', 'yes')
+        if probe:
+            self.setup_client()
+
+    @property
+    def genai(self):
+        """延迟导入并配置 SDK"""
+        if not self._configured:
+            if self._backend is None:
+                with tracer.span("sdk.import"):
+                    import google.generativeai as genai
+                self._backend = genai
+            with tracer.span("sdk.configure"):
+                self._backend.configure(api_key=self.api_key)  # type: ignore
+            self._configured = True
+        return self._backend
     
+    def fork(self, verbose: Optional[bool] = None) -> 'GeminiClient':
+        """创建共享已配置的 SDK/连接池、限流器和熔断器，但会话状态独立的客户端（供 serve 并发处理请求）"""
+        client = GeminiClient(self.api_key, self.proxy_config, probe=False, backend=self.genai,
+                              retry=RetryPolicy(limiter=self.retry.limiter, breaker=self.retry.breaker),
+                              hedge=self.hedge, verbose=self.verbose if verbose is None else verbose)
+        client._configured = True
+        return client
+
     def setup_proxy(self):
-        """设置代理配置"""
+        """设置代理配置：REST 传输按客户端设置，SDK 只能读取进程环境变量"""
         if self.proxy_config:
-            # 设置环境变量代理
-            for key, value in self.proxy_config.items():
-                os.environ[key] = value
+            if not isinstance(self._backend, (RestBackend, FakeBackend)):
+                for key, value in self.proxy_config.items():
+                    os.environ[key] = value
             
-            print(f"{Fore.YELLOW}✓ 代理已配置: {self.proxy_config}{Style.RESET_ALL}")
+            if self.verbose:
+                print(f"{Fore.YELLOW}✓ 代理已配置: {self.proxy_config}{Style.RESET_ALL}")
     
     def setup_client(self):
-        """初始化Gemini客户端"""
+        """测试与 Gemini API 的连接"""
         try:
-            genai.configure(api_key=self.api_key)  # type: ignore
-            
-            # 测试连接
-            models = list(genai.list_models())  # type: ignore  # type: ignore
+            with tracer.span("client.probe"):
+                models = list(self.genai.list_models())  # type: ignore
             if models:
                 print(f"{Fore.GREEN}✓ Gemini API连接成功{Style.RESET_ALL}")
             else:
@@ -179,55 +2662,281 @@ class GeminiClient:
             print(f"{Fore.RED}✗ Gemini API连接失败: {e}{Style.RESET_ALL}")
             sys.exit(1)
     
+    def _fetch_models(self) -> List[str]:
+        """获取支持 generateContent 的模型名称，失败时抛出异常"""
+        genai = self.genai
+        with tracer.span("model.list"):
+            models = list(genai.list_models())  # type: ignore
+        return [model.name for model in models if 'generateContent' in model.supported_generation_methods]
+
     def list_models(self):
         """列出可用的模型"""
         try:
-            models = list(genai.list_models())  # type: ignore
-            return [model.name for model in models if 'generateContent' in model.supported_generation_methods]
+            return self._fetch_models()
         except Exception as e:
             print(f"{Fore.RED}获取模型列表失败: {e}{Style.RESET_ALL}")
             return []
     
-    def generate_content(self, prompt: str, model_name: str = "gemini-pro", use_context: bool = False) -> str:
-        """生成内容，支持上下文关联"""
-        try:
-            model = genai.GenerativeModel(model_name)  # type: ignore
-            
-            # 如果启用上下文，构建完整的提示词
-            if use_context and self.context_manager.current_session:
-                context_messages = self.context_manager.get_context_messages(5)
-                context_summary = self.context_manager.get_context_summary()
-                
-                # 构建上下文提示
-                context_prompt = ""
-                if context_summary:
-                    context_prompt += f"上下文摘要: {context_summary}\n\n"
-                
-                if context_messages:
-                    context_prompt += "最近的对话\n"
-                    for msg in context_messages[-3:]:  # 只使用最近的3条
-                        role = "用户" if msg["role"] == "user" else "AI"
-                        context_prompt += f"{role}: {msg['content'][:100]}...\n"
-                    context_prompt += "\n"
-                
-                full_prompt = f"{context_prompt}当前问题: {prompt}"
+    @staticmethod
+    def _usage_from(response, model_name: str) -> Dict:
+        """从响应的 usage_metadata 提取 Token 用量"""
+        metadata = getattr(response, "usage_metadata", None)
+        prompt_tokens = getattr(metadata, "prompt_token_count", 0) or 0
+        candidate_tokens = getattr(metadata, "candidates_token_count", 0) or 0
+        total_tokens = getattr(metadata, "total_token_count", 0) or prompt_tokens + candidate_tokens
+        return {"model": model_name, "prompt_tokens": prompt_tokens,
+                "candidate_tokens": candidate_tokens, "total_tokens": total_tokens}
+
+    @classmethod
+    def _collect_response(cls, response, started: float, model_name: str,
+                          on_chunk: Optional[Callable[[str], None]] = None) -> Tuple[str, Dict, Dict]:
+        """读取响应（流式响应逐块回调），返回 (完整文本, 耗时统计, Token 用量)"""
+        if on_chunk is None:
+            text = response.text
+            elapsed = round((time.perf_counter() - started) * 1000, 1)
+            return text, {"first_chunk_ms": elapsed, "total_ms": elapsed}, cls._usage_from(response, model_name)
+
+        parts = []
+        first_chunk_ms = None
+        last_chunk = None
+        for chunk in response:
+            last_chunk = chunk
+            try:
+                text = chunk.text
+            except ValueError:
+                continue  # 没有文本内容的片段（如仅包含结束原因）
+            if first_chunk_ms is None:
+                first_chunk_ms = round((time.perf_counter() - started) * 1000, 1)
+            parts.append(text)
+            on_chunk(text)
+        total_ms = round((time.perf_counter() - started) * 1000, 1)
+        # 流式响应的用量在最后一个片段中，SDK 也会在迭代结束后汇总到响应对象上
+        usage = cls._usage_from(response, model_name)
+        if not usage["total_tokens"] and last_chunk is not None:
+            usage = cls._usage_from(last_chunk, model_name)
+        return "".join(parts), {"first_chunk_ms": first_chunk_ms or total_ms, "total_ms": total_ms}, usage
+
+    def _call_model(self, send: Callable[[Optional[Callable[[str], None]]], Any], model_name: str, prompt: str,
+                    on_chunk: Optional[Callable[[str], None]] = None) -> Tuple[str, Dict, Dict]:
+        """通过重试层发送请求并收集响应，send(callback) 发起一次请求
+
+        流式输出一旦开始就不再重试，避免重复输出；耗时从最后一次尝试开始计算。
+        """
+        emitted = []
+
+        def forward(text):
+            emitted.append(True)
+            on_chunk(text)
+
+        def attempt():
+            started = time.perf_counter()
+            callback = forward if on_chunk else None
+            return self._collect_response(send(callback), started, model_name, callback)
+
+        with tracer.span("model.call", model=model_name, stream=on_chunk is not None) as span:
+            text, timing, usage = self.retry.call(attempt, tokens=estimate_tokens(prompt), can_retry=lambda: not emitted)
+            span.set(first_chunk_ms=timing["first_chunk_ms"], prompt_tokens=usage["prompt_tokens"],
+                     candidate_tokens=usage["candidate_tokens"], total_tokens=usage["total_tokens"])
+        return text, timing, usage
+
+    def _call_hedged(self, prompt: str, model_name: str,
+                     on_chunk: Optional[Callable[[str], None]] = None) -> Tuple[str, Dict, Dict]:
+        """对冲请求：主请求在 hedge.delay() 内没有收到首个片段时再发一个请求，先完成者胜出，另一个被中止
+
+        主请求按时收到首个片段时照常流式输出；发出对冲请求后两边的片段都先缓存，胜出者完成后再输出，
+        不会重复输出。请求在后台线程中进行，落败的请求的流式响应被立即关闭，不阻塞返回。
+        """
+        policy = self.hedge
+        policy.begin()
+        lock = threading.Lock()
+        results: queue.Queue = queue.Queue()
+        responded = threading.Event()
+        state = {"mode": "pending", "primary_done": False, "first_chunk": None}  # mode: pending → live / racing
+        buffers: Dict[str, List[str]] = {}
+        aborts: Dict[str, threading.Event] = {}
+        streams: Dict[str, Any] = {}
+        started = time.perf_counter()
+
+        def release(stream):
+            """落败的请求立即关闭流式响应，归还连接池中的连接（SDK 响应不支持关闭时在下一个片段处中止）"""
+            close = getattr(stream, "close", None)
+            if close is not None:
+                try:
+                    close()
+                except Exception:
+                    pass
+
+        def run(name: str, target_model: str):
+            model = self.genai.GenerativeModel(target_model)  # type: ignore
+            chunks, abort = buffers[name], aborts[name]
+
+            def send(forward):
+                if abort.is_set():
+                    raise RequestCancelled("对冲请求落败，已中止")
+                stream = model.generate_content(prompt, stream=True)
+                with lock:
+                    streams[name] = stream
+                    aborted = abort.is_set()
+                if aborted:
+                    release(stream)  # 建立连接期间已经落败
+                return stream
+
+            def callback(text):
+                if abort.is_set():
+                    raise RequestCancelled("对冲请求落败，已中止")
+                with lock:
+                    if name == "primary":
+                        if state["first_chunk"] is None:
+                            state["first_chunk"] = time.perf_counter() - started
+                            responded.set()
+                        if state["mode"] == "pending":
+                            state["mode"] = "live"
+                    live = name == "primary" and state["mode"] == "live"
+                    if not live:
+                        chunks.append(text)
+                if live and on_chunk:
+                    on_chunk(text)
+
+            try:
+                result = self._call_model(send, target_model, prompt, callback)
+                error = None
+            except Exception as e:
+                result, error = None, e
+            if name == "primary":
+                with lock:
+                    state["primary_done"] = True
+                responded.set()
+            results.put((name, result, error))
+
+        def launch(name: str, target_model: str):
+            buffers[name], aborts[name] = [], threading.Event()
+            threading.Thread(target=run, args=(name, target_model), name=f"gemini-{name}", daemon=True).start()
+
+        with tracer.span("model.hedge", model=model_name) as span:
+            launch("primary", model_name)
+            responded.wait(policy.delay())
+            with lock:
+                hedge = state["mode"] == "pending" and not state["primary_done"] and policy.acquire()
+                if hedge:
+                    state["mode"] = "racing"
+            if hedge:
+                launch("hedge", policy.fallback_model or model_name)
+
+            running, errors = set(buffers), {}
+            winner = None
+            while running:
+                name, result, error = results.get()
+                running.discard(name)
+                if error is None:
+                    winner = name
+                    break
+                errors[name] = error
+            for name in running:
+                with lock:
+                    aborts[name].set()
+                    stream = streams.get(name)
+                if stream is not None:
+                    release(stream)
+            with lock:
+                first_chunk = state["first_chunk"]
+            policy.observe(first_chunk if first_chunk is not None else time.perf_counter() - started)
+            span.set(hedged=hedge, winner=winner)
+            if winner is None:
+                raise errors["primary"]
+
+        text, timing, usage = result
+        if hedge:
+            if winner == "hedge":
+                policy.record_win()
+            if on_chunk:
+                for chunk in buffers[winner]:
+                    on_chunk(chunk)
+            total_ms = round((time.perf_counter() - started) * 1000, 1)
+            timing = {"first_chunk_ms": total_ms, "total_ms": total_ms, "hedged": True, "hedge_winner": winner}
+        return text, timing, usage
+
+    def _record_exchange(self, prompt: str, reply: str, timing: Dict, usage: Dict, sink: Any = None):
+        """保存一问一答：提示词 Token 计入用户消息，其余计入回复，回复附带完整用量和耗时
+
+        sink 为提供 add_message 的对象（默认 ContextManager，聊天中为 PersistenceWorker）。
+        """
+        sink = sink or self.context_manager
+        prompt_tokens = usage["prompt_tokens"]
+        with tracer.span("session.record"):
+            sink.add_message("user", prompt, tokens=prompt_tokens)
+            sink.add_message("assistant", reply, tokens=usage["total_tokens"] - prompt_tokens,
+                             extra={"latency": timing, "usage": usage})
+
+    @staticmethod
+    def _context_prompt(context_prompt: str, prompt: str) -> str:
+        """把上下文和当前问题拼成完整的提示词"""
+        return f"{context_prompt}当前问题: {prompt}"
+
+    def generate(self, prompt: str, model_name: str = "gemini-pro", use_context: bool = False,
+                 on_chunk: Optional[Callable[[str], None]] = None) -> Tuple[str, Dict, Dict]:
+        """生成内容并返回 (完整文本, 耗时统计, Token 用量)，失败时抛出异常
+
+        传入 on_chunk 时以流式方式请求，每收到一个文本片段即回调一次。
+        不修改客户端状态，可在多个线程中并发调用（启用上下文时除外）。
+        设置了 self.cache 时先查响应缓存，命中则不调用 API，也不导入和配置 SDK。
+        """
+        # 如果启用上下文，在 Token 预算内构建完整的提示词
+        if use_context and self.context_manager.current_session:
+            with tracer.span("context.build") as span:
+                context_prompt = self.context_manager.build_context_prompt(self.context_tokens)
+                span.set(tokens=estimate_tokens(context_prompt))
+            full_prompt = self._context_prompt(context_prompt, prompt)
+        else:
+            full_prompt = prompt
+        
+        started = time.perf_counter()
+        cache_key = ResponseCache.make_key(model_name, full_prompt) if self.cache else None
+        with tracer.span("cache.lookup") as span:
+            cached = self.cache.get(cache_key) if cache_key else None
+            span.set(enabled=cache_key is not None, hit=cached is not None)
+        if cached is not None:
+            text = cached
+            if on_chunk:
+                on_chunk(text)
+            elapsed = round((time.perf_counter() - started) * 1000, 1)
+            timing = {"first_chunk_ms": elapsed, "total_ms": elapsed, "cached": True}
+            usage = {"model": model_name, "prompt_tokens": 0, "candidate_tokens": 0, "total_tokens": 0}
+        else:
+            if self.hedge:
+                text, timing, usage = self._call_hedged(full_prompt, model_name, on_chunk)
             else:
-                full_prompt = prompt
-            
-            response = model.generate_content(full_prompt)
-            
-            # 保存到上下文
-            if use_context and self.context_manager.current_session:
-                self.context_manager.add_message("user", prompt)
-                self.context_manager.add_message("assistant", response.text)
-            
-            return response.text
+                model = self.genai.GenerativeModel(model_name)  # type: ignore
+                text, timing, usage = self._call_model(
+                    lambda callback: model.generate_content(full_prompt, stream=callback is not None),
+                    model_name, full_prompt, on_chunk)
+            if cache_key and text:
+                with tracer.span("cache.store"):
+                    self.cache.put(cache_key, model_name, text)
+        
+        # 保存到上下文
+        if use_context and self.context_manager.current_session:
+            self._record_exchange(prompt, text, timing, usage)
+        
+        return text, timing, usage
+
+    def generate_content(self, prompt: str, model_name: str = "gemini-pro", use_context: bool = False,
+                         on_chunk: Optional[Callable[[str], None]] = None) -> str:
+        """生成内容，支持上下文关联
+
+        传入 on_chunk 时以流式方式请求，每收到一个文本片段即回调一次；返回值始终为完整文本。
+        耗时统计和 Token 用量分别保存在 self.last_timing、self.last_usage 中。
+        """
+        try:
+            text, self.last_timing, self.last_usage = self.generate(prompt, model_name, use_context, on_chunk)
+            return text
         except Exception as e:
             print(f"{Fore.RED}生成内容失败: {e}{Style.RESET_ALL}")
             return ""
     
-    def chat_session(self, model_name: str = "gemini-pro", session_id: Optional[str] = None, session_name: Optional[str] = None):
+    def chat_session(self, model_name: str = "gemini-pro", session_id: Optional[str] = None, session_name: Optional[str] = None,
+                     history_tokens: int = 8000, stream: bool = True):
         """启动增强型聊天会话，支持上下文管理"""
+        writer = None
         try:
             # 加载或创建会话
             if session_id:
@@ -240,29 +2949,24 @@ class GeminiClient:
                 session_id = self.context_manager.create_session(session_name)
                 print(f"{Fore.GREEN}创建新会话: {session_id}{Style.RESET_ALL}")
             
-            model = genai.GenerativeModel(model_name)  # type: ignore
-            chat = model.start_chat()
-            
-            # 恢复历史上下文
-            context_messages = self.context_manager.get_context_messages()
-            if context_messages:
-                print(f"{Fore.CYAN}加载了 {len(context_messages)} 条历史消息{Style.RESET_ALL}")
-                # 恢复上下文到聊天会话
-                for msg in context_messages:
-                    if msg["role"] == "user":
-                        try:
-                            chat.send_message(msg["content"])
-                        except Exception:
-                            pass  # 静默失败，不影响新对话
+            # 从本地保存的消息重建历史上下文，不调用 API
+            with tracer.span("context.history") as span:
+                history = self.context_manager.get_chat_history(history_tokens)
+                span.set(entries=len(history))
+            model = self.genai.GenerativeModel(model_name)  # type: ignore
+            chat = model.start_chat(history=history)
+            if history:
+                print(f"{Fore.CYAN}加载了 {len(history)} 条历史消息{Style.RESET_ALL}")
             
             print(f"{Fore.CYAN}=== Gemini 智能聊天会话 ==={Style.RESET_ALL}")
             print(f"{Fore.YELLOW}会话 ID: {session_id}{Style.RESET_ALL}")
             print(f"{Fore.YELLOW}模型: {model_name}{Style.RESET_ALL}")
-            print(f"{Fore.YELLOW}上下文: {'已启用' if context_messages else '新会话'}{Style.RESET_ALL}")
+            print(f"{Fore.YELLOW}上下文: {'已启用' if history else '新会话'}{Style.RESET_ALL}")
             print(f"{Fore.YELLOW}命令: 'quit'=退出, 'clear'=清空, 'save'=保存, 'summary'=摘要, 'history'=历史{Style.RESET_ALL}")
             print("-" * 60)
             
-            message_count = 0
+            # 消息保存和自动摘要在后台线程完成，读取会话数据的命令先等待写入完成
+            writer = PersistenceWorker(self.context_manager)
             
             while True:
                 try:
@@ -276,17 +2980,21 @@ class GeminiClient:
                         os.system('cls' if os.name == 'nt' else 'clear')
                         continue
                     elif user_input.lower() == 'save':
+                        writer.flush()
                         self.context_manager.save_session()
                         print(f"{Fore.GREEN}会话已手动保存{Style.RESET_ALL}")
                         continue
                     elif user_input.lower() == 'summary':
-                        self._generate_context_summary()
+                        writer.flush()
+                        self._generate_context_summary(model_name=model_name)
                         continue
                     elif user_input.lower() == 'history':
+                        writer.flush()
                         self._show_chat_history()
                         continue
                     elif user_input.lower().startswith('/search '):
                         query = user_input[8:]
+                        writer.flush()
                         self._search_history(query)
                         continue
                     
@@ -294,20 +3002,23 @@ class GeminiClient:
                         continue
                     
                     # 发送消息
-                    print(f"{Fore.BLUE}[Gemini]: {Style.RESET_ALL}", end="", flush=True)
-                    response = chat.send_message(user_input)
-                    print(response.text)
-                    
-                    # 保存对话
-                    self.context_manager.add_message("user", user_input)
-                    self.context_manager.add_message("assistant", response.text)
-                    
-                    message_count += 1
+                    with tracer.span("chat.turn"):
+                        print(f"{Fore.BLUE}[Gemini]: {Style.RESET_ALL}", end="", flush=True)
+                        reply, timing, usage = self._call_model(
+                            lambda callback: chat.send_message(user_input, stream=callback is not None),
+                            model_name, user_input, _print_chunk if stream else None)
+                        with tracer.span("output"):
+                            if stream:
+                                print()
+                            else:
+                                print(reply)
+                        self.last_timing, self.last_usage = timing, usage
+
+                        # 保存对话（交给后台线程，这里只计入入队耗时）
+                        self._record_exchange(user_input, reply, timing, usage, sink=writer)
                     
-                    # 每10条消息自动生成摘要
-                    if message_count % 10 == 0:
-                        print(f"{Fore.CYAN}📝 自动生成上下文摘要...{Style.RESET_ALL}")
-                        self._generate_context_summary(auto=True)
+                    # 新增内容达到阈值时在后台增量更新摘要
+                    writer.submit(lambda: self._submit_auto_summary(writer, model_name))
                     
                 except KeyboardInterrupt:
                     print(f"\n{Fore.YELLOW}聊天已中断，会话已保存{Style.RESET_ALL}")
@@ -316,75 +3027,756 @@ class GeminiClient:
                     print(f"{Fore.RED}发送消息失败: {e}{Style.RESET_ALL}")
                     
         except Exception as e:
-            print(f"{Fore.RED}启动聊天会话失败: {e}{Style.RESET_ALL}")
-    
-    def _generate_context_summary(self, auto: bool = False):
-        """生成上下文摘要"""
-        messages = self.context_manager.get_context_messages(20)
-        if len(messages) < 5:
-            if not auto:
-                print(f"{Fore.YELLOW}消息太少，无法生成摘要{Style.RESET_ALL}")
-            return
-        
-        # 构建摘要提示
-        conversation_text = "\n".join([
-            f"用户 if msg['role'] == 'user' else 'AI': {msg['content'][:200]}"
-            for msg in messages[-10:]  # 只用最近的10条
-        ])
-        
-        summary_prompt = f"""请为以下对话生成一个简洁的上下文摘要（100字以内），包括主要话题和关键信息：
+            print(f"{Fore.RED}启动聊天会话失败: {e}{Style.RESET_ALL}")
+        finally:
+            if writer:
+                writer.close()
+            self.context_manager.close()
+    
+    def _summary_request(self, auto: bool = False) -> Optional[Tuple[str, int]]:
+        """构建增量摘要提示：由旧摘要和上次摘要后新增的消息组成，返回 (提示词, 摘要覆盖的消息数)
+
+        自动模式下仅当新增内容达到 summary_tokens 时才返回；每次最多纳入
+        2 倍阈值的新内容，剩余部分留给下一次，单次摘要的开销与会话长度无关。
+        """
+        pending = self.context_manager.get_unsummarized_messages()
+        pending_tokens = sum(estimate_tokens(msg["content"]) for msg in pending)
+        if not pending or (auto and pending_tokens < self.summary_tokens):
+            return None
+
+        # 单条消息和本次新增内容总量都有上限
+        budget = self.summary_tokens * 2
+        per_message = max(self.summary_tokens // 4, 50)
+        lines = []
+        for msg in pending:
+            content = _truncate_to_tokens(msg["content"], min(per_message, budget))
+            budget -= estimate_tokens(content)
+            speaker = "用户" if msg["role"] == "user" else "AI"
+            lines.append(f"{speaker}: {content}")
+            if budget <= 0:
+                break
+        summarized_upto = self.context_manager.current_session.get("summarized_upto", 0) + len(lines)
+
+        previous = self.context_manager.get_context_summary()
+        previous_text = f"已有摘要：\n{previous}\n\n" if previous else ""
+        conversation_text = "\n".join(lines)
+        summary_prompt = f"""请根据已有摘要和新增对话，生成更新后的上下文摘要（200字以内），保留仍然重要的早期信息，包括主要话题和关键信息：
+
+{previous_text}新增对话：
+{conversation_text}
+
+摘要：
+"""
+        return summary_prompt, summarized_upto
+
+    def _generate_context_summary(self, auto: bool = False, model_name: str = "gemini-pro"):
+        """增量更新上下文摘要（同步执行），自动模式下新增内容未达阈值时跳过、失败时不输出"""
+        request = self._summary_request(auto)
+        if request is None:
+            if not auto:
+                print(f"{Fore.YELLOW}没有需要摘要的新消息{Style.RESET_ALL}")
+            return
+        summary_prompt, summarized_upto = request
+
+        try:
+            if not auto:
+                print(f"{Fore.YELLOW}正在生成上下文摘要...{Style.RESET_ALL}")
+            # 直接调用 generate：不改写 last_timing/last_usage，也不打印错误
+            summary = self.generate(summary_prompt, model_name)[0]
+            if summary:
+                self.context_manager.update_context_summary(summary, summarized_upto)
+                if not auto:
+                    print(f"{Fore.CYAN}上下文摘要: {summary}{Style.RESET_ALL}")
+        except Exception as e:
+            if not auto:
+                print(f"{Fore.RED}生成摘要失败: {e}{Style.RESET_ALL}")
+
+    def _submit_auto_summary(self, writer: 'PersistenceWorker', model_name: str):
+        """聊天中的自动摘要：在写入线程中检查阈值并构建提示词，模型调用在独立线程中进行，
+        结果再交回写入线程保存。写入队列和 close() 不等待模型调用；同一时间最多一个摘要请求。
+        须在写入线程中调用（通过 writer.submit）。
+        """
+        if self._summarizing:
+            return
+        request = self._summary_request(auto=True)
+        if request is None:
+            return
+        summary_prompt, summarized_upto = request
+        self._summarizing = True
+
+        def save(summary):
+            self._summarizing = False
+            self.context_manager.update_context_summary(summary, summarized_upto)
+
+        def run():
+            try:
+                summary = self.generate(summary_prompt, model_name)[0]
+            except Exception:
+                summary = ""
+            if summary and writer.submit(partial(save, summary)):
+                return
+            self._summarizing = False
+
+        threading.Thread(target=run, name="gemini-summary", daemon=True).start()
+
+    def _show_chat_history(self):
+        """显示聊天历史"""
+        messages = self.context_manager.get_context_messages(10)
+        if not messages:
+            print(f"{Fore.YELLOW}暂无历史消息{Style.RESET_ALL}")
+            return
+        
+        print(f"{Fore.CYAN}=== 最近 {len(messages)} 条消息 ==={Style.RESET_ALL}")
+        for i, msg in enumerate(messages, 1):
+            role = "👤 你" if msg["role"] == "user" else "🤖 AI"
+            timestamp = msg["timestamp"][:19].replace("T", " ")
+            content = msg["content"][:100] + "..." if len(msg["content"]) > 100 else msg["content"]
+            print(f"{i:2d}. [{timestamp}] {role}: {content}")
+        print("-" * 60)
+    
+    def _search_history(self, query: str):
+        """搜索历史消息"""
+        results = self.context_manager.search_messages(query, limit=10)
+        if not results:
+            print(f"{Fore.YELLOW}未找到包含 '{query}' 的消息{Style.RESET_ALL}")
+            return
+        
+        print(f"{Fore.CYAN}=== 搜索结果: '{query}' ==={Style.RESET_ALL}")
+        for i, (session_id, msg) in enumerate(results, 1):
+            role = "👤" if msg["role"] == "user" else "🤖"
+            timestamp = msg["timestamp"][:19].replace("T", " ")
+            content = msg["content"][:80] + "..." if len(msg["content"]) > 80 else msg["content"]
+            print(f"{i:2d}. [{session_id[:8]}] [{timestamp}] {role}: {content}")
+        print("-" * 60)
+
+
+def _asyncio():
+    """延迟导入 asyncio：仅异步接口需要，不增加命令行的启动开销"""
+    import asyncio
+    return asyncio
+
+
+class AsyncContextManager:
+    """ContextManager 的 asyncio 包装：所有读写在一个专用线程中按顺序执行，不阻塞事件循环
+
+    ContextManager 不是线程安全的，单线程执行器保证同一时刻只有一个操作；
+    ContextManager 本身（打开目录和索引数据库）也在该线程中按需创建。
+    """
+
+    def __init__(self, context_manager: Optional[ContextManager] = None, **kwargs):
+        self._context_manager = context_manager
+        self._kwargs = kwargs
+        from concurrent.futures import ThreadPoolExecutor
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gemini-context")
+
+    def _get(self) -> ContextManager:
+        if self._context_manager is None:
+            self._context_manager = ContextManager(**self._kwargs)
+        return self._context_manager
+
+    async def run(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        """在上下文线程中执行 func(*args, **kwargs)"""
+        loop = _asyncio().get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(func, *args, **kwargs))
+
+    async def _call(self, name: str, *args, **kwargs) -> Any:
+        return await self.run(lambda: getattr(self._get(), name)(*args, **kwargs))
+
+    async def open(self) -> ContextManager:
+        """创建（如尚未创建）并返回底层的 ContextManager"""
+        return await self.run(self._get)
+
+    @property
+    def current_session_id(self) -> Optional[str]:
+        return self._context_manager.current_session_id if self._context_manager else None
+
+    @property
+    def current_session(self) -> Optional[Dict]:
+        return self._context_manager.current_session if self._context_manager else None
+
+    async def create_session(self, name: Optional[str] = None) -> str:
+        return await self._call("create_session", name)
+
+    async def load_session(self, session_id: str) -> bool:
+        return await self._call("load_session", session_id)
+
+    async def save_session(self):
+        await self._call("save_session")
+
+    async def add_message(self, role: str, content: str, tokens: int = 0, extra: Optional[Dict] = None):
+        await self._call("add_message", role, content, tokens, extra)
+
+    async def add_messages(self, entries: List[Tuple[str, str, int, Optional[Dict]]]):
+        await self._call("add_messages", entries)
+
+    async def get_chat_history(self, token_budget: int = 8000) -> List[Dict]:
+        return await self._call("get_chat_history", token_budget)
+
+    async def build_context_prompt(self, token_budget: int = 2000) -> str:
+        return await self._call("build_context_prompt", token_budget)
+
+    async def list_sessions(self, **kwargs) -> List[Dict]:
+        return await self._call("list_sessions", **kwargs)
+
+    async def search_messages(self, query: str, **kwargs) -> List[Tuple[str, Dict]]:
+        return await self._call("search_messages", query, **kwargs)
+
+    async def close(self):
+        """等待已提交的操作完成后关闭存储"""
+        if self._context_manager is not None:
+            await self.run(self._context_manager.close)
+        self._executor.shutdown(wait=False)
+
+
+class AsyncGeminiClient:
+    """GeminiClient 的 asyncio 接口，供在异步服务中作为库使用
+
+    - 导入和配置 SDK、发送请求、读写会话都在线程中完成，不阻塞事件循环；
+    - max_concurrency 限制同时进行的请求数（默认 GEMINI_ASYNC_CONCURRENCY 或 8）；
+    - 请求总以流式方式读取，调用方的任务被取消时，工作线程在下一个片段到达时中止请求并关闭响应；
+    - 出错时抛出异常，不打印、不退出进程。
+
+    用法: async with AsyncGeminiClient(api_key) as client: text, timing, usage = await client.generate("...")
+    """
+
+    def __init__(self, api_key: str, proxy_config: Optional[Dict[str, str]] = None,
+                 max_concurrency: Optional[int] = None, context: Optional[AsyncContextManager] = None,
+                 backend: Any = None, cache: Optional[ResponseCache] = None, retry: Optional[RetryPolicy] = None):
+        self.max_concurrency = max_concurrency or int(os.getenv('GEMINI_ASYNC_CONCURRENCY', 8))
+        self.context = context or AsyncContextManager()
+        self._client_args = {"api_key": api_key, "proxy_config": proxy_config, "backend": backend,
+                             "cache": cache, "retry": retry}
+        self._client: Optional[GeminiClient] = None
+        self._starting: Optional['asyncio.Future'] = None
+        self._semaphore: Optional['asyncio.Semaphore'] = None
+        # 被取消的请求在下一个片段到达前仍占用线程，线程数与并发上限相同即可
+        from concurrent.futures import ThreadPoolExecutor
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="gemini-async")
+
+    async def __aenter__(self) -> 'AsyncGeminiClient':
+        return await self.start()
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def _run(self, func: Callable[[], Any]) -> Any:
+        return await _asyncio().get_running_loop().run_in_executor(self._executor, func)
+
+    async def _create_client(self):
+        context_manager = await self.context.open()
+        client = await self._run(lambda: GeminiClient(context_manager=context_manager, probe=False,
+                                                      verbose=False, **self._client_args))
+        await self._run(lambda: client.genai)
+        self._client = client
+
+    async def start(self, probe: bool = False) -> 'AsyncGeminiClient':
+        """创建底层客户端并配置 SDK；probe=True 时请求一次模型列表验证连接，失败抛出异常
+
+        不显式调用时在第一次请求前自动完成。
+        """
+        asyncio = _asyncio()
+        if self._client is None:
+            if self._starting is None:
+                self._semaphore = asyncio.Semaphore(self.max_concurrency)
+                self._starting = asyncio.ensure_future(self._create_client())
+            try:
+                await asyncio.shield(self._starting)
+            except Exception:
+                self._starting = None  # 下次调用时重试
+                raise
+        if probe:
+            await self.list_models()
+        return self
+
+    async def _started(self) -> GeminiClient:
+        await self.start()
+        return self._client  # type: ignore
+
+    async def _request(self, func: Callable[[Callable[[str], None]], Any],
+                       on_chunk: Optional[Callable[[str], None]] = None) -> Any:
+        """在线程池中执行 func(callback)，callback 把片段转发到事件循环中的 on_chunk
+
+        调用方被取消时通知工作线程，callback 在下一个片段处抛出 RequestCancelled 中止读取。
+        """
+        asyncio = _asyncio()
+        loop = asyncio.get_running_loop()
+        cancelled = threading.Event()
+
+        def callback(text):
+            if cancelled.is_set():
+                raise RequestCancelled("请求已取消")
+            if on_chunk:
+                loop.call_soon_threadsafe(on_chunk, text)
+
+        async with self._semaphore:  # type: ignore
+            try:
+                return await loop.run_in_executor(self._executor, func, callback)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+    @staticmethod
+    async def _stream(start: Callable[[Callable[[str], None]], Any]) -> AsyncIterator[str]:
+        """把 start(on_chunk) 返回的协程转换为片段的异步迭代器；提前结束迭代时取消请求"""
+        asyncio = _asyncio()
+        chunks: asyncio.Queue = asyncio.Queue()
+        task = asyncio.ensure_future(start(chunks.put_nowait))
+        # 片段回调先于任务完成进入事件循环，None 一定排在最后一个片段之后
+        task.add_done_callback(lambda _: chunks.put_nowait(None))
+        try:
+            while True:
+                text = await chunks.get()
+                if text is None:
+                    break
+                yield text
+            await task
+        finally:
+            task.cancel()
+
+    async def list_models(self) -> List[str]:
+        """列出支持 generateContent 的模型，失败时抛出异常"""
+        client = await self._started()
+        async with self._semaphore:  # type: ignore
+            return await self._run(client._fetch_models)
+
+    async def generate(self, prompt: str, model_name: str = "gemini-pro", use_context: bool = False,
+                       on_chunk: Optional[Callable[[str], None]] = None) -> Tuple[str, Dict, Dict]:
+        """生成内容并返回 (完整文本, 耗时统计, Token 用量)，失败时抛出异常
+
+        on_chunk 在事件循环线程中按顺序收到每个文本片段。use_context=True 时在当前会话的
+        上下文中提问，问答写入会话。
+        """
+        client = await self._started()
+        use_context = use_context and self.context.current_session is not None
+        full_prompt = prompt
+        if use_context:
+            context_prompt = await self.context.build_context_prompt(client.context_tokens)
+            full_prompt = client._context_prompt(context_prompt, prompt)
+        text, timing, usage = await self._request(
+            lambda callback: client.generate(full_prompt, model_name, on_chunk=callback), on_chunk)
+        if use_context:
+            await self.context.run(client._record_exchange, prompt, text, timing, usage)
+        return text, timing, usage
+
+    def stream(self, prompt: str, model_name: str = "gemini-pro", use_context: bool = False) -> AsyncIterator[str]:
+        """以异步迭代器逐块返回生成的文本
+
+        提前结束迭代时请用 contextlib.aclosing 或显式 aclose()，以便立即中止请求。
+        """
+        return self._stream(lambda on_chunk: self.generate(prompt, model_name, use_context, on_chunk))
+
+    async def chat(self, session_id: Optional[str] = None, name: Optional[str] = None,
+                   model_name: str = "gemini-pro", history_tokens: int = 8000) -> 'AsyncChatSession':
+        """恢复 session_id 指定的会话（不存在时抛出 ValueError）或创建新会话，返回多轮对话"""
+        client = await self._started()
+        if session_id:
+            if not await self.context.load_session(session_id):
+                raise ValueError(f"会话不存在: {session_id}")
+        else:
+            session_id = await self.context.create_session(name)
+        history = await self.context.get_chat_history(history_tokens)
+        chat = client.genai.GenerativeModel(model_name).start_chat(history=history)  # type: ignore
+        return AsyncChatSession(self, chat, model_name, session_id)
+
+    async def aclose(self):
+        """等待会话写入完成，关闭连接池和线程池"""
+        if self._client is not None and isinstance(self._client._backend, RestBackend):
+            self._client._backend.close()
+        await self.context.close()
+        self._executor.shutdown(wait=False)
+
+
+class AsyncChatSession:
+    """AsyncGeminiClient.chat() 返回的多轮对话：消息按顺序发送，每轮问答写入会话
+
+    同一个 AsyncGeminiClient 的上下文只有一个当前会话，需要同时进行多个对话时请使用多个客户端。
+    """
+
+    def __init__(self, client: AsyncGeminiClient, chat: Any, model_name: str, session_id: str):
+        self.client = client
+        self.chat = chat
+        self.model_name = model_name
+        self.session_id = session_id
+        self._lock = _asyncio().Lock()
+
+    async def send(self, message: str, on_chunk: Optional[Callable[[str], None]] = None) -> Tuple[str, Dict, Dict]:
+        """发送一条消息并返回 (回复, 耗时统计, Token 用量)"""
+        client = await self.client._started()
+        async with self._lock:
+            reply, timing, usage = await self.client._request(
+                lambda callback: client._call_model(
+                    lambda forward: self.chat.send_message(message, stream=forward is not None),
+                    self.model_name, message, callback), on_chunk)
+            await self.client.context.run(client._record_exchange, message, reply, timing, usage)
+        return reply, timing, usage
+
+    def stream(self, message: str) -> AsyncIterator[str]:
+        """发送一条消息，以异步迭代器逐块返回回复"""
+        return self.client._stream(lambda on_chunk: self.send(message, on_chunk))
+
+
+def read_batch_prompts(source: str) -> List[Dict]:
+    """读取批量提示词，支持 JSONL、CSV 和标准输入 (-)
+
+    JSONL 每行为 {"id": ..., "prompt": ..., "model": ...}，id 和 model 可省略；
+    CSV 需包含 prompt 列，可选 id、model 列；标准输入每行为 JSON 对象或纯文本提示词。
+    未指定 id 时使用从 1 开始的行号。格式错误或缺少 prompt 时抛出 click.BadParameter 并指出行号。
+    """
+    items = []
+    if source == "-":
+        lines = sys.stdin
+    elif source.lower().endswith(".csv"):
+        import csv
+        with open(source, 'r', encoding='utf-8-sig', newline='') as f:
+            for n, row in enumerate(csv.DictReader(f), 1):
+                if not row.get("prompt"):
+                    raise click.BadParameter(f"{source}:{n + 1}: 缺少 prompt 列")
+                items.append({"id": row.get("id") or str(n), "prompt": row["prompt"], "model": row.get("model") or None})
+        return items
+    else:
+        lines = open(source, 'r', encoding='utf-8')
+
+    label = "<stdin>" if source == "-" else source
+    try:
+        for n, line in enumerate(lines, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line) if line.startswith("{") else {"prompt": line}
+            except json.JSONDecodeError as e:
+                raise click.BadParameter(f"{label}:{n}: 不是有效的 JSON ({e.msg})")
+            if not isinstance(record, dict) or not record.get("prompt"):
+                raise click.BadParameter(f"{label}:{n}: 缺少 prompt 字段")
+            items.append({"id": str(record.get("id", n)), "prompt": record["prompt"], "model": record.get("model")})
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+    return items
+
+
+def load_completed_ids(output: str) -> set:
+    """读取已有输出文件中成功完成的 ID，用于断点续跑"""
+    completed = set()
+    if not os.path.exists(output):
+        return completed
+    with open(output, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # 中断时可能残留不完整的末行
+            if not isinstance(record, dict) or "id" not in record:
+                continue  # 不是本工具写出的结果行
+            if not record.get("error"):
+                completed.add(str(record["id"]))
+    return completed
+
+
+def run_batch(client: 'GeminiClient', items: List[Dict], output: str, model_name: str,
+              workers: int = 4, ordered: bool = False,
+              on_result: Optional[Callable[[Dict], None]] = None) -> Dict[str, int]:
+    """并发执行批量生成，结果逐条追加写入 JSONL 输出文件
+
+    ordered=False 时按完成顺序写入，否则按输入顺序写入。已在输出文件中成功完成的 ID 会被跳过；
+    失败的条目会带 error 字段写入，下次运行时重试。
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    completed = load_completed_ids(output)
+    pending = [item for item in items if item["id"] not in completed]
+    stats = {"total": len(items), "skipped": len(items) - len(pending), "succeeded": 0, "failed": 0}
+
+    def work(item):
+        model = item.get("model") or model_name
+        try:
+            text, timing, usage = client.generate(item["prompt"], model)
+            return {"id": item["id"], "model": model, "response": text, "latency": timing, "usage": usage}
+        except Exception as e:
+            return {"id": item["id"], "model": model, "response": "", "error": str(e)}
 
-{conversation_text}
+    with open(output, 'a', encoding='utf-8') as out, ThreadPoolExecutor(max_workers=workers) as executor:
+        def emit(result):
+            out.write(json.dumps(result, ensure_ascii=False) + "\n")
+            out.flush()
+            stats["failed" if result.get("error") else "succeeded"] += 1
+            if on_result:
+                on_result(result)
 
-摘要：
-"""
-        
+        futures = [executor.submit(work, item) for item in pending]
         try:
-            if not auto:
-                print(f"{Fore.YELLOW}正在生成上下文摘要...{Style.RESET_ALL}")
-            summary = self.generate_content(summary_prompt, use_context=False)
-            if summary:
-                self.context_manager.update_context_summary(summary)
-                if not auto:
-                    print(f"{Fore.CYAN}上下文摘要: {summary}{Style.RESET_ALL}")
+            if ordered:
+                for future in futures:
+                    emit(future.result())
+            else:
+                for future in as_completed(futures):
+                    emit(future.result())
+        except KeyboardInterrupt:
+            for future in futures:
+                future.cancel()
+            raise
+    return stats
+
+
+def _split_to_tokens(text: str, max_tokens: int) -> List[str]:
+    """将超长文本按估算 Token 数切为多段（二分查找每段的最大长度）"""
+    pieces = []
+    while estimate_tokens(text) > max_tokens:
+        low, high = 1, len(text)
+        while low < high:
+            mid = (low + high + 1) // 2
+            if estimate_tokens(text[:mid]) <= max_tokens:
+                low = mid
+            else:
+                high = mid - 1
+        pieces.append(text[:low])
+        text = text[low:]
+    if text:
+        pieces.append(text)
+    return pieces
+
+
+def iter_file_chunks(patterns: List[str], chunk_tokens: int = 4000, overlap_tokens: int = 200):
+    """逐行读取文件（支持通配符），按 Token 预算切块，相邻块重叠 overlap_tokens
+
+    每块为 {"source", "index", "start_line", "end_line", "text"}；内存占用只与块大小有关。
+    文件路径在调用时立即检查：通配符没有匹配、或非通配符路径不存在/不是文件时抛出 click.BadParameter。
+    """
+    import glob
+    paths = []
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            matched = sorted(glob.glob(pattern, recursive=True))
+            if not matched:
+                raise click.BadParameter(f"没有匹配的文件: {pattern}")
+        elif not os.path.isfile(pattern):
+            raise click.BadParameter(f"文件不存在或不是普通文件: {pattern}")
+        else:
+            matched = [pattern]
+        paths += [path for path in matched if os.path.isfile(path) and path not in paths]
+    return _chunk_files(paths, chunk_tokens, overlap_tokens)
+
+
+def _chunk_files(paths: List[str], chunk_tokens: int, overlap_tokens: int):
+    index = 0
+    for path in paths:
+        lines: List[Tuple[int, str, int]] = []  # (行号, 内容, Token 数)
+        tokens = 0
+
+        def flush():
+            return {"source": path, "index": index, "start_line": lines[0][0], "end_line": lines[-1][0],
+                    "text": "".join(line for _, line, _ in lines)}
+
+        with open(path, 'r', encoding='utf-8', errors='replace') as f:
+            for number, line in enumerate(f, 1):
+                for piece in _split_to_tokens(line, chunk_tokens):
+                    cost = estimate_tokens(piece)
+                    if lines and tokens + cost > chunk_tokens:
+                        yield flush()
+                        index += 1
+                        # 保留末尾不超过 overlap_tokens 的行作为下一块的开头
+                        kept, kept_tokens = [], 0
+                        for entry in reversed(lines):
+                            if kept_tokens + entry[2] > overlap_tokens or kept_tokens + entry[2] + cost > chunk_tokens:
+                                break
+                            kept.insert(0, entry)
+                            kept_tokens += entry[2]
+                        lines, tokens = kept, kept_tokens
+                    lines.append((number, piece, cost))
+                    tokens += cost
+        if lines:
+            yield flush()
+            index += 1
+
+
+def map_reduce_generate(client: 'GeminiClient', question: str, chunks, model_name: str, workers: int = 4,
+                        reduce_tokens: int = 4000,
+                        on_progress: Optional[Callable[[Dict], None]] = None) -> Dict[str, Any]:
+    """对每个块并发提问 (map)，再逐层合并部分回答 (reduce)，返回 {"answer", "chunks", "failed", "cached", "calls"}
+
+    chunks 可以是生成器，同时执行的请求不超过 workers、已读取未完成的块不超过 2*workers。
+    每次调用都经过客户端的响应缓存，失败后重新运行时已完成的块和合并步骤直接命中缓存。
+    有块失败时不执行 reduce，answer 为 None。
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+    partials: Dict[int, str] = {}
+    stats = {"chunks": 0, "failed": [], "cached": 0, "calls": 0}
+
+    def call(prompt):
+        text, timing, _ = client.generate(prompt, model_name)
+        return text, bool(timing.get("cached"))
+
+    def settle(future, stage, item):
+        event = {"stage": stage, "item": item}
+        try:
+            text, cached = future.result()
+            event["cached"] = cached
+            stats["cached" if cached else "calls"] += 1
         except Exception as e:
-            if not auto:
-                print(f"{Fore.RED}生成摘要失败: {e}{Style.RESET_ALL}")
-    
-    def _show_chat_history(self):
-        """显示聊天历史"""
-        messages = self.context_manager.get_context_messages(10)
-        if not messages:
-            print(f"{Fore.YELLOW}暂无历史消息{Style.RESET_ALL}")
-            return
-        
-        print(f"{Fore.CYAN}=== 最近 {len(messages)} 条消息 ==={Style.RESET_ALL}")
-        for i, msg in enumerate(messages, 1):
-            role = "👤 你" if msg["role"] == "user" else "🤖 AI"
-            timestamp = msg["timestamp"][:19].replace("T", " ")
-            content = msg["content"][:100] + "..." if len(msg["content"]) > 100 else msg["content"]
-            print(f"{i:2d}. [{timestamp}] {role}: {content}")
-        print("-" * 60)
-    
-    def _search_history(self, query: str):
-        """搜索历史消息"""
-        results = self.context_manager.search_messages(query)
-        if not results:
-            print(f"{Fore.YELLOW}未找到包含 '{query}' 的消息{Style.RESET_ALL}")
-            return
-        
-        print(f"{Fore.CYAN}=== 搜索结果: '{query}' ==={Style.RESET_ALL}")
-        for i, (session_id, msg) in enumerate(results[:10], 1):
-            role = "👤" if msg["role"] == "user" else "🤖"
-            timestamp = msg["timestamp"][:19].replace("T", " ")
-            content = msg["content"][:80] + "..." if len(msg["content"]) > 80 else msg["content"]
-            print(f"{i:2d}. [{session_id[:8]}] [{timestamp}] {role}: {content}")
-        print("-" * 60)
+            text = None
+            event["error"] = str(e)
+        if on_progress:
+            on_progress(event)
+        return text
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        with tracer.span("mapreduce.map") as span:
+            running = {}
+            for chunk in chunks:
+                stats["chunks"] += 1
+                prompt = (f"{question}\n\n以下是输入的一部分（{chunk['source']} 第 {chunk['start_line']}-"
+                          f"{chunk['end_line']} 行），请只根据这部分内容回答，没有相关内容时回答“无相关内容”：\n\n"
+                          f"{chunk['text']}")
+                running[executor.submit(call, prompt)] = {k: v for k, v in chunk.items() if k != "text"}
+                while len(running) >= workers * 2:
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        item = running.pop(future)
+                        partials[item["index"]] = settle(future, "map", item)
+            for future in as_completed(list(running)):
+                item = running.pop(future)
+                partials[item["index"]] = settle(future, "map", item)
+            span.set(chunks=stats["chunks"])
+
+        stats["failed"] = [index for index, text in partials.items() if text is None]
+        if stats["failed"] or not partials:
+            return dict(stats, answer=None)
+
+        answers = [partials[index] for index in sorted(partials)]
+        level = 0
+        with tracer.span("mapreduce.reduce") as span:
+            if len(answers) == 1:
+                # 只有一块时 map 的回答即为最终回答
+                return dict(stats, answer=answers[0])
+            while len(answers) > 1:
+                level += 1
+                # 按 Token 预算分组，每组至少两份，保证每层数量至少减半
+                groups: List[List[str]] = []
+                for answer in answers:
+                    cost = estimate_tokens(answer)
+                    if groups and (len(groups[-1]) < 2 or sum(map(estimate_tokens, groups[-1])) + cost <= reduce_tokens):
+                        groups[-1].append(answer)
+                    else:
+                        groups.append([answer])
+                if len(groups[-1]) == 1 and len(groups) > 1:
+                    groups[-2] += groups.pop()
+                futures = []
+                for number, group in enumerate(groups):
+                    parts = "\n\n".join(f"[部分 {i}]\n{text}" for i, text in enumerate(group, 1))
+                    prompt = (f"{question}\n\n下面是针对同一输入不同部分的 {len(group)} 份回答（按原文顺序），"
+                              f"请合并为一份完整、不重复的回答，忽略“无相关内容”的部分：\n\n{parts}")
+                    futures.append((executor.submit(call, prompt), {"level": level, "group": number + 1,
+                                                                    "groups": len(groups)}))
+                answers = [settle(future, "reduce", item) for future, item in futures]
+                if any(answer is None for answer in answers):
+                    stats["failed"] = ["reduce"]
+                    return dict(stats, answer=None)
+            span.set(levels=level)
+    return dict(stats, answer=answers[0])
+
+
+def compare_models(client: 'GeminiClient', prompts: List[str], models: List[str], repeat: int = 1,
+                   on_result: Optional[Callable[[Dict], None]] = None) -> Dict[str, Any]:
+    """把相同的提示词并发发给多个模型，返回各模型的首片段耗时、总耗时、输出速度和 Token 数汇总及回答
+
+    不同模型同时请求；同一模型的 len(prompts) * repeat 次请求依次进行，避免自身并发干扰测量。
+    以流式方式请求以测量首个片段耗时；调用方应关闭客户端的响应缓存和对冲请求。
+    每次请求完成后以 {"model", "prompt", "round", ...} 回调 on_result（在工作线程中）。
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    def run(model):
+        runs = []
+        for round_index in range(repeat):
+            for prompt_index, prompt in enumerate(prompts):
+                result: Dict[str, Any] = {"model": model, "prompt": prompt_index, "round": round_index}
+                try:
+                    text, timing, usage = client.generate(prompt, model, on_chunk=lambda chunk: None)
+                    seconds = timing["total_ms"] / 1000
+                    result.update(response=text, first_chunk_ms=timing["first_chunk_ms"],
+                                  total_ms=timing["total_ms"], prompt_tokens=usage["prompt_tokens"],
+                                  candidate_tokens=usage["candidate_tokens"],
+                                  tokens_per_s=round(usage["candidate_tokens"] / seconds, 1) if seconds else 0.0)
+                except Exception as e:
+                    result["error"] = str(e)
+                runs.append(result)
+                if on_result:
+                    on_result(result)
+        return runs
+
+    with ThreadPoolExecutor(max_workers=max(len(models), 1)) as executor:
+        results = dict(zip(models, executor.map(run, models)))
+
+    def summarize(values):
+        if not values:
+            return None
+        values = sorted(values)
+        return {"mean": round(sum(values) / len(values), 1), "p50": _percentile(values, 50),
+                "p95": _percentile(values, 95), "min": values[0], "max": values[-1]}
+
+    summary = []
+    for model, runs in results.items():
+        succeeded = [run for run in runs if "error" not in run]
+        errors = [run["error"] for run in runs if "error" in run]
+        summary.append({
+            "model": model, "requests": len(runs), "errors": len(errors), "last_error": errors[-1] if errors else None,
+            **{metric: summarize([run[metric] for run in succeeded])
+               for metric in ("first_chunk_ms", "total_ms", "tokens_per_s", "prompt_tokens", "candidate_tokens")},
+            # 每个提示词取第一次成功的回答用于并排对比
+            "answers": [next((run["response"] for run in succeeded if run["prompt"] == index), None)
+                        for index in range(len(prompts))],
+            "runs": [{key: value for key, value in run.items() if key not in ("model", "response")} for run in runs],
+        })
+    return {"generated_at": datetime.now().isoformat(timespec="seconds"), "prompts": prompts, "repeat": repeat,
+            "models": summary}
+
+
+def _display_width(text: str) -> int:
+    """终端显示宽度：全角字符占两列"""
+    import unicodedata
+    return sum(2 if unicodedata.east_asian_width(char) in "WF" else 1 for char in text)
+
+
+def _wrap_display(text: str, width: int) -> List[str]:
+    """按显示宽度折行，保留原有换行"""
+    lines = []
+    for paragraph in text.splitlines() or [""]:
+        line, used = "", 0
+        for char in paragraph:
+            char_width = _display_width(char)
+            if used + char_width > width:
+                lines.append(line)
+                line, used = "", 0
+            line += char
+            used += char_width
+        lines.append(line)
+    return lines
+
+
+def _print_side_by_side(columns: List[Tuple[str, str]], max_lines: int):
+    """把多个 (标题, 文本) 并排打印，每列最多 max_lines 行"""
+    total = shutil.get_terminal_size((120, 24)).columns
+    width = max((total - 3 * (len(columns) - 1)) // len(columns), 10)
+    wrapped = []
+    for title, text in columns:
+        lines = _wrap_display(text, width)
+        if len(lines) > max_lines:
+            lines = lines[:max_lines - 1] + ["…"]
+        wrapped.append([_wrap_display(title, width)[0]] + ["─" * width] + lines)
+    for row in range(max(len(lines) for lines in wrapped)):
+        cells = [lines[row] if row < len(lines) else "" for lines in wrapped]
+        print(" │ ".join(cell + " " * (width - _display_width(cell)) for cell in cells).rstrip())
+
+
+def _print_chunk(text: str):
+    """流式输出一个文本片段"""
+    print(text, end="", flush=True)
 
 
 def load_config():
     """加载配置"""
-    load_dotenv()
+    with tracer.span("config.load_dotenv"):
+        from dotenv import load_dotenv
+        load_dotenv()
     
     api_key = os.getenv('GEMINI_API_KEY')
     if not api_key:
@@ -409,18 +3801,47 @@ def load_config():
     return api_key, proxy_config, model
 
 
+# serve 守护进程中预热的客户端，命令通过 make_client 复用它的 SDK/连接池
+_daemon_client: Optional[GeminiClient] = None
+
+
+def make_client(api_key: str, proxy_config: Dict[str, str], verbose: bool = True) -> GeminiClient:
+    """创建命令使用的客户端，在守护进程中复用已预热的客户端；verbose=False 时不打印代理提示"""
+    if _daemon_client is not None:
+        return _daemon_client.fork(verbose)
+    return GeminiClient(api_key, proxy_config, verbose=verbose)
+
+
 @click.group()
 @click.version_option(version='1.0.0')
-def cli():
+@click.option('--timings', is_flag=True, help='命令结束后打印分阶段耗时')
+@click.option('--trace-file', default=None, help='追加写入追踪记录 (.json 为 Chrome trace 格式，否则为 JSONL)')
+@click.pass_context
+def cli(ctx, timings, trace_file):
     """Gemini CLI - 支持代理的Gemini命令行工具"""
-    pass
+    if not (timings or trace_file) or tracer.enabled:
+        return
+    tracer.start()
+    if _daemon_client is None:  # 守护进程中的模块导入早已完成
+        tracer.record("startup.import", _IMPORT_STARTED, time.perf_counter())
+    root = tracer.span(ctx.invoked_subcommand or "cli")
+    root.__enter__()
+
+    def finish():
+        root.__exit__(None, None, None)
+        tracer.enabled = False
+        if timings:
+            tracer.report()
+        if trace_file:
+            tracer.export(trace_file)
+    ctx.call_on_close(finish)
 
 
 @cli.command()
 def models():
     """列出可用的模型"""
     api_key, proxy_config, _ = load_config()
-    client = GeminiClient(api_key, proxy_config)
+    client = make_client(api_key, proxy_config)
     
     model_list = client.list_models()
     if model_list:
@@ -435,13 +3856,35 @@ def models():
 @click.option('--model', '-m', default=None, help='指定模型名称')
 @click.option('--context', '-c', is_flag=True, help='启用上下文关联')
 @click.option('--session', '-s', default=None, help='指定会话 ID')
+@click.option('--no-stream', is_flag=True, help='等待完整响应后再输出')
+@click.option('--no-cache', is_flag=True, help='不使用响应缓存')
+@click.option('--context-tokens', default=None, type=int, help='上下文的 Token 预算（默认 2000）')
+@click.option('--file', '-f', 'files', multiple=True, help='对文件内容提问，可重复或使用通配符 (如 "logs/*.log")')
+@click.option('--chunk-tokens', default=4000, type=int, help='--file 每块的 Token 数')
+@click.option('--overlap', default=200, type=int, help='--file 相邻块重叠的 Token 数')
+@click.option('--workers', '-w', default=4, type=int, help='--file 并发请求数')
+@click.option('--hedge', is_flag=True, help='首个片段迟迟未到时再发一个对冲请求，先完成者胜出')
+@click.option('--hedge-model', default=None, help='对冲请求改发给该模型 (隐含 --hedge)')
 @click.argument('prompt', required=False)
-def generate(model, context, session, prompt):
-    """生成内容，支持上下文关联"""
+def generate(model, context, session, no_stream, no_cache, context_tokens, files, chunk_tokens, overlap, workers,
+             hedge, hedge_model, prompt):
+    """生成内容，支持上下文关联；--file 对大文件分块并发处理后合并回答"""
+    if files and context:
+        raise click.UsageError("--file 不能与 --context 同时使用")
     api_key, proxy_config, default_model = load_config()
-    client = GeminiClient(api_key, proxy_config)
+    client = make_client(api_key, proxy_config)
+    if context_tokens:
+        client.context_tokens = context_tokens
+    if not no_cache:
+        client.cache = ResponseCache(client.context_manager.data_dir / "cache.db")
+    if hedge or hedge_model:
+        _enable_hedge(client, hedge_model)
     
     model_name = model or default_model
+    if files:
+        _generate_from_files(client, prompt or click.prompt('请输入问题'), files, model_name, chunk_tokens,
+                             overlap, workers)
+        return
     
     # 加载指定会话
     if context and session:
@@ -459,14 +3902,33 @@ def generate(model, context, session, prompt):
     if not prompt:
         prompt = click.prompt('请输入提示词')
     
-    context_info = f" (上下文关联: {'\u5df2\u542f\u7528' if context else '\u672a\u542f\u7528'})" if context else ""
+    context_state = '已启用' if context else '未启用'
+    context_info = f" (上下文关联: {context_state})" if context else ""
     print(f"{Fore.YELLOW}正在生成内容{context_info}...{Style.RESET_ALL}")
     
-    response = client.generate_content(prompt, model_name, use_context=context)
+    streamed = []
+
+    def on_chunk(text):
+        if not streamed:
+            print(f"\n{Fore.CYAN}=== Gemini 响应 ==={Style.RESET_ALL}")
+        streamed.append(text)
+        _print_chunk(text)
+
+    response = client.generate_content(prompt, model_name, use_context=context,
+                                       on_chunk=None if no_stream else on_chunk)
     
     if response:
-        print(f"\n{Fore.CYAN}=== Gemini 响应 ==={Style.RESET_ALL}")
-        print(response)
+        with tracer.span("output"):
+            if streamed:
+                print()
+            else:
+                print(f"\n{Fore.CYAN}=== Gemini 响应 ==={Style.RESET_ALL}")
+                print(response)
+        timing = client.last_timing
+        note = " (缓存命中)" if timing.get("cached") else ""
+        if timing.get("hedged"):
+            note = f" (已对冲，{'对冲请求' if timing['hedge_winner'] == 'hedge' else '主请求'}胜出)"
+        print(f"{Fore.YELLOW}首个片段 {timing['first_chunk_ms']:.0f} ms，总耗时 {timing['total_ms']:.0f} ms{note}{Style.RESET_ALL}")
         
         # 显示会话信息
         if context and client.context_manager.current_session:
@@ -476,79 +3938,290 @@ def generate(model, context, session, prompt):
         print(f"{Fore.RED}生成失败{Style.RESET_ALL}")
 
 
+def _unavailable_models(names: List[str], available: List[str]) -> List[str]:
+    """names 中不在 list_models() 结果里的模型（列表为空即获取失败时不检查）"""
+    if not available:
+        return []
+    return [name for name in names if (name if name.startswith("models/") else f"models/{name}") not in available]
+
+
+def _enable_hedge(client: GeminiClient, hedge_model: Optional[str]):
+    """--hedge / --hedge-model：开启对冲请求，备用模型须在 models 列出的模型中"""
+    client.hedge = client.hedge or HedgePolicy.from_env(enabled=True)
+    if hedge_model:
+        if _unavailable_models([hedge_model], client.list_models()):
+            print(f"{Fore.RED}对冲模型 {hedge_model} 不可用，可用模型见 models 命令{Style.RESET_ALL}")
+            sys.exit(1)
+        client.hedge.fallback_model = hedge_model
+
+
+def _generate_from_files(client: GeminiClient, question: str, files: Tuple[str, ...], model_name: str,
+                         chunk_tokens: int, overlap: int, workers: int):
+    """generate --file：分块 map-reduce 并打印进度和最终回答；已完成的块记录在响应缓存中，没有缓存时无法续跑"""
+    chunks = iter_file_chunks(list(files), chunk_tokens, overlap)
+    if client.cache is None:
+        print(f"{Fore.YELLOW}未使用响应缓存 (--no-cache)：已完成的块不会保存，失败后重新运行将重做全部块{Style.RESET_ALL}")
+    print(f"{Fore.YELLOW}正在分块处理 {', '.join(files)} (每块 {chunk_tokens} Token，并发 {workers})...{Style.RESET_ALL}")
+
+    def on_progress(event):
+        item = event["item"]
+        if event["stage"] == "map":
+            label = f"{item['source']}:{item['start_line']}-{item['end_line']}"
+        else:
+            label = f"合并 第 {item['level']} 层 {item['group']}/{item['groups']}"
+        if event.get("error"):
+            print(f"{Fore.RED}  ✗ {label}: {event['error']}{Style.RESET_ALL}")
+        else:
+            print(f"{Fore.GREEN}  ✓ {label}{' (缓存)' if event['cached'] else ''}{Style.RESET_ALL}")
+
+    started = time.perf_counter()
+    result = map_reduce_generate(client, question, chunks, model_name, workers, chunk_tokens, on_progress)
+    elapsed = time.perf_counter() - started
+    if not result["chunks"]:
+        print(f"{Fore.RED}没有可处理的输入：匹配到的文件均为空{Style.RESET_ALL}")
+        sys.exit(1)
+    if result["answer"] is None:
+        failed = "合并步骤" if result["failed"] == ["reduce"] else f"{len(result['failed'])} 个块"
+        hint = "重新运行相同命令只会重做未完成的部分" if client.cache is not None else "不使用缓存时重新运行将重做全部块"
+        print(f"{Fore.RED}{failed}失败，{hint}{Style.RESET_ALL}")
+        sys.exit(1)
+    with tracer.span("output"):
+        print(f"\n{Fore.CYAN}=== Gemini 响应 ==={Style.RESET_ALL}")
+        print(result["answer"])
+    print(f"{Fore.YELLOW}共 {result['chunks']} 块，调用 {result['calls']} 次，缓存命中 {result['cached']} 次，"
+          f"耗时 {elapsed:.1f} 秒{Style.RESET_ALL}")
+
+
+@cli.command()
+@click.option('--model', '-m', default=None, help='默认模型名称（可被输入中的 model 字段覆盖）')
+@click.option('--output', '-o', required=True, help='结果输出文件 (JSONL)，已完成的 ID 重跑时会跳过')
+@click.option('--workers', '-w', default=4, type=int, help='并发请求数')
+@click.option('--rpm', default=0, type=int, help='每分钟最大请求数 (0 表示不限)')
+@click.option('--tpm', default=0, type=int, help='每分钟最大提示词 Token 数 (0 表示不限)')
+@click.option('--ordered', is_flag=True, help='按输入顺序写出结果（默认按完成顺序）')
+@click.option('--no-cache', is_flag=True, help='不使用响应缓存')
+@click.option('--hedge', is_flag=True, help='首个片段迟迟未到时再发一个对冲请求，先完成者胜出')
+@click.option('--hedge-model', default=None, help='对冲请求改发给该模型 (隐含 --hedge)')
+@click.argument('source')
+def batch(model, output, workers, rpm, tpm, ordered, no_cache, hedge, hedge_model, source):
+    """批量生成：从 JSONL/CSV 文件或标准输入 (-) 读取提示词"""
+    api_key, proxy_config, default_model = load_config()
+    client = make_client(api_key, proxy_config)
+    if not no_cache:
+        client.cache = ResponseCache(client.context_manager.data_dir / "cache.db")
+    if hedge or hedge_model:
+        _enable_hedge(client, hedge_model)
+    
+    items = read_batch_prompts(source)
+    if rpm or tpm:
+        # 限流在客户端重试层中进行，缓存命中和重试都按实际请求计算配额
+        client.retry.limiter = RateLimiter(rpm, tpm)
+    done = [0]
+
+    def on_result(result):
+        done[0] += 1
+        if result.get("error"):
+            print(f"{Fore.RED}[{done[0]}] {result['id']} 失败: {result['error']}{Style.RESET_ALL}")
+        else:
+            print(f"{Fore.GREEN}[{done[0]}] {result['id']} ✓ {result['latency']['total_ms']:.0f} ms{Style.RESET_ALL}")
+
+    print(f"{Fore.YELLOW}共 {len(items)} 条提示词，并发数 {workers}{Style.RESET_ALL}")
+    started = time.perf_counter()
+    try:
+        stats = run_batch(client, items, output, model or default_model, workers, ordered, on_result)
+    except KeyboardInterrupt:
+        print(f"\n{Fore.YELLOW}已中断，重新运行相同命令即可继续{Style.RESET_ALL}")
+        return
+    elapsed = time.perf_counter() - started
+
+    print(f"{Fore.CYAN}=== 批量生成完成 ==={Style.RESET_ALL}")
+    print(f"成功: {stats['succeeded']}  失败: {stats['failed']}  跳过(已完成): {stats['skipped']}")
+    finished = stats['succeeded'] + stats['failed']
+    if finished:
+        print(f"耗时: {elapsed:.1f} 秒，吞吐: {finished / elapsed:.2f} 条/秒")
+    retry = client.retry.stats()
+    if retry['retries'] or retry['throttled'] or retry['rejected']:
+        print(f"重试: {retry['retries']}  限流等待: {retry['throttled']} 次 / {retry['throttle_seconds']:.1f} 秒  "
+              f"熔断拒绝: {retry['rejected']}")
+    if client.hedge:
+        hedging = client.hedge.stats()
+        print(f"对冲: {hedging['hedged']}/{hedging['requests']} 次，对冲胜出 {hedging['hedge_wins']} 次，"
+              f"超出比例上限 {hedging['rate_limited']} 次，当前等待阈值 {hedging['delay_ms']:.0f} ms")
+
+
+@cli.command()
+@click.option('--model', '-m', 'model_names', multiple=True, help='参与比较的模型，可重复（默认为 models 列出的全部模型）')
+@click.option('--repeat', '-n', default=1, type=int, help='每个提示词对每个模型请求的次数')
+@click.option('--file', '-f', 'source', default=None, help='从 JSONL/CSV 文件或标准输入 (-) 读取提示词')
+@click.option('--json', 'json_path', default=None, help='把汇总结果写入 JSON 文件 (- 表示只向标准输出打印 JSON)')
+@click.option('--lines', default=20, type=int, help='并排显示回答时每列的最大行数')
+@click.argument('prompts', nargs=-1)
+def compare(model_names, repeat, source, json_path, lines, prompts):
+    """把相同的提示词并发发给多个模型，并排显示回答并比较延迟和吞吐"""
+    # --json - 时标准输出只有 JSON，其余提示都写到标准错误
+    quiet = json_path == "-"
+    log = sys.stderr if quiet else sys.stdout
+    api_key, proxy_config, _ = load_config()
+    client = make_client(api_key, proxy_config, verbose=not quiet)
+    client.hedge = None  # 测量单个请求的真实延迟，不使用缓存和对冲
+
+    prompts = list(prompts) + ([item["prompt"] for item in read_batch_prompts(source)] if source else [])
+    if not prompts:
+        prompts = [click.prompt('请输入提示词', err=quiet)]
+    try:
+        available = client._fetch_models()
+    except Exception as e:
+        print(f"{Fore.RED}获取模型列表失败: {e}{Style.RESET_ALL}", file=log)
+        available = []
+    models = list(model_names) or available
+    missing = _unavailable_models(models, available)
+    if not models or missing:
+        print(f"{Fore.RED}模型不可用: {', '.join(missing) or '无法获取模型列表'}{Style.RESET_ALL}", file=log)
+        sys.exit(1)
+
+    def on_result(result):
+        if quiet:
+            return
+        label = f"{result['model']} #{result['prompt'] + 1}.{result['round'] + 1}"
+        if "error" in result:
+            print(f"{Fore.RED}  ✗ {label}: {result['error']}{Style.RESET_ALL}")
+        else:
+            print(f"{Fore.GREEN}  ✓ {label} {result['total_ms']:.0f} ms{Style.RESET_ALL}")
+
+    if not quiet:
+        print(f"{Fore.YELLOW}比较 {len(models)} 个模型，{len(prompts)} 个提示词，每个重复 {repeat} 次...{Style.RESET_ALL}")
+    summary = compare_models(client, prompts, models, repeat, on_result)
+
+    if quiet:
+        print(json.dumps(summary, ensure_ascii=False, indent=2))
+        return
+    for index, prompt in enumerate(prompts):
+        print(f"\n{Fore.CYAN}=== 提示词 {index + 1}: {_truncate_to_tokens(prompt, 30)} ==={Style.RESET_ALL}")
+        _print_side_by_side([(item["model"], item["answers"][index] or f"(失败: {item['last_error']})")
+                             for item in summary["models"]], lines)
+
+    def pair(stats):
+        return f"{stats['p50']:.0f}/{stats['p95']:.0f}" if stats else "-"
+
+    def row(*cells):
+        widths = (32, 8, 14, 14, 12, 16)
+        return " ".join(cell + " " * (width - _display_width(cell)) if index == 0
+                        else " " * (width - _display_width(cell)) + cell
+                        for index, (cell, width) in enumerate(zip(cells, widths)))
+
+    print(f"\n{Fore.CYAN}=== 延迟与吞吐 (p50/p95，共 {repeat} 轮) ==={Style.RESET_ALL}")
+    print(row("模型", "成功", "首片段(ms)", "总耗时(ms)", "Token/秒", "输入/输出 Token"))
+    for item in summary["models"]:
+        tokens = (f"{item['prompt_tokens']['mean']:.0f}/{item['candidate_tokens']['mean']:.0f}"
+                  if item["candidate_tokens"] else "-")
+        print(row(item["model"], f"{item['requests'] - item['errors']}/{item['requests']}",
+                  pair(item["first_chunk_ms"]), pair(item["total_ms"]), pair(item["tokens_per_s"]), tokens))
+    if json_path:
+        with open(json_path, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        print(f"{Fore.GREEN}汇总已写入 {json_path}{Style.RESET_ALL}")
+
+
 @cli.command()
 @click.option('--model', '-m', default=None, help='指定模型名称')
 @click.option('--session', '-s', default=None, help='加载指定会话 ID')
 @click.option('--name', '-n', default=None, help='新会话名称')
-def chat(model, session, name):
+@click.option('--history-tokens', default=8000, type=int, help='恢复会话时载入历史的 Token 预算')
+@click.option('--no-stream', is_flag=True, help='等待完整响应后再输出')
+def chat(model, session, name, history_tokens, no_stream):
     """启动增强聊天会话，支持上下文管理"""
     api_key, proxy_config, default_model = load_config()
-    client = GeminiClient(api_key, proxy_config)
+    client = make_client(api_key, proxy_config)
     
     model_name = model or default_model
-    client.chat_session(model_name, session_id=session, session_name=name)
+    client.chat_session(model_name, session_id=session, session_name=name, history_tokens=history_tokens,
+                        stream=not no_stream)
 
 
 @cli.command()
-def sessions():
+@click.option('--limit', '-l', default=None, type=int, help='每页显示的会话数')
+@click.option('--page', '-p', default=1, type=int, help='页码（从 1 开始）')
+@click.option('--sort', 'sort_by', default='created_at', type=click.Choice(SessionCatalog.SORT_FIELDS), help='排序字段')
+@click.option('--asc', is_flag=True, help='升序排列')
+def sessions(limit, page, sort_by, asc):
     """列出所有会话"""
-    api_key, proxy_config, _ = load_config()
-    client = GeminiClient(api_key, proxy_config)
+    context_manager = ContextManager()
     
-    session_list = client.context_manager.list_sessions()
+    offset = (max(page, 1) - 1) * limit if limit else 0
+    session_list = context_manager.list_sessions(limit, offset, sort_by, descending=not asc)
     if not session_list:
         print(f"{Fore.YELLOW}暂无保存的会话{Style.RESET_ALL}")
         return
     
     print(f"{Fore.CYAN}=== 会话列表 ==={Style.RESET_ALL}")
-    print(f"{'ID':<10} {'\u540d\u79f0':<20} {'\u521b\u5efa\u65f6\u95f4':<20} {'\u6d88\u606f\u6570':<8} {'Token\u6570':<8}")
+    print(f"{'ID':<10} {'名称':<20} {'创建时间':<20} {'消息数':<8} {'Token数':<8}")
     print("-" * 70)
     
     for session in session_list:
         created = session['created_at'][:19].replace('T', ' ')
         print(f"{session['id']:<10} {session['name']:<20} {created:<20} {session['message_count']:<8} {session['total_tokens']:<8}")
 
+    if limit:
+        total = context_manager.catalog.count()
+        pages = (total + limit - 1) // limit
+        print(f"{Fore.YELLOW}第 {page}/{pages} 页，共 {total} 个会话{Style.RESET_ALL}")
+
 
 @cli.command()
+@click.option('--limit', '-l', default=20, type=int, help='最多显示的结果数')
+@click.option('--session', '-s', default=None, help='只搜索指定会话')
+@click.option('--role', '-r', default=None, type=click.Choice(['user', 'assistant']), help='只搜索指定角色的消息')
+@click.option('--since', default=None, help='起始时间 (如 2024-01-01)')
+@click.option('--until', default=None, help='截止时间 (不含)')
+@click.option('--recent', is_flag=True, help='按时间倒序而非相关度排序')
+@click.option('--semantic', is_flag=True, help='按语义相似度搜索（需要 NumPy）')
+@click.option('--embedder', default=None, type=click.Choice(['local', 'gemini']),
+              help='语义搜索的嵌入方式 (默认 GEMINI_EMBEDDER 或 local)')
 @click.argument('query')
-def search(query):
-    """搜索历史消息"""
-    api_key, proxy_config, _ = load_config()
-    client = GeminiClient(api_key, proxy_config)
+def search(limit, session, role, since, until, recent, semantic, embedder, query):
+    """搜索历史消息（空格分隔为 AND，引号内为短语；--semantic 按语义相似度）"""
+    context_manager = ContextManager()
     
-    results = client.context_manager.search_messages(query)
+    if semantic:
+        try:
+            import numpy  # noqa: F401
+        except ImportError:
+            print(f"{Fore.RED}语义搜索需要 NumPy: pip install numpy{Style.RESET_ALL}")
+            return
+        if (embedder or os.getenv('GEMINI_EMBEDDER', 'local')) == 'gemini':
+            api_key, proxy_config, _ = load_config()
+            context_manager.enable_semantic(GeminiEmbedder(make_client(api_key, proxy_config)))
+        results = context_manager.semantic_search(query, limit, session, role, since, until)
+    else:
+        results = context_manager.search_messages(query, limit, session, role, since, until, ranked=not recent)
     if not results:
         print(f"{Fore.YELLOW}未找到包含 '{query}' 的消息{Style.RESET_ALL}")
         return
     
     print(f"{Fore.CYAN}=== 搜索结果: '{query}' ({len(results)} 条) ==={Style.RESET_ALL}")
-    for i, (session_id, msg) in enumerate(results[:20], 1):
+    for i, (session_id, msg) in enumerate(results, 1):
         role = "👤" if msg["role"] == "user" else "🤖"
         timestamp = msg["timestamp"][:19].replace("T", " ")
         content = msg["content"][:80] + "..." if len(msg["content"]) > 80 else msg["content"]
-        print(f"{i:2d}. [{session_id[:8]}] [{timestamp}] {role}: {content}")
+        score = f" ({msg['score']:.2f})" if "score" in msg else ""
+        print(f"{i:2d}. [{session_id[:8]}] [{timestamp}]{score} {role}: {content}")
 
 
 @cli.command()
 @click.argument('session_id')
 def show(session_id):
     """显示指定会话的详细信息"""
-    api_key, proxy_config, _ = load_config()
-    client = GeminiClient(api_key, proxy_config)
-    
-    if not client.context_manager.load_session(session_id):
-        print(f"{Fore.RED}会话 {session_id} 不存在{Style.RESET_ALL}")
-        return
+    context_manager = ContextManager()
     
-    session = client.context_manager.current_session
+    session = context_manager.peek_session(session_id, limit=10)
     if not session:
-        print(f"{Fore.RED}会话数据无效{Style.RESET_ALL}")
+        print(f"{Fore.RED}会话 {session_id} 不存在{Style.RESET_ALL}")
         return
         
     print(f"{Fore.CYAN}=== 会话详情: {session['name']} ==={Style.RESET_ALL}")
     print(f"ID: {session['id']}")
     print(f"创建时间: {session['created_at'][:19].replace('T', ' ')}")
-    print(f"消息数量: {len(session['messages'])}")
+    print(f"消息数量: {session['message_count']}")
     print(f"Token 统计: {session.get('total_tokens', 0)}")
     
     if session.get('context_summary'):
@@ -557,10 +4230,125 @@ def show(session_id):
     messages = session['messages']
     if messages:
         print(f"\n{Fore.CYAN}=== 最近 10 条消息 ==={Style.RESET_ALL}")
-        for msg in messages[-10:]:
+        for msg in messages:
             role = "👤 你" if msg["role"] == "user" else "🤖 AI"
             timestamp = msg["timestamp"][:19].replace("T", " ")
             content = msg["content"][:150] + "..." if len(msg["content"]) > 150 else msg["content"]
+            print(f"[{timestamp}] {role}: {content}")
+
+
+@cli.command()
+@click.option('--to', 'target', type=click.Choice(ContextManager.STORAGE_BACKENDS), default='sqlite',
+              help='目标存储后端 (另一种后端为来源)')
+def migrate(target):
+    """在存储后端之间迁移会话（默认从 JSON 日志文件迁移到 SQLite）"""
+    source = "journal" if target == "sqlite" else "sqlite"
+    print(f"{Fore.YELLOW}正在从 {source} 迁移会话到 {target}...{Style.RESET_ALL}")
+    migrated, skipped = migrate_sessions(ContextManager(storage=source), ContextManager(storage=target))
+    print(f"{Fore.GREEN}已迁移 {migrated} 个会话，跳过 {skipped} 个（目标中已存在）{Style.RESET_ALL}")
+    print(f"在 .env 中设置 GEMINI_STORAGE={target} 以使用新的存储后端，原有数据保留不变")
+
+
+@cli.command()
+@click.option('--days', '-d', default=None, type=float, help='归档超过多少天没有新消息的会话 (默认 GEMINI_ARCHIVE_DAYS 或 30)')
+def archive(days):
+    """将长期不用的会话压缩归档（仍可列出、查看、搜索，载入时自动解压）"""
+    days = days if days is not None else float(os.getenv('GEMINI_ARCHIVE_DAYS', 30))
+    context_manager = ContextManager()
+    archived = context_manager.archive_sessions(days)
+    context_manager.close()
+    print(f"{Fore.GREEN}已归档 {len(archived)} 个超过 {days:g} 天未使用的会话{Style.RESET_ALL}")
+
+
+def _env_number(name: str, cast: Callable = float):
+    value = os.getenv(name)
+    return cast(value) if value else None
+
+
+@cli.command()
+@click.option('--max-age', default=None, type=float, help='删除超过多少天未使用的会话 (默认 GEMINI_RETENTION_DAYS)')
+@click.option('--max-mb', default=None, type=float, help='会话总大小上限 (MB，默认 GEMINI_RETENTION_MB)')
+@click.option('--max-sessions', default=None, type=int, help='最多保留的会话数 (默认 GEMINI_RETENTION_SESSIONS)')
+@click.option('--dry-run', is_flag=True, help='只列出将被删除的会话')
+def prune(max_age, max_mb, max_sessions, dry_run):
+    """按保留策略删除最久未使用的会话"""
+    max_age = max_age if max_age is not None else _env_number('GEMINI_RETENTION_DAYS')
+    max_mb = max_mb if max_mb is not None else _env_number('GEMINI_RETENTION_MB')
+    max_sessions = max_sessions if max_sessions is not None else _env_number('GEMINI_RETENTION_SESSIONS', int)
+    if max_age is None and max_mb is None and max_sessions is None:
+        print(f"{Fore.YELLOW}未设置保留策略，请指定 --max-age / --max-mb / --max-sessions{Style.RESET_ALL}")
+        return
+
+    context_manager = ContextManager()
+    pruned = context_manager.prune_sessions(max_age, None if max_mb is None else int(max_mb * 1024 * 1024),
+                                            max_sessions, dry_run)
+    context_manager.close()
+    for row in pruned:
+        print(f"{row['id']:<10} {row['name'][:18]:<20} {row['updated_at'][:19].replace('T', ' ')}  "
+              f"{row['size'] / 1024:.1f} KB")
+    freed = sum(row["size"] for row in pruned) / 1024 / 1024
+    action = "将删除" if dry_run else "已删除"
+    print(f"{Fore.GREEN}{action} {len(pruned)} 个会话，共 {freed:.2f} MB{Style.RESET_ALL}")
+
+
+@cli.command()
+@click.option('--top', '-t', default=10, type=int, help='显示 Token 消耗最多的会话数')
+@click.option('--input-price', default=0.0, type=float, help='提示词单价 (每百万 Token)')
+@click.option('--output-price', default=0.0, type=float, help='输出单价 (每百万 Token)')
+def stats(top, input_price, output_price):
+    """Token 用量统计（按会话和模型汇总）"""
+    context_manager = ContextManager()
+    context_manager.refresh_catalog()
+    catalog = context_manager.catalog
+
+    def cost(row):
+        return (row["prompt_tokens"] * input_price + row["candidate_tokens"] * output_price) / 1_000_000
+
+    def throughput(row):
+        seconds = row["response_ms"] / 1000
+        return row["candidate_tokens"] / seconds if seconds else 0
+
+    totals = catalog.usage_totals()
+    print(f"{Fore.CYAN}=== Token 用量统计 ==={Style.RESET_ALL}")
+    print(f"会话数: {totals['sessions']}  消息数: {totals['messages']}  请求数: {totals['request_count']}")
+    print(f"提示词 Token: {totals['prompt_tokens']}  输出 Token: {totals['candidate_tokens']}  总计: {totals['total_tokens']}")
+    print(f"平均输出吞吐: {throughput(totals):.1f} Token/秒")
+    if input_price or output_price:
+        print(f"估算费用: {cost(totals):.4f}")
+
+    models = catalog.usage_by_model()
+    if models:
+        print(f"\n{Fore.CYAN}=== 按模型 ==={Style.RESET_ALL}")
+        print(f"{'模型':<32} {'请求数':<8} {'提示词':<10} {'输出':<10} {'平均耗时(ms)':<14} {'Token/秒':<10}")
+        for row in models:
+            avg_ms = row["response_ms"] / row["request_count"] if row["request_count"] else 0
+            print(f"{row['model']:<32} {row['request_count']:<8} {row['prompt_tokens']:<10} "
+                  f"{row['candidate_tokens']:<10} {avg_ms:<14.0f} {throughput(row):<10.1f}")
+
+    sessions = catalog.top_sessions(top)
+    if sessions:
+        print(f"\n{Fore.CYAN}=== Token 消耗最多的会话 ==={Style.RESET_ALL}")
+        print(f"{'ID':<10} {'名称':<20} {'请求数':<8} {'总 Token':<10} {'费用':<10}")
+        for row in sessions:
+            print(f"{row['id']:<10} {row['name']:<20} {row['request_count']:<8} {row['total_tokens']:<10} {cost(row):<10.4f}")
+
+
+@cli.command()
+@click.option('--clear', is_flag=True, help='清空响应缓存')
+def cache(clear):
+    """查看响应缓存统计"""
+    response_cache = ResponseCache(ContextManager().data_dir / "cache.db")
+    if clear:
+        response_cache.clear()
+        print(f"{Fore.GREEN}响应缓存已清空{Style.RESET_ALL}")
+        return
+
+    stats = response_cache.stats()
+    lookups = stats["hits"] + stats["misses"]
+    hit_rate = stats["hits"] / lookups * 100 if lookups else 0
+    print(f"{Fore.CYAN}=== 响应缓存 ==={Style.RESET_ALL}")
+    print(f"条目数: {stats['entries']}  大小: {stats['bytes'] / 1024:.1f} KB")
+    print(f"命中: {stats['hits']}  未命中: {stats['misses']}  命中率: {hit_rate:.1f}%  淘汰: {stats['evictions']}")
 
 
 @cli.command()
@@ -573,27 +4361,7 @@ def test():
     print(f"代理配置: {proxy_config if proxy_config else '无'}")
     print(f"默认模型: {model}")
     
-    client = GeminiClient(api_key, proxy_config)
-    
-    # 简单测试
-    test_prompt = "Hello, please respond with 'Connection successful!'"
-    print(f"\n{Fore.YELLOW}测试提示词: {test_prompt}{Style.RESET_ALL}")
-    
-    response = client.generate_content(test_prompt, model)
-    if response:
-        print(f"{Fore.GREEN}✓ 测试成功!{Style.RESET_ALL}")
-        print(f"响应: {response}")
-    else:
-        print(f"{Fore.RED}✗ 测试失败{Style.RESET_ALL}")
-    """测试连接"""
-    api_key, proxy_config, model = load_config()
-    
-    print(f"{Fore.CYAN}=== 连接测试 ==={Style.RESET_ALL}")
-    print(f"API Key: {api_key[:10]}...{api_key[-10:] if len(api_key) > 20 else api_key}")
-    print(f"代理配置: {proxy_config if proxy_config else '无'}")
-    print(f"默认模型: {model}")
-    
-    client = GeminiClient(api_key, proxy_config)
+    client = GeminiClient(api_key, proxy_config, probe=True)
     
     # 简单测试
     test_prompt = "Hello, please respond with 'Connection successful!'"
@@ -607,5 +4375,246 @@ def test():
         print(f"{Fore.RED}✗ 测试失败{Style.RESET_ALL}")
 
 
+class _ThreadRoutedStream:
+    """按线程转发输出：守护进程中每个请求线程的 print 写回各自的客户端连接"""
+
+    def __init__(self, default):
+        self._default = default
+        self._local = threading.local()
+
+    def route(self, target):
+        self._local.target = target
+
+    def write(self, text):
+        return (getattr(self._local, "target", None) or self._default).write(text)
+
+    def flush(self):
+        (getattr(self._local, "target", None) or self._default).flush()
+
+    def __getattr__(self, name):
+        return getattr(self._default, name)
+
+
+class _SocketStream:
+    """把写入的文本作为 JSON 行发送给瘦客户端，kind 为 out 或 err"""
+
+    def __init__(self, wfile, kind: str):
+        self.wfile = wfile
+        self.kind = kind
+
+    def write(self, text):
+        if text:
+            self.wfile.write(json.dumps({self.kind: text}, ensure_ascii=False).encode('utf-8') + b"\n")
+        return len(text)
+
+    def flush(self):
+        self.wfile.flush()
+
+    def isatty(self):
+        return False
+
+
+FORWARD_COMMANDS = ("generate", "models", "batch", "compare")
+PROXY_ENV_KEYS = ("HTTP_PROXY", "HTTPS_PROXY", "ALL_PROXY", "NO_PROXY")
+
+
+def _forwarded_env() -> Dict[str, str]:
+    """影响命令行为的环境变量：GEMINI_* 配置和代理设置（不含套接字路径）"""
+    return {key: value for key, value in os.environ.items()
+            if (key.startswith("GEMINI_") and key != "GEMINI_SOCKET") or key.upper() in PROXY_ENV_KEYS}
+
+
+def _daemon_socket_path() -> Path:
+    return Path(os.getenv('GEMINI_SOCKET', os.path.join('.gemini_data', 'gemini.sock')))
+
+
+def _split_global_options(argv: List[str]) -> Tuple[Dict[str, Any], List[str]]:
+    """解析命令前的全局选项 (--timings 等)，返回 (全局选项, 命令及其参数)；无法解析时命令部分为空"""
+    try:
+        options, args, _ = cli.make_parser(click.Context(cli, resilient_parsing=True)).parse_args(list(argv))
+    except click.ClickException:
+        return {}, []
+    return options, args
+
+
+def _forwardable(argv: List[str]) -> bool:
+    """只转发不需要终端交互的命令：generate/compare 需给出提示词，batch/compare 不能从标准输入读取"""
+    _, args = _split_global_options(argv)
+    if not args or args[0] not in FORWARD_COMMANDS:
+        return False
+    command = cli.get_command(None, args[0])
+    try:
+        ctx = command.make_context(args[0], list(args[1:]), resilient_parsing=True)
+    except click.ClickException:
+        return False
+    if args[0] == "generate":
+        return bool(ctx.params.get("prompt"))
+    if args[0] == "batch":
+        return ctx.params.get("source") not in (None, "-")
+    if args[0] == "compare":
+        source = ctx.params.get("source")
+        return source != "-" and bool(source or ctx.params.get("prompts"))
+    return True
+
+
+def forward_to_daemon(argv: List[str]) -> Optional[int]:
+    """serve 守护进程在运行且命令可转发时由其执行，返回退出码；否则返回 None 在本进程执行"""
+    path = _daemon_socket_path()
+    if os.getenv('GEMINI_NO_DAEMON') or not path.exists() or not _forwardable(argv):
+        return None
+    import socket
+    if not hasattr(socket, "AF_UNIX"):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(str(path))
+    except OSError:
+        sock.close()
+        return None  # 守护进程已退出，套接字文件残留
+
+    with sock, sock.makefile('rb') as reader:
+        request = {"argv": argv, "cwd": os.getcwd(), "env": _forwarded_env()}
+        sock.sendall(json.dumps(request, ensure_ascii=False).encode('utf-8') + b"\n")
+        for line in reader:
+            message = json.loads(line)
+            if "out" in message:
+                sys.stdout.write(message["out"])
+                sys.stdout.flush()
+            elif "err" in message:
+                sys.stderr.write(message["err"])
+                sys.stderr.flush()
+            elif "fallback" in message:
+                return None
+            elif "exit" in message:
+                return message["exit"]
+    print(f"{Fore.RED}守护进程连接中断{Style.RESET_ALL}", file=sys.stderr)
+    return 1
+
+
+def _run_forwarded(argv: List[str]) -> int:
+    """在守护进程中执行一条命令，返回退出码"""
+    try:
+        result = cli.main(args=argv, prog_name="gemini_cli.py", standalone_mode=False)
+        return result if isinstance(result, int) else 0
+    except click.exceptions.Abort:
+        print("Aborted!", file=sys.stderr)
+        return 1
+    except click.ClickException as e:
+        e.show(file=sys.stderr)
+        return e.exit_code
+    except SystemExit as e:
+        return e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    except Exception as e:
+        print(f"{Fore.RED}命令执行失败: {e}{Style.RESET_ALL}", file=sys.stderr)
+        return 1
+
+
+@cli.command()
+@click.option('--stop', is_flag=True, help='停止正在运行的守护进程')
+def serve(stop):
+    """启动常驻守护进程，generate/models/batch 命令会自动转发给它执行"""
+    import socket
+    import signal
+    import socketserver
+
+    if not hasattr(socket, "AF_UNIX"):
+        print(f"{Fore.RED}当前平台不支持 Unix 套接字，无法启动守护进程{Style.RESET_ALL}")
+        return
+
+    path = _daemon_socket_path()
+    running = False
+    if path.exists():
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(str(path))
+            running = True
+            if stop:
+                probe.sendall(b'{"stop": true}\n')
+                probe.recv(64)
+        except OSError:
+            path.unlink()  # 上次异常退出残留的套接字文件
+        finally:
+            probe.close()
+    if stop:
+        print(f"{Fore.GREEN}守护进程已停止{Style.RESET_ALL}" if running else f"{Fore.YELLOW}守护进程未运行{Style.RESET_ALL}")
+        return
+    if running:
+        print(f"{Fore.YELLOW}守护进程已在运行: {path}{Style.RESET_ALL}")
+        return
+
+    global _daemon_client
+    # 在创建客户端之前记录：SDK 传输会把代理配置写入进程环境变量
+    daemon_env = _forwarded_env()
+    api_key, proxy_config, _ = load_config()
+    _daemon_client = GeminiClient(api_key, proxy_config)
+    _daemon_client.genai  # 预先导入并配置 SDK
+    # 追踪器在进程内共享：带 --timings/--trace-file 的命令只在没有其他命令执行时转发，执行期间其他命令在本地执行
+    running = {"count": 0, "traced": False}
+    running_lock = threading.Lock()
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            request = json.loads(self.rfile.readline() or b"{}")
+            if request.get("stop"):
+                self.wfile.write(b'{"exit": 0}\n')
+                threading.Thread(target=self.server.shutdown, daemon=True).start()
+                return
+            if os.path.realpath(request.get("cwd", "")) != os.getcwd():
+                # 相对路径和会话目录都以工作目录为准，不同目录的请求在客户端本地执行
+                self.wfile.write(b'{"fallback": true}\n')
+                return
+            if request.get("env") != daemon_env:
+                # 环境变量在进程内共享，无法按请求切换；配置不同的请求在客户端本地执行
+                self.wfile.write(b'{"fallback": true}\n')
+                return
+            traced = any(_split_global_options(request["argv"])[0].values())
+            with running_lock:
+                if running["traced"] or (traced and running["count"]):
+                    self.wfile.write(b'{"fallback": true}\n')
+                    return
+                running["count"] += 1
+                running["traced"] = traced
+            sys.stdout.route(_SocketStream(self.wfile, "out"))
+            sys.stderr.route(_SocketStream(self.wfile, "err"))
+            try:
+                code = _run_forwarded(request["argv"])
+            finally:
+                sys.stdout.route(None)
+                sys.stderr.route(None)
+                with running_lock:
+                    running["count"] -= 1
+                    running["traced"] = False
+            self.wfile.write(json.dumps({"exit": code}).encode('utf-8') + b"\n")
+
+    class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    path.parent.mkdir(exist_ok=True)
+    server = Server(str(path), Handler)
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = _ThreadRoutedStream(stdout), _ThreadRoutedStream(stderr)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    print(f"{Fore.GREEN}守护进程已启动: {path} (Ctrl+C 或 serve --stop 停止){Style.RESET_ALL}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+        server.server_close()
+        path.unlink(missing_ok=True)
+    print(f"{Fore.YELLOW}守护进程已退出{Style.RESET_ALL}")
+
+
+def main():
+    try:
+        code = forward_to_daemon(sys.argv[1:])
+    except KeyboardInterrupt:
+        sys.exit(130)
+    if code is None:
+        cli()
+    sys.exit(code)
+
+
 if __name__ == '__main__':
-    cli()
\ No newline at end of file
+    main()
\ No newline at end of file
@@ -7,9 +7,15 @@
 
 import sys
 import os
+import json
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
 sys.path.insert(0, '.')
 
-from gemini_cli import GeminiClient
+from gemini_cli import FakeBackend, GeminiClient
 
 def test_basic_functionality():
     """测试基本功能"""
@@ -24,12 +30,26 @@ def test_basic_functionality():
     print("✓ 代理配置测试通过")
     print(f"  配置: {proxy_config}")
     
-    # 测试无API Key的情况
+    # SDK 传输会把代理写入进程环境变量，测试结束后恢复，避免影响其他测试
+    saved_env = {key: os.environ.get(key) for key in proxy_config}
     try:
+        # 创建客户端不访问网络，SDK 延迟到首次调用时才导入
         client = GeminiClient("fake_api_key", proxy_config)
-        print("✗ 应该抛出连接错误")
-    except SystemExit:
-        print("✓ 无效API Key正确处理")
+        assert not client._configured
+        print("✓ 客户端延迟初始化")
+
+        # 显式开启连接测试时，无效API Key应退出
+        try:
+            client = GeminiClient("fake_api_key", proxy_config, probe=True)
+            print("✗ 应该抛出连接错误")
+        except SystemExit:
+            print("✓ 无效API Key正确处理")
+    finally:
+        for key, value in saved_env.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
     
     print("\n=== 基本功能测试完成 ===")
     print("工具已准备就绪！")
@@ -41,5 +61,1136 @@ def test_basic_functionality():
     print("3. 开始聊天:")
     print("   python gemini_cli.py chat")
 
+def test_session_journal(tmp_path):
+    """测试会话日志追加、压缩与旧版 JSON 迁移"""
+    from gemini_cli import ContextManager, SessionStore
+
+    with pytest.raises(TypeError):
+        SessionStore()  # 存储后端须实现全部读写方法
+
+    manager = ContextManager(str(tmp_path), fsync_policy="never", compact_threshold=3)
+    session_id = manager.create_session("journal")
+    for i in range(5):
+        manager.add_message("user", f"消息 {i}", tokens=2)
+    for i in range(4):
+        manager.update_context_summary(f"摘要 {i}")
+    manager.close()
+
+    # 3 条 meta 记录触发压缩，最后一条仍以追加形式存在
+    lines = (tmp_path / "sessions" / f"{session_id}.jsonl").read_text(encoding="utf-8").splitlines()
+    assert len(lines) == 1 + 5 + 1
+
+    reloaded = ContextManager(str(tmp_path))
+    assert reloaded.load_session(session_id)
+    assert len(reloaded.current_session["messages"]) == 5
+    assert reloaded.current_session["total_tokens"] == 10
+    assert reloaded.current_session["context_summary"] == "摘要 3"
+
+    legacy = {
+        "id": "legacy01", "name": "旧会话", "created_at": "2024-01-01T00:00:00",
+        "messages": [{"role": "user", "content": "旧消息", "timestamp": "2024-01-01T00:00:00", "tokens": 0}],
+        "context_summary": "", "total_tokens": 0
+    }
+    (tmp_path / "sessions" / "legacy01.json").write_text(json.dumps(legacy), encoding="utf-8")
+    assert {s["id"] for s in reloaded.list_sessions()} == {session_id, "legacy01"}
+    assert reloaded.load_session("legacy01")
+    assert not (tmp_path / "sessions" / "legacy01.json").exists()
+    assert reloaded.current_session["messages"][0]["content"] == "旧消息"
+
+
+def test_session_catalog(tmp_path):
+    """测试会话目录索引的增量更新、分页排序和 mtime 校验"""
+    from gemini_cli import ContextManager
+
+    manager = ContextManager(str(tmp_path), fsync_policy="never")
+    ids = []
+    for i in range(5):
+        ids.append(manager.create_session(f"会话{i}"))
+        for _ in range(i):
+            manager.add_message("user", "你好", tokens=3)
+    manager.close()
+
+    by_count = manager.list_sessions(limit=2, offset=1, sort_by="message_count")
+    assert [s["message_count"] for s in by_count] == [3, 2]
+    assert manager.catalog.count() == 5
+
+    # 其他进程直接改写/删除文件后，目录索引按 mtime/大小重新校验
+    with open(tmp_path / "sessions" / f"{ids[0]}.jsonl", "a", encoding="utf-8") as f:
+        f.write(json.dumps({"type": "message", "role": "user", "content": "外部写入",
+                            "timestamp": "2030-01-01T00:00:00", "tokens": 7}) + "\n")
+    (tmp_path / "sessions" / f"{ids[1]}.jsonl").unlink()
+    sessions = {s["id"]: s for s in manager.list_sessions()}
+    assert ids[1] not in sessions
+    assert sessions[ids[0]]["message_count"] == 1
+    assert sessions[ids[0]]["total_tokens"] == 7
+
+
+def test_message_search(tmp_path):
+    """测试全文索引：中文分词、短语/AND 查询、过滤条件与增量补建"""
+    from gemini_cli import ContextManager
+
+    manager = ContextManager(str(tmp_path), fsync_policy="never")
+    first = manager.create_session("学习")
+    manager.add_message("user", "我想学习机器学习和深度学习")
+    manager.add_message("assistant", "Python is great for machine learning")
+    second = manager.create_session("闲聊")
+    manager.add_message("user", "机器人今天很开心")
+    manager.close()
+
+    def contents(results):
+        return [msg["content"] for _, msg in results]
+
+    assert contents(manager.search_messages("机器学习")) == ["我想学习机器学习和深度学习"]
+    assert len(manager.search_messages("机")) == 2
+    assert len(manager.search_messages("机", limit=1)) == 1
+    assert contents(manager.search_messages("pyth")) == ["Python is great for machine learning"]
+    assert manager.search_messages('"learning machine"') == []
+    assert manager.search_messages("机器 python") == []
+    assert [sid for sid, _ in manager.search_messages("机器", session_id=second)] == [second]
+    assert manager.search_messages("学习", role="assistant") == []
+
+    # 索引丢失后从会话文件补建，会话文件删除后索引随之清理
+    for path in tmp_path.glob("catalog.db*"):
+        path.unlink()
+    rebuilt = ContextManager(str(tmp_path))
+    assert contents(rebuilt.search_messages("深度")) == ["我想学习机器学习和深度学习"]
+    (tmp_path / "sessions" / f"{first}.jsonl").unlink()
+    assert rebuilt.search_messages("深度") == []
+
+
+def test_semantic_search(tmp_path):
+    """语义检索：本地嵌入器、增量嵌入、过滤条件与全文索引重建后的重置"""
+    pytest.importorskip("numpy")
+    from gemini_cli import ContextManager, HashingEmbedder
+
+    embedder = HashingEmbedder()
+    vectors = embedder.embed(["机器学习模型训练", "训练机器学习模型", "今天天气很好"])
+    assert vectors.shape == (3, 256)
+    assert vectors[0] @ vectors[1] > vectors[0] @ vectors[2]
+
+    manager = ContextManager(str(tmp_path), fsync_policy="never")
+    first = manager.create_session("学习")
+    manager.add_message("user", "怎样训练一个机器学习模型")
+    manager.add_message("assistant", "Deploy the server with docker containers")
+    results = manager.semantic_search("机器学习的训练方法", limit=1)
+    assert [msg["content"] for _, msg in results] == ["怎样训练一个机器学习模型"]
+    assert 0 < results[0][1]["score"] <= 1
+
+    # 开启后新消息随 add_message 增量嵌入
+    second = manager.create_session("运维")
+    manager.add_message("user", "docker container deployment tips")
+    assert len(manager.semantic) == 3
+    assert [sid for sid, _ in manager.semantic_search("deploying containers", session_id=second)] == [second]
+    assert all(msg["role"] == "assistant" for _, msg in manager.semantic_search("docker", role="assistant"))
+    manager.close()
+
+    # 新进程载入已保存的矩阵；全文索引重建后语义索引随之重置，结果不重复
+    for path in tmp_path.glob("catalog.db*"):
+        path.unlink()
+    reopened = ContextManager(str(tmp_path))
+    results = reopened.semantic_search("docker deployment", limit=10)
+    assert len(results) == 3 and len({(sid, msg["seq"]) for sid, msg in results}) == 3
+    assert results[0][0] in (first, second)
+
+    # 上次写入中断时多出的半行向量在下次同步前被截掉，向量与消息键保持对齐
+    index = reopened.semantic
+    with open(index.vectors_path, "ab") as f:
+        f.write(b"\0" * 12)
+    reopened.load_session(second)
+    reopened.add_message("user", "kubernetes rollout strategy")
+    assert index.vectors_path.stat().st_size == len(index) * index.meta["dim"] * 4
+    assert reopened.semantic_search("kubernetes rollout", limit=1)[0][1]["content"] == "kubernetes rollout strategy"
+
+
+def test_archive_and_prune(tmp_path):
+    """冷归档：压缩后仍可列出/查看/搜索，载入和追加时解压；保留策略按最近活动时间删除"""
+    from gemini_cli import ContextManager
+
+    def old_session(session_id, days_ago, count=20):
+        timestamp = (datetime.now() - timedelta(days=days_ago)).isoformat()
+        return {"id": session_id, "name": f"会话{session_id}", "created_at": timestamp, "context_summary": "",
+                "messages": [{"role": "user", "content": f"{session_id} 历史消息 {i} " * 5, "timestamp": timestamp,
+                              "tokens": 3} for i in range(count)]}
+
+    for storage in ("journal", "sqlite"):
+        data_dir = tmp_path / storage
+        manager = ContextManager(str(data_dir), fsync_policy="never", storage=storage)
+        for session_id, days_ago in (("aaaa0001", 90), ("aaaa0002", 40), ("aaaa0003", 1)):
+            manager.store.put(old_session(session_id, days_ago))
+        assert manager.search_messages("aaaa0001")
+
+        assert manager.archive_sessions(30) == ["aaaa0001", "aaaa0002"]
+        assert manager.archive_sessions(30) == []
+        if storage == "journal":
+            assert sorted(p.name for p in (data_dir / "sessions").glob("aaaa000*.jsonl*")) == [
+                "aaaa0001.jsonl.gz", "aaaa0002.jsonl.gz", "aaaa0003.jsonl"]
+        assert [row["message_count"] for row in manager.list_sessions(sort_by="updated_at")] == [20, 20, 20]
+        peek = manager.peek_session("aaaa0001", limit=2)
+        assert peek["message_count"] == 20 and len(peek["messages"]) == 2
+        assert manager.index.stale_sessions() == []  # 归档不改变内容，无需重建全文索引
+        assert [sid for sid, _ in manager.search_messages("aaaa0002")] == ["aaaa0002"] * 20
+
+        # 载入时解压回普通存储，继续追加不丢消息
+        assert manager.load_session("aaaa0002")
+        manager.add_message("user", "归档后的新消息")
+        reopened = ContextManager(str(data_dir), storage=storage)
+        assert reopened.load_session("aaaa0002")
+        assert len(reopened.current_session["messages"]) == 21
+        if storage == "journal":
+            assert not (data_dir / "sessions" / "aaaa0002.jsonl.gz").exists()
+
+        # 保留策略：按最近活动时间保留，当前会话不删除
+        assert [row["id"] for row in reopened.prune_sessions(max_sessions=2, dry_run=True)] == ["aaaa0001"]
+        assert [row["id"] for row in reopened.prune_sessions(max_age_days=30)] == ["aaaa0001"]
+        assert reopened.peek_session("aaaa0001") is None
+        assert reopened.search_messages("aaaa0001") == []
+        sizes = reopened.store.sizes()
+        assert [row["id"] for row in reopened.prune_sessions(max_bytes=sizes["aaaa0002"])] == ["aaaa0003"]
+        assert [row["id"] for row in reopened.list_sessions()] == ["aaaa0002"]
+        manager.close()
+        reopened.close()
+
+
+def test_fake_backend(tmp_path):
+    """离线后端：确定性回复、流式片段节奏、Token 用量、错误注入与重试"""
+    from gemini_cli import ContextManager, FakeBackend, GeminiClient, RetryPolicy, RateLimiter
+
+    sleeps = []
+    backend = FakeBackend(ttft_ms=50, chunk_ms=10, reply_tokens=10, chunk_tokens=4, fail_first=2,
+                          sleep=sleeps.append)
+    retry = RetryPolicy(limiter=RateLimiter(), base_delay=0)
+    manager = ContextManager(str(tmp_path), fsync_policy="never")
+    client = GeminiClient("key", context_manager=manager, backend=backend, retry=retry)
+
+    chunks = []
+    text, _, usage = client.generate("你好", "fake-flash", on_chunk=chunks.append)
+    assert text == backend.reply("你好") == "".join(chunks)
+    assert len(chunks) == 3 and sleeps == [0.05, 0.01, 0.01]
+    assert usage["candidate_tokens"] == 10 and usage["prompt_tokens"] > 0
+    assert backend.failures == 2 and retry.stats()["retries"] == 2
+
+    assert client.generate("你好", "fake-flash")[0] == text
+    assert FakeBackend.from_spec("error_rate=1,error_code=400").error_code == 400
+    failing = GeminiClient("key", context_manager=manager, backend=FakeBackend.from_spec("error_rate=1,error_code=400"),
+                           retry=RetryPolicy(limiter=RateLimiter(), base_delay=0))
+    with pytest.raises(Exception, match="400"):
+        failing.generate("你好", "fake-flash")
+    assert len(failing.genai.requests) == 1  # 400 不重试
+
+
+def test_timings_and_trace(tmp_path, monkeypatch, capsys):
+    """--timings / --trace-file：分阶段记录耗时、Token、缓存和重试，未开启时 span 为空操作"""
+    import gemini_cli
+    from gemini_cli import tracer
+
+    assert tracer.span("x") is gemini_cli._NULL_SPAN
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("GEMINI_API_KEY", "key")
+    monkeypatch.setenv("GEMINI_TRANSPORT", "fake")
+    monkeypatch.setenv("GEMINI_FAKE", "fail_first=1,reply_tokens=8")
+    monkeypatch.setenv("GEMINI_RETRY_BASE", "0")
+
+    gemini_cli.cli(["--timings", "--trace-file", "trace.jsonl", "generate", "-c", "你好"], standalone_mode=False)
+    for _ in range(2):
+        gemini_cli.cli(["--trace-file", "trace.json", "generate", "你好"], standalone_mode=False)
+    assert not tracer.enabled
+    assert "model.call" in capsys.readouterr().err
+
+    records = [json.loads(line) for line in (tmp_path / "trace.jsonl").read_text(encoding="utf-8").splitlines()]
+    spans = {record["span"]: record for record in records}
+    assert {"startup.import", "generate", "generate/config.load_dotenv", "generate/context.build",
+            "generate/session.record/session.append", "generate/output"} <= set(spans)
+    call = spans["generate/model.call"]
+    assert call["retries"] == 1 and call["candidate_tokens"] == 8 and call["stream"] is True
+    assert spans["generate/cache.lookup"]["hit"] is False
+
+    # Chrome trace：数组格式，多次运行追加到同一文件；第二次运行命中缓存
+    events = json.loads((tmp_path / "trace.json").read_text(encoding="utf-8").rstrip(",\n") + "]")
+    assert [event["args"]["hit"] for event in events if event["name"] == "cache.lookup"] == [False, True]
+    assert len([event for event in events if event["name"] == "model.call"]) == 1
+
+
+def test_map_reduce_files(tmp_path, capsys):
+    """generate --file：按 Token 切块并重叠、并发 map、分层 reduce，失败后重跑只重做未完成的块"""
+    import click
+    from gemini_cli import (ContextManager, GeminiClient, RateLimiter, ResponseCache, RetryPolicy, estimate_tokens,
+                            iter_file_chunks, map_reduce_generate)
+
+    (tmp_path / "a.log").write_text("".join(f"第 {i} 行日志 request-{i}\n" for i in range(200)), encoding="utf-8")
+    (tmp_path / "b.log").write_text("x" * 5000 + "\n", encoding="utf-8")
+    chunks = list(iter_file_chunks([str(tmp_path / "*.log")], chunk_tokens=200, overlap_tokens=30))
+    a_chunks = [chunk for chunk in chunks if chunk["source"].endswith("a.log")]
+    assert all(estimate_tokens(chunk["text"]) <= 200 for chunk in chunks)
+    assert a_chunks[0]["start_line"] == 1 and a_chunks[-1]["end_line"] == 200
+    assert all(b["start_line"] <= a["end_line"] for a, b in zip(a_chunks, a_chunks[1:]))  # 相邻块重叠
+    assert len([chunk for chunk in chunks if chunk["source"].endswith("b.log")]) == 7  # 超长单行被切开
+    assert [chunk["index"] for chunk in chunks] == list(range(len(chunks)))
+    # 不存在的路径和目录立即报错，而不是被静默忽略
+    for missing in (tmp_path / "missing.log", tmp_path):
+        with pytest.raises(click.BadParameter):
+            iter_file_chunks([str(missing)])
+    (tmp_path / "empty.txt").write_text("", encoding="utf-8")
+    assert list(iter_file_chunks([str(tmp_path / "empty.txt")])) == []
+
+    broken = {"on": True}
+
+    def fail_line_150(model_name, prompt):
+        if broken["on"] and "第 150 行" in prompt:
+            raise ValueError("bad chunk")
+
+    backend = _HookedBackend(fail_line_150, reply_tokens=40)
+    client = GeminiClient("key", context_manager=ContextManager(str(tmp_path / "data")), backend=backend,
+                          retry=RetryPolicy(limiter=RateLimiter()))
+    client.cache = ResponseCache(tmp_path / "cache.db")
+    events = []
+
+    def run():
+        return map_reduce_generate(client, "总结", iter_file_chunks([str(tmp_path / "a.log")], 200, 30), "fake",
+                                   workers=3, reduce_tokens=100, on_progress=events.append)
+
+    first = run()
+    assert first["answer"] is None and len(first["failed"]) >= 1
+    assert not [event for event in events if event["stage"] == "reduce"]
+
+    broken["on"] = False
+    del events[:]
+    second = run()
+    assert second["answer"] and second["failed"] == []
+    # 只重做失败的块，其余命中缓存；reduce 调用随后执行
+    assert len([e for e in events if e["stage"] == "map" and e["cached"]]) == first["chunks"] - len(first["failed"])
+    reduce_calls = [e for e in events if e["stage"] == "reduce" and not e["cached"]]
+    assert second["calls"] == len(first["failed"]) + len(reduce_calls)
+    assert max(e["item"]["level"] for e in events if e["stage"] == "reduce") >= 2  # 分层合并
+    assert run()["calls"] == 0  # 全部命中缓存
+
+    # 不使用缓存时无法续跑，提示而不是静默重做
+    from gemini_cli import _generate_from_files
+    client.cache, broken["on"] = None, True
+    with pytest.raises(SystemExit):
+        _generate_from_files(client, "总结", (str(tmp_path / "a.log"),), "fake", 200, 30, 3)
+    output = capsys.readouterr().out
+    assert "--no-cache" in output and "重做全部块" in output and "只会重做未完成" not in output
+
+
+def test_async_client(tmp_path):
+    """AsyncGeminiClient：并发上限、异步流式、取消时中止请求、异步对话写入会话、出错时抛出异常"""
+    import asyncio
+    from gemini_cli import (AsyncContextManager, AsyncGeminiClient, ContextManager, FakeBackend, RateLimiter,
+                            RetryPolicy)
+
+    active = {"now": 0, "peak": 0}
+
+    def sleep(seconds):
+        active["now"] += 1
+        active["peak"] = max(active["peak"], active["now"])
+        time.sleep(seconds)
+        active["now"] -= 1
+
+    backend = FakeBackend(ttft_ms=20, chunk_ms=20, chunk_tokens=2, reply_tokens=40, sleep=sleep)
+
+    async def main():
+        async with AsyncGeminiClient("key", max_concurrency=2, backend=backend,
+                                     context=AsyncContextManager(data_dir=str(tmp_path), fsync_policy="never"),
+                                     retry=RetryPolicy(base_delay=0, limiter=RateLimiter())) as client:
+            assert await client.list_models() == ["models/fake-flash", "models/fake-pro"]
+            results = await asyncio.gather(*(client.generate(f"问题{i}", "fake") for i in range(5)))
+            assert [text for text, _, _ in results] == [backend.reply(f"问题{i}") for i in range(5)]
+            assert active["peak"] <= 2
+
+            chunks = [chunk async for chunk in client.stream("流式", "fake")]
+            assert len(chunks) == 20 and "".join(chunks) == backend.reply("流式")
+
+            # 取消后工作线程在下一个片段处中止，不再读取剩余片段
+            received = []
+            task = asyncio.ensure_future(client.generate("取消", "fake", on_chunk=received.append))
+            while len(received) < 2:
+                await asyncio.sleep(0.01)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            await asyncio.sleep(0.1)
+            assert len(received) < 20 and active["now"] == 0
+
+            chat = await client.chat(name="异步", model_name="fake")
+            reply, _, usage = await chat.send("第一句")
+            assert reply == backend.reply("第一句") and usage["candidate_tokens"] == 40
+            assert "".join([chunk async for chunk in chat.stream("第二句")]) == backend.reply("第二句")
+            assert len(backend.requests[-1][1]) == 3  # 第二轮带上了第一轮的历史
+            return chat.session_id
+
+    session_id = asyncio.run(main())
+    manager = ContextManager(str(tmp_path))
+    assert manager.load_session(session_id)
+    assert [m["content"] for m in manager.current_session["messages"]][::2] == ["第一句", "第二句"]
+
+    async def failing():
+        client = AsyncGeminiClient("key", backend=FakeBackend(fail_first=1, error_code=400),
+                                   context=AsyncContextManager(data_dir=str(tmp_path)))
+        try:
+            with pytest.raises(ValueError):
+                await client.chat(session_id="missing")
+            with pytest.raises(Exception, match="400"):
+                await client.generate("你好")
+        finally:
+            await client.aclose()
+
+    asyncio.run(failing())
+
+
+def test_hedged_requests(tmp_path):
+    """对冲请求：主请求首个片段超时后发给备用模型，先完成者胜出且不重复输出；按比例限制对冲次数，阈值取分位数"""
+    import random
+    from gemini_cli import (ContextManager, FakeBackend, GeminiClient, HedgePolicy, RateLimiter, ResponseCache,
+                            RetryPolicy)
+
+    # 选一个种子，使第一个请求 (主请求) 成为长尾、第二个请求 (对冲请求) 正常
+    seed = next(s for s in range(100) if (lambda r: r.random() < 0.5 <= r.random())(random.Random(s)))
+    backend = FakeBackend(ttft_ms=5, chunk_tokens=4, reply_tokens=16, straggler_rate=0.5, straggler_ms=1000,
+                          seed=seed)
+    hedge = HedgePolicy(max_rate=1.0, fallback_model="fake-flash", initial_delay=0.05)
+    client = GeminiClient("key", context_manager=ContextManager(str(tmp_path)), backend=backend, hedge=hedge,
+                          retry=RetryPolicy(base_delay=0, limiter=RateLimiter()))
+
+    chunks = []
+    started = time.perf_counter()
+    text, timing, usage = client.generate("长尾", "fake-pro", on_chunk=chunks.append)
+    assert time.perf_counter() - started < 0.5
+    assert text == backend.reply("长尾") and "".join(chunks) == text
+    assert timing["hedged"] and timing["hedge_winner"] == "hedge"
+    assert [request[0] for request in backend.requests] == ["models/fake-pro", "models/fake-flash"]
+    assert usage["model"] == "fake-flash"
+    assert backend.cancelled == 1  # 落败的主请求的流式响应已关闭，不等下一个片段
+
+    # 对冲请求的结果同样写入响应缓存
+    client.cache = ResponseCache(tmp_path / "cache.db")
+    client.generate("缓存", "fake-pro")
+    requests = len(backend.requests)
+    text, timing, _ = client.generate("缓存", "fake-pro")
+    assert timing["cached"] and text == backend.reply("缓存") and len(backend.requests) == requests
+    client.cache = None
+
+    # 主请求按时返回时照常流式输出，不发对冲请求
+    backend.straggler_rate = 0
+    hedge.initial_delay = 1.0
+    chunks = []
+    text, timing, _ = client.generate("正常", "fake-pro", on_chunk=chunks.append)
+    assert "hedged" not in timing and len(chunks) == 4
+    assert hedge.stats()["hedged"] == 1 and hedge.stats()["hedge_wins"] == 1
+
+    # 对冲次数受 max_rate 限制，为 0 时不发对冲请求
+    capped = HedgePolicy(max_rate=0, initial_delay=0.01)
+    client.hedge = capped
+    backend.straggler_rate, backend.straggler_ms = 1.0, 50
+    for i in range(3):
+        assert client.generate(f"限制{i}", "fake-pro")[0] == backend.reply(f"限制{i}")
+    assert capped.stats()["hedged"] == 0 and capped.stats()["rate_limited"] == 3
+
+    policy = HedgePolicy(percentile=90, min_samples=20)
+    for i in range(1, 21):
+        policy.observe(i / 100)
+    assert policy.delay() == 0.18  # 最近秩：20 个样本的 p90 为第 18 小的值
+
+
+def test_compare_models(tmp_path, monkeypatch, capsys):
+    """compare：多个模型并发请求、同一模型依次请求，汇总首片段/总耗时/吞吐/Token，失败单独计数，可输出 JSON"""
+    import gemini_cli
+    from gemini_cli import ContextManager, FakeAPIError, GeminiClient, RateLimiter, RetryPolicy, compare_models
+
+    def per_model(model_name, prompt):
+        if model_name == "models/broken":
+            raise FakeAPIError(400, "bad model")
+        if model_name.endswith("pro"):
+            time.sleep(0.05)  # 较慢的模型
+
+    backend = _HookedBackend(per_model, reply_tokens=20)
+    client = GeminiClient("key", context_manager=ContextManager(str(tmp_path)), backend=backend,
+                          retry=RetryPolicy(base_delay=0, limiter=RateLimiter()))
+    results = []
+    summary = compare_models(client, ["问题一", "问题二"], ["fake-flash", "fake-pro", "broken"], repeat=3,
+                             on_result=results.append)
+    assert results[-1]["model"] == "fake-pro"  # 各模型同时请求，较慢的模型最后完成
+    assert len(results) == 18 and summary["repeat"] == 3
+    flash, pro, broken = summary["models"]
+    assert flash["requests"] == 6 and flash["errors"] == 0 and len(flash["runs"]) == 6
+    assert flash["answers"] == [backend.reply("问题一"), backend.reply("问题二")]
+    assert pro["first_chunk_ms"]["p50"] >= 50 > flash["first_chunk_ms"]["p50"]
+    assert flash["candidate_tokens"]["mean"] == 20 and flash["tokens_per_s"]["min"] > pro["tokens_per_s"]["max"]
+    assert broken["errors"] == 6 and broken["answers"] == [None, None] and "400" in broken["last_error"]
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("GEMINI_API_KEY", "key")
+    monkeypatch.setenv("GEMINI_TRANSPORT", "fake")
+    monkeypatch.setenv("GEMINI_FAKE", "reply_tokens=8")
+    gemini_cli.cli(["compare", "-n", "2", "--json", "summary.json", "你好"], standalone_mode=False)
+    output = capsys.readouterr().out
+    assert "models/fake-flash" in output and "models/fake-pro" in output
+    saved = json.loads((tmp_path / "summary.json").read_text(encoding="utf-8"))
+    assert [item["model"] for item in saved["models"]] == ["models/fake-flash", "models/fake-pro"]
+    assert all(item["requests"] == 2 and item["first_chunk_ms"] for item in saved["models"])
+    # --json - 时标准输出只有 JSON，代理提示等写到标准错误
+    monkeypatch.setenv("HTTPS_PROXY", "http://proxy.invalid:3128")
+    gemini_cli.cli(["compare", "-m", "fake-pro", "--json", "-", "你好"], standalone_mode=False)
+    assert json.loads(capsys.readouterr().out)["models"][0]["model"] == "fake-pro"
+
+
+def test_chat_history_budget(tmp_path):
+    """测试恢复会话时按 Token 预算重建历史，不足时附带摘要"""
+    from gemini_cli import ContextManager, estimate_tokens
+
+    assert estimate_tokens("你好世界") == 4
+    assert estimate_tokens("abcdefgh") == 2
+
+    manager = ContextManager(str(tmp_path), fsync_policy="never")
+    manager.create_session("历史")
+    for i in range(10):
+        manager.add_message("user", f"问题{i}" * 10)
+        manager.add_message("assistant", f"回答{i}" * 10)
+    manager.add_message("user", "没有回复的问题")
+
+    full = manager.get_chat_history(token_budget=10000)
+    assert len(full) == 20
+    assert [turn["role"] for turn in full[:2]] == ["user", "model"]
+    assert full[-1]["parts"] == ["回答9" * 10]
+
+    manager.update_context_summary("之前讨论了问题0到问题7")
+    tail = manager.get_chat_history(token_budget=100)
+    assert "问题0到问题7" in tail[0]["parts"][0]
+    assert tail[1]["role"] == "model"
+    assert tail[2]["role"] == "user"
+    assert tail[-1]["parts"] == ["回答9" * 10]
+    assert len(tail) < len(full)
+
+
+def test_local_command_startup(tmp_path):
+    """sessions/search 等本地命令不导入 SDK、不访问网络（启动耗时见 benchmarks/bench_client.py）"""
+    import subprocess
+
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, GEMINI_API_KEY="", PYTHONPATH=package_dir)
+    env.pop("GEMINI_SOCKET", None)
+    check = (
+        "import socket, sys\n"
+        "def refuse(*args, **kwargs):\n"
+        "    raise AssertionError('本地命令不应访问网络')\n"
+        "socket.socket.connect = socket.create_connection = refuse\n"
+        "import gemini_cli\n"
+        "for command in (['sessions'], ['search', '机器学习']):\n"
+        "    gemini_cli.cli(command, standalone_mode=False)\n"
+        "assert 'google.generativeai' not in sys.modules\n"
+    )
+    subprocess.run([sys.executable, "-c", check], cwd=tmp_path, env=env, check=True, capture_output=True)
+
+
+class _Chunk:
+    def __init__(self, text):
+        self.text = text
+
+
+class _StubModel:
+    def __init__(self, name):
+        self.name = name
+
+    def generate_content(self, prompt, stream=False):
+        chunks = [_Chunk("你好"), _Chunk("，"), _Chunk("世界")]
+        return iter(chunks) if stream else _Chunk("你好，世界")
+
+
+class _StubBackend:
+    """只实现 GeminiClient 用到的最小 genai 接口"""
+
+    def configure(self, api_key):
+        self.api_key = api_key
+
+    def GenerativeModel(self, name):
+        return _StubModel(name)
+
+
+class _HookedBackend(FakeBackend):
+    """每次请求前先调用 hook(模型名, 提示词) 的 FakeBackend，hook 可抛出异常模拟失败或等待模拟慢模型"""
+
+    def __init__(self, hook, **params):
+        super().__init__(**params)
+        self.hook = hook
+
+    def generate(self, model_name, contents, stream=False):
+        self.hook(model_name, contents[-1]["parts"][0]["text"])
+        return super().generate(model_name, contents, stream)
+
+
+def test_generate_streaming(tmp_path):
+    """测试流式生成：逐块回调、只保存一次完整文本并记录耗时"""
+    from gemini_cli import ContextManager, GeminiClient
+
+    manager = ContextManager(str(tmp_path), fsync_policy="never")
+    client = GeminiClient("key", context_manager=manager, backend=_StubBackend())
+    manager.create_session("stream")
+
+    chunks = []
+    text = client.generate_content("问候", use_context=True, on_chunk=chunks.append)
+    assert text == "你好，世界"
+    assert chunks == ["你好", "，", "世界"]
+    assert client.last_timing["first_chunk_ms"] <= client.last_timing["total_ms"]
+
+    messages = manager.current_session["messages"]
+    assert [m["content"] for m in messages] == ["问候", "你好，世界"]
+    assert "latency" in messages[1]
+
+    assert client.generate_content("问候") == "你好，世界"
+
+
+def test_batch_resume(tmp_path):
+    """测试批量生成：并发执行、按输入顺序输出、失败条目在重跑时续做"""
+    import click
+    from gemini_cli import GeminiClient, ContextManager, RateLimiter, read_batch_prompts, run_batch
+
+    class FlakyModel(_StubModel):
+        failures = {"3"}
+
+        def generate_content(self, prompt, stream=False):
+            if prompt in self.failures:
+                raise RuntimeError("503 unavailable")
+            return _Chunk(f"答:{prompt}")
+
+    class FlakyBackend(_StubBackend):
+        def GenerativeModel(self, name):
+            return FlakyModel(name)
+
+    source = tmp_path / "prompts.jsonl"
+    source.write_text("\n".join(json.dumps({"id": str(i), "prompt": str(i)}) for i in range(1, 6)), encoding="utf-8")
+    output = tmp_path / "out.jsonl"
+    items = read_batch_prompts(str(source))
+    client = GeminiClient("key", context_manager=ContextManager(str(tmp_path / "data")), backend=FlakyBackend())
+
+    # 格式错误的行报告文件名和行号
+    bad = tmp_path / "bad.jsonl"
+    for content, line in (('{"prompt": "a"}\n{"prompt": \n', 2), ('{"prompt": "a"}\n\n{"id": "x"}\n', 3)):
+        bad.write_text(content, encoding="utf-8")
+        with pytest.raises(click.BadParameter, match=f"bad.jsonl:{line}:"):
+            read_batch_prompts(str(bad))
+
+    stats = run_batch(client, items, str(output), "gemini-pro", workers=3, ordered=True)
+    assert stats == {"total": 5, "skipped": 0, "succeeded": 4, "failed": 1}
+    records = [json.loads(line) for line in output.read_text(encoding="utf-8").splitlines()]
+    assert [r["id"] for r in records] == ["1", "2", "3", "4", "5"]
+    assert records[2]["error"]
+
+    FlakyModel.failures = set()
+    # 输出文件中混入的非结果行（无 id 或不是对象）被忽略，不影响续跑
+    with open(output, "a", encoding="utf-8") as f:
+        f.write('{"note": "manual"}\n"text"\n[1, 2]\n')
+    stats = run_batch(client, items, str(output), "gemini-pro", workers=3)
+    assert stats == {"total": 5, "skipped": 4, "succeeded": 1, "failed": 0}
+
+    limiter = RateLimiter(tokens_per_minute=6000)
+    assert limiter.acquire(6000) == 0
+    assert limiter.acquire(10) > 0.05
+
+
+def test_response_cache(tmp_path):
+    """测试响应缓存：命中后不再调用 API，TTL 过期与 LRU 淘汰"""
+    from gemini_cli import ContextManager, GeminiClient, ResponseCache
+
+    calls = []
+
+    class CountingModel(_StubModel):
+        def generate_content(self, prompt, stream=False):
+            calls.append(prompt)
+            return super().generate_content(prompt, stream)
+
+    class CountingBackend(_StubBackend):
+        def GenerativeModel(self, name):
+            return CountingModel(name)
+
+    cache = ResponseCache(tmp_path / "cache.db")
+    client = GeminiClient("key", context_manager=ContextManager(str(tmp_path)),
+                          backend=CountingBackend(), cache=cache)
+    assert client.generate("问候", "model-a")[0] == "你好，世界"
+    text, timing, _ = client.generate("问候", "model-a")
+    assert text == "你好，世界" and timing["cached"]
+    client.generate("问候", "model-b")
+    assert len(calls) == 2
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 2
+
+    # 命中缓存时不导入和配置 SDK（在子进程中检查，本进程可能已导入）
+    import subprocess
+    check = (
+        "import sys\n"
+        "from gemini_cli import ContextManager, GeminiClient, ResponseCache\n"
+        "cache = ResponseCache('sdk.db')\n"
+        "cache.put(ResponseCache.make_key('gemini-pro', '问候'), 'gemini-pro', '你好')\n"
+        "client = GeminiClient('key', context_manager=ContextManager('data'), cache=cache)\n"
+        "text, timing, _ = client.generate('问候', 'gemini-pro')\n"
+        "assert text == '你好' and timing['cached']\n"
+        "assert not client._configured and 'google.generativeai' not in sys.modules\n"
+    )
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)), GEMINI_TRANSPORT="sdk")
+    result = subprocess.run([sys.executable, "-c", check], cwd=tmp_path, env=env, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+
+    small = ResponseCache(tmp_path / "small.db", ttl=0.05, max_entries=2)
+    for key in ("a", "b"):
+        small.put(key, "m", key)
+    small.get("a")
+    small.put("c", "m", "c")  # b 最久未被访问，被淘汰
+    assert small.get("b") is None
+    assert small.get("a") == "a"
+    time.sleep(0.06)
+    assert small.get("c") is None
+
+    sized = ResponseCache(tmp_path / "sized.db", max_bytes=10)
+    for key in ("a", "b", "c"):
+        sized.put(key, "m", key * 4)
+    assert sized.get("a") is None and sized.get("c") == "cccc"
+    assert sized.stats()["entries"] == 2 and sized.stats()["evictions"] == 1
+
+
+def test_context_prompt_budget(tmp_path):
+    """测试按 Token 预算组装上下文：摘要优先，最新消息优先，边界处截断"""
+    from gemini_cli import ContextManager, estimate_tokens
+
+    manager = ContextManager(str(tmp_path), fsync_policy="never")
+    manager.create_session("预算")
+    for i in range(50):
+        manager.add_message("user" if i % 2 == 0 else "assistant", f"消息{i:02d}" + "内容" * 40)
+    manager.update_context_summary("讨论了五十条消息")
+
+    prompt = manager.build_context_prompt(token_budget=300)
+    assert prompt.startswith("上下文摘要: 讨论了五十条消息")
+    assert "消息49" in prompt and "消息48" in prompt
+    assert "消息00" not in prompt
+    assert prompt.index("消息48") < prompt.index("消息49")
+    assert estimate_tokens(prompt) <= 300 + 20  # 仅多出固定的标题文字
+
+    generous = manager.build_context_prompt(token_budget=100000)
+    assert "消息00" in generous
+
+
+def test_token_accounting(tmp_path):
+    """测试按响应 usage_metadata 记录 Token 用量，并在目录索引中按会话/模型汇总"""
+    from types import SimpleNamespace
+    from gemini_cli import ContextManager, GeminiClient
+
+    class UsageModel(_StubModel):
+        def generate_content(self, prompt, stream=False):
+            response = _Chunk("回答")
+            response.usage_metadata = SimpleNamespace(prompt_token_count=12, candidates_token_count=30,
+                                                      total_token_count=42)
+            return response
+
+    class UsageBackend(_StubBackend):
+        def GenerativeModel(self, name):
+            return UsageModel(name)
+
+    manager = ContextManager(str(tmp_path), fsync_policy="never")
+    client = GeminiClient("key", context_manager=manager, backend=UsageBackend())
+    session_id = manager.create_session("用量")
+    client.generate("问题一", "model-a", use_context=True)
+    client.generate("问题二", "model-b", use_context=True)
+    manager.close()
+
+    user, assistant = manager.current_session["messages"][:2]
+    assert user["tokens"] == 12 and assistant["tokens"] == 30
+    assert assistant["usage"]["model"] == "model-a"
+    assert manager.current_session["total_tokens"] == 84
+
+    def check(catalog):
+        assert catalog.usage_totals()["total_tokens"] == 84
+        assert catalog.usage_totals()["request_count"] == 2
+        assert {m["model"]: m["total_tokens"] for m in catalog.usage_by_model()} == {"model-a": 42, "model-b": 42}
+        assert catalog.top_sessions()[0]["id"] == session_id
+
+    check(manager.catalog)
+    # 目录索引丢失后可从会话文件重建相同的统计
+    for path in tmp_path.glob("catalog.db*"):
+        path.unlink()
+    rebuilt = ContextManager(str(tmp_path))
+    rebuilt.refresh_catalog()
+    check(rebuilt.catalog)
+
+
+def test_persistence_worker(tmp_path):
+    """后台写入：连续消息合并写入，flush 后可读，close 前处理完所有任务"""
+    from gemini_cli import ContextManager, PersistenceWorker
+
+    manager = ContextManager(str(tmp_path), fsync_policy="never")
+    session_id = manager.create_session("后台")
+    writer = PersistenceWorker(manager, max_pending=8)
+    for i in range(50):
+        writer.add_message("user", f"消息 {i}", tokens=1)
+    writer.flush()
+    assert len(manager.current_session["messages"]) == 50
+    assert writer.messages_written == 50 and writer.batches_written < 50
+
+    done = []
+    writer.add_message("assistant", "最后一条")
+    writer.submit(lambda: done.append(True))
+    writer.close()
+    manager.close()
+    assert done == [True]
+
+    reloaded = ContextManager(str(tmp_path))
+    assert reloaded.load_session(session_id)
+    assert len(reloaded.current_session["messages"]) == 51
+    assert reloaded.search_messages("最后一条")[0][0] == session_id
+
+
+def test_incremental_summary(tmp_path, capsys):
+    """增量摘要：按新增 Token 触发，只发送旧摘要和新增消息，偏移量随会话持久化"""
+    import threading
+    from gemini_cli import ContextManager, GeminiClient, PersistenceWorker
+
+    prompts, models = [], []
+    gate = threading.Event()
+    gate.set()
+
+    class SummaryModel(_StubModel):
+        broken = False
+
+        def generate_content(self, prompt, stream=False):
+            gate.wait(5)
+            models.append(self.name)
+            if self.broken:
+                raise ValueError("summary failed")
+            prompts.append(prompt)
+            return _Chunk(f"摘要{len(prompts)}")
+
+    class SummaryBackend(_StubBackend):
+        def GenerativeModel(self, name):
+            return SummaryModel(name)
+
+    manager = ContextManager(str(tmp_path), fsync_policy="never")
+    client = GeminiClient("key", context_manager=manager, backend=SummaryBackend())
+    client.summary_tokens = 100
+    session_id = manager.create_session("摘要")
+
+    manager.add_message("user", "第一轮 " + "甲" * 60)
+    client._generate_context_summary(auto=True)
+    assert prompts == []  # 未达到阈值
+
+    manager.add_message("assistant", "第一轮回复 " + "乙" * 60)
+    client._generate_context_summary(auto=True)
+    assert len(prompts) == 1 and "第一轮" in prompts[0]
+    assert manager.get_context_summary() == "摘要1" and manager.get_unsummarized_messages() == []
+
+    manager.add_message("user", "第二轮 " + "丙" * 120)
+    client._generate_context_summary(auto=True)
+    assert "摘要1" in prompts[1] and "第二轮" in prompts[1] and "第一轮" not in prompts[1]
+
+    # 后台自动摘要不改写最近一次请求的统计，失败时不输出错误
+    assert client.last_timing == {} and client.last_usage == {}
+    manager.add_message("user", "第三轮 " + "丁" * 120)
+    SummaryModel.broken = True
+    capsys.readouterr()
+    client._generate_context_summary(auto=True)
+    assert capsys.readouterr().out == "" and len(prompts) == 2
+    manager.close()
+
+    reloaded = ContextManager(str(tmp_path))
+    reloaded.load_session(session_id)
+    assert reloaded.current_session["summarized_upto"] == 3
+    assert reloaded.get_context_summary() == "摘要2"
+    reloaded.close()
+
+    # 聊天中的自动摘要：模型调用不占用写入线程，使用聊天的模型，关闭时不等待
+    SummaryModel.broken = False
+    gate.clear()
+    manager = ContextManager(str(tmp_path), fsync_policy="never")
+    manager.load_session(session_id)
+    client = GeminiClient("key", context_manager=manager, backend=SummaryBackend())
+    client.summary_tokens = 100
+    writer = PersistenceWorker(manager)
+    writer.add_message("user", "第四轮 " + "戊" * 120)
+    writer.submit(lambda: client._submit_auto_summary(writer, "chat-model"))
+    writer.flush()  # 摘要请求仍在等待，写入队列已处理完
+    assert manager.get_context_summary() == "摘要2"
+    gate.set()
+    for _ in range(100):
+        writer.flush()
+        if manager.get_context_summary() == "摘要3":
+            break
+        time.sleep(0.02)
+    assert manager.get_context_summary() == "摘要3" and models[-1] == "chat-model"
+
+    gate.clear()
+    writer.add_message("user", "第五轮 " + "己" * 120)
+    writer.submit(lambda: client._submit_auto_summary(writer, "chat-model"))
+    started = time.perf_counter()
+    writer.close()
+    assert time.perf_counter() - started < 1
+    gate.set()
+    manager.close()
+
+
+def test_retry_policy(tmp_path):
+    """重试层：临时错误按退避重试并遵守 retry-after，连续失败后熔断，计数器可读"""
+    from gemini_cli import ContextManager, GeminiClient, RetryPolicy, CircuitBreaker, CircuitOpenError, RateLimiter
+
+    class QuotaError(Exception):
+        code = 429
+        retry_after = 0.05
+
+    class BadRequest(Exception):
+        code = 400
+
+    failures = {"left": 2}
+
+    class FlakyModel(_StubModel):
+        def generate_content(self, prompt, stream=False):
+            if prompt == "bad":
+                raise BadRequest("invalid")
+            if failures["left"]:
+                failures["left"] -= 1
+                raise QuotaError("quota exceeded")
+            return super().generate_content(prompt, stream)
+
+    class FlakyBackend(_StubBackend):
+        def GenerativeModel(self, name):
+            return FlakyModel(name)
+
+    retry = RetryPolicy(max_retries=3, base_delay=0.01, limiter=RateLimiter(),
+                        breaker=CircuitBreaker(failure_threshold=3, reset_timeout=0.2))
+    manager = ContextManager(str(tmp_path), fsync_policy="never")
+    client = GeminiClient("key", context_manager=manager, backend=FlakyBackend(), retry=retry)
+
+    started = time.monotonic()
+    assert client.generate("你好")[0] == "你好，世界"
+    assert time.monotonic() - started >= 0.1  # 两次重试都等待了 retry-after
+    assert retry.stats()["retries"] == 2
+
+    # 不可重试的错误立即抛出
+    try:
+        client.generate("bad")
+        assert False, "应当抛出 BadRequest"
+    except BadRequest:
+        pass
+    assert retry.stats()["retries"] == 2
+
+    # 重试耗尽后连续失败达到阈值，熔断期间快速失败，超时后试探成功恢复
+    failures["left"] = 4
+    try:
+        client.generate("你好")
+        assert False, "应当熔断"
+    except CircuitOpenError:
+        pass
+    stats = retry.stats()
+    assert stats["rejected"] == 1 and stats["circuit"] == "open"
+    time.sleep(0.25)
+    failures["left"] = 0
+    assert client.generate("你好")[0] == "你好，世界"
+    assert retry.stats()["circuit"] == "closed"
+
+    # 流式输出开始后出错不重试，避免重复输出
+    class BrokenStreamModel(_StubModel):
+        def generate_content(self, prompt, stream=False):
+            yield _Chunk("你好")
+            raise QuotaError("stream interrupted")
+
+    class BrokenStreamBackend(_StubBackend):
+        def GenerativeModel(self, name):
+            return BrokenStreamModel(name)
+
+    streaming = GeminiClient("key", context_manager=manager, backend=BrokenStreamBackend(),
+                             retry=RetryPolicy(max_retries=3, base_delay=0.01, limiter=RateLimiter()))
+    chunks = []
+    try:
+        streaming.generate("你好", on_chunk=chunks.append)
+        assert False, "应当抛出 QuotaError"
+    except QuotaError:
+        pass
+    assert chunks == ["你好"] and streaming.retry.stats()["retries"] == 0
+    assert RetryPolicy.retry_after(Exception("Please retry in 12.5s.")) == 12.5
+
+
+def test_rest_transport(tmp_path, monkeypatch):
+    """REST 传输：连接复用、流式 SSE、对话历史、503 重试，代理不写入环境变量"""
+    from benchmarks.stub_server import StubGeminiServer
+    from gemini_cli import ContextManager, GeminiClient, RestBackend, RetryPolicy, RateLimiter
+
+    # 本地桩服务器不经过代理，与外部环境变量无关
+    for key in ("HTTP_PROXY", "HTTPS_PROXY", "ALL_PROXY", "http_proxy", "https_proxy", "all_proxy"):
+        monkeypatch.delenv(key, raising=False)
+    monkeypatch.setenv("NO_PROXY", "127.0.0.1,localhost")
+
+    with StubGeminiServer() as server:
+        backend = RestBackend(endpoint=server.endpoint)
+        manager = ContextManager(str(tmp_path), fsync_policy="never")
+        client = GeminiClient("key", context_manager=manager, backend=backend,
+                              retry=RetryPolicy(base_delay=0.01, limiter=RateLimiter()))
+        text, _, usage = client.generate("你好", "stub-pro")
+        assert text == "回复: 你好" and usage["total_tokens"] == usage["prompt_tokens"] + usage["candidate_tokens"]
+
+        chunks = []
+        assert client.generate("世界", "stub-pro", on_chunk=chunks.append)[0] == "回复: 世界"
+        assert len(chunks) == 3
+
+        server.fail_next = 1
+        assert client.generate("重试", "stub-pro")[0] == "回复: 重试"
+        assert client.retry.stats()["retries"] == 1
+
+        chat = backend.GenerativeModel("stub-pro").start_chat()
+        list(chat.send_message("第一句", stream=True))
+        chat.send_message("第二句")
+        assert [item["parts"][0] for item in chat.history] == ["第一句", "回复: 第一句", "第二句", "回复: 第二句"]
+        assert len(server.requests[-1][2]["contents"]) == 3
+        assert server.connections == 1  # 所有请求复用同一个连接
+        assert server.requests[0][1] == "/v1beta/models/stub-pro:generateContent"
+
+    proxied = GeminiClient("key", {"HTTPS_PROXY": "http://proxy.invalid:3128"}, context_manager=manager,
+                           backend=RestBackend(proxies={"HTTPS_PROXY": "http://proxy.invalid:3128"}))
+    assert proxied.genai.session.proxies == {"https": "http://proxy.invalid:3128"}
+    assert os.environ.get("HTTPS_PROXY") != "http://proxy.invalid:3128"
+
+
+def test_daemon_forwarding(tmp_path):
+    """serve 守护进程：generate 命令 (包括带全局选项时) 转发给常驻进程执行，复用同一个连接池"""
+    import subprocess
+    from benchmarks.stub_server import StubGeminiServer
+
+    if not hasattr(__import__("socket"), "AF_UNIX"):
+        return
+
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    with StubGeminiServer() as server:
+        env = dict(os.environ, GEMINI_API_KEY="key", GEMINI_TRANSPORT="rest", GEMINI_ENDPOINT=server.endpoint,
+                   PYTHONPATH=package_dir, HTTP_PROXY="", HTTPS_PROXY="")
+
+        def run(*args, **extra_env):
+            return subprocess.run([sys.executable, "-m", "gemini_cli"] + list(args), cwd=tmp_path,
+                                  env=dict(env, **extra_env), capture_output=True, text=True, encoding="utf-8",
+                                  timeout=60)
+
+        daemon = subprocess.Popen([sys.executable, "-m", "gemini_cli", "serve"], cwd=tmp_path, env=env,
+                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            socket_path = tmp_path / ".gemini_data" / "gemini.sock"
+            for _ in range(100):
+                if socket_path.exists():
+                    break
+                time.sleep(0.05)
+            assert socket_path.exists()
+
+            for prompt in ("你好", "世界"):
+                result = run("generate", "--no-cache", "-m", "stub-pro", prompt)
+                assert result.returncode == 0, result.stderr
+                assert f"回复: {prompt}" in result.stdout
+            assert len(server.requests) == 2 and server.connections == 1  # 两次命令复用守护进程的连接
+
+            # 全局选项在命令之前时同样转发，耗时汇总由守护进程输出
+            result = run("--timings", "generate", "--no-cache", "-m", "stub-pro", "计时")
+            assert result.returncode == 0 and "回复: 计时" in result.stdout
+            assert "分阶段耗时" in result.stderr and "startup.import" not in result.stderr
+            assert server.connections == 1
+
+            # 环境变量与守护进程不同时在本进程执行，使用自己的连接
+            result = run("generate", "--no-cache", "-m", "stub-pro", "本地", GEMINI_RETRY_BASE="0")
+            assert result.returncode == 0 and "回复: 本地" in result.stdout
+            assert server.connections == 2
+
+            # 需要交互输入的命令不转发
+            assert run("generate", "--help").returncode == 0
+            assert run("serve", "--stop").returncode == 0
+            daemon.wait(timeout=10)
+        finally:
+            if daemon.poll() is None:
+                daemon.kill()
+        assert not socket_path.exists()
+
+        # 守护进程退出后回退到本进程执行
+        result = run("generate", "--no-cache", "-m", "stub-pro", "再见")
+        assert result.returncode == 0 and "回复: 再见" in result.stdout
+        assert server.connections == 3
+
+
+def test_sqlite_storage(tmp_path):
+    """SQLite 存储后端：从日志迁移、尾部读取、多个连接并发追加同一会话、全文检索"""
+    from gemini_cli import ContextManager, migrate_sessions
+
+    journal = ContextManager(str(tmp_path), fsync_policy="never")
+    session_id = journal.create_session("迁移")
+    for i in range(30):
+        journal.add_message("user" if i % 2 == 0 else "assistant", f"消息 {i}", tokens=1,
+                            extra={"usage": {"model": "m", "prompt_tokens": 1, "candidate_tokens": 0,
+                                             "total_tokens": 1}} if i % 2 else None)
+    journal.update_context_summary("旧摘要")
+    journal.close()
+    legacy = {"id": "legacy01", "name": "旧会话", "created_at": "2024-01-01T00:00:00", "context_summary": "",
+              "messages": [{"role": "user", "content": "旧消息", "timestamp": "2024-01-01T00:00:00", "tokens": 0}]}
+    (tmp_path / "sessions" / "legacy01.json").write_text(json.dumps(legacy), encoding="utf-8")
+
+    first = ContextManager(str(tmp_path), storage="sqlite")
+    assert migrate_sessions(ContextManager(str(tmp_path)), first) == (2, 0)
+    assert migrate_sessions(ContextManager(str(tmp_path)), first) == (0, 2)
+
+    peek = first.peek_session(session_id, limit=3)
+    assert [m["content"] for m in peek["messages"]] == ["消息 27", "消息 28", "消息 29"]
+    assert peek["message_count"] == 30 and peek["context_summary"] == "旧摘要"
+    assert peek["messages"][0]["usage"]["model"] == "m"
+    assert first.catalog.usage_totals()["request_count"] == 15
+
+    # 两个连接（相当于两个进程）交替追加同一会话，序号由数据库分配
+    second = ContextManager(str(tmp_path), storage="sqlite")
+    assert first.load_session(session_id) and second.load_session(session_id)
+    for i in range(5):
+        first.add_message("user", f"甲 {i}")
+        second.add_message("user", f"乙 {i}")
+    second.update_context_summary("新摘要")
+
+    reloaded = ContextManager(str(tmp_path), storage="sqlite")
+    assert reloaded.load_session(session_id)
+    assert len(reloaded.current_session["messages"]) == 40
+    assert reloaded.current_session["messages"][-1]["content"] == "乙 4"
+    assert reloaded.get_context_summary() == "新摘要"
+    assert {s["id"]: s["message_count"] for s in reloaded.list_sessions()} == {session_id: 40, "legacy01": 1}
+    assert [sid for sid, _ in reloaded.search_messages("旧消息")] == ["legacy01"]
+
+
+def test_concurrent_session_writers(tmp_path):
+    """压力测试：多个进程同时向同一会话追加消息、更新摘要并压缩日志，消息一条不丢"""
+    import subprocess
+    from gemini_cli import ContextManager
+
+    worker = (
+        "import sys, gemini_cli\n"
+        "name, data_dir, storage, session_id = sys.argv[1:]\n"
+        "manager = gemini_cli.ContextManager(data_dir, fsync_policy='never', compact_threshold=3, storage=storage)\n"
+        "assert manager.load_session(session_id)\n"
+        "for i in range(40):\n"
+        "    manager.add_message('user', f'{name}-{i}', tokens=1)\n"
+        "    if i % 5 == 4:\n"
+        "        manager.update_context_summary(f'{name} 摘要 {i}')\n"
+        "    if i % 13 == 12:\n"
+        "        manager.save_session()\n"
+        "manager.close()\n"
+    )
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=package_dir)
+
+    for storage in ContextManager.STORAGE_BACKENDS:
+        data_dir = tmp_path / storage
+        manager = ContextManager(str(data_dir), fsync_policy="never", storage=storage)
+        session_id = manager.create_session("并发")
+        manager.close()
+
+        workers = [subprocess.Popen([sys.executable, "-c", worker, f"w{n}", str(data_dir), storage, session_id],
+                                    env=env) for n in range(8)]
+        assert all(process.wait(timeout=120) == 0 for process in workers)
+
+        reloaded = ContextManager(str(data_dir), storage=storage)
+        assert reloaded.load_session(session_id)
+        contents = [message["content"] for message in reloaded.current_session["messages"]]
+        assert sorted(contents) == sorted(f"w{n}-{i}" for n in range(8) for i in range(40))
+        for n in range(8):  # 每个进程的消息保持写入顺序
+            own = [c for c in contents if c.startswith(f"w{n}-")]
+            assert own == [f"w{n}-{i}" for i in range(40)]
+        assert reloaded.current_session["total_tokens"] == 320
+        assert reloaded.list_sessions()[0]["message_count"] == 320
+        assert not list((data_dir / "sessions").glob("*.tmp"))
+        # 全文索引中的序号唯一且与会话中的消息顺序一致
+        reloaded.sync_index()
+        indexed = reloaded.index.conn.execute(
+            "SELECT seq, content FROM indexed_messages WHERE session_id = ? ORDER BY seq", (session_id,)).fetchall()
+        assert [tuple(row) for row in indexed] == list(enumerate(contents))
+
+
 if __name__ == '__main__':
     test_basic_functionality()
\ No newline at end of file